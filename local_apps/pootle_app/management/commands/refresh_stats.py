@@ -28,13 +28,15 @@ from django.core.management.base import NoArgsCommand
 
 from pootle_translationproject.models import TranslationProject
 from pootle_app import project_tree
+from pootle_store.fields import TranslationStoreFieldFile
+from pootle_store.qualitychecks import make_check_pool
 
 class Command(NoArgsCommand):
     option_list = NoArgsCommand.option_list + (
         make_option('--directory', action='store', dest='directory', default='',
                     help='directory to refresh relative to po directory'),
         make_option('--recompute', action='store_true', dest='recompute', default=False,
-                    help='Update the mtime of file, thereby forcing stats and index recomputation.'),
+                    help='Update the mtime of file and recalculate stored stats, thereby forcing stats and index recomputation.'),
         )
     help = "Allow stats and text indices to be refreshed manually."
 
@@ -42,33 +44,40 @@ class Command(NoArgsCommand):
         refresh_path = options.get('directory', '')
         recompute = options.get('recompute', False)
 
-        # reduce size of parse pool early on
-        from pootle_store.fields import  TranslationStoreFieldFile
-        TranslationStoreFieldFile._store_cache.maxsize = 2
-        TranslationStoreFieldFile._store_cache.cullsize = 2
+        # one set of quality check processes for the whole run
+        pool = make_check_pool()
+        try:
+            for translation_project in TranslationProject.objects.filter(real_path__startswith=refresh_path).iterator():
+                if not os.path.isdir(translation_project.abs_real_path):
+                    # translation project no longer exists
+                    translation_project.delete()
+                    continue
 
+                # rescan translation_projects
+                project_tree.scan_translation_project_files(translation_project)
+                if recompute:
+                    for store in translation_project.stores.iterator():
+                        # We force stats and indexing information to be recomputed by
+                        # updating the mtimes of the files whose information we want
+                        # to update.
+                        logging.info("Resetting mtime for %s to now", store.real_path)
+                        os.utime(store.abs_real_path, None)
+                        # materialized stats are recalculated from the units
+                        # in case they drifted
+                        store.patch_quickstats(store.update_stats())
 
-        for translation_project in TranslationProject.objects.filter(real_path__startswith=refresh_path).iterator():
-            if not os.path.isdir(translation_project.abs_real_path):
-                # translation project no longer exists
-                translation_project.delete()
-                continue
+                # This will force the indexer of a TranslationProject to be
+                # initialized. The indexer will update the text index of the
+                # TranslationProject if it is out of date.
+                translation_project.indexer
 
-            # rescan translation_projects
-            project_tree.scan_translation_project_files(translation_project)
-            if recompute:
-                for store in translation_project.stores.iterator():
-                    # We force stats and indexing information to be recomputed by
-                    # updating the mtimes of the files whose information we want
-                    # to update.
-                    logging.info("Resetting mtime for %s to now", store.real_path)
-                    os.utime(store.abs_real_path, None)
+                logging.info("Updating stats for %s", translation_project.fullname)
+                if not translation_project.is_template_project:
+                    translation_project.require_qualitychecks(pool=pool)
+                translation_project.getcompletestats()
+                translation_project.getquickstats()
+        finally:
+            if pool is not None:
+                pool.close()
 
-            # This will force the indexer of a TranslationProject to be
-            # initialized. The indexer will update the text index of the
-            # TranslationProject if it is out of date.
-            translation_project.indexer
-
-            logging.info("Updating stats for %s", translation_project.fullname)
-            translation_project.getcompletestats()
-            translation_project.getquickstats()
+        logging.debug("Parse pool usage: %r", TranslationStoreFieldFile._store_cache.get_stats())
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2010 Zuza Software Foundation
+#
+# This file is part of Pootle.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+import os
+os.environ['DJANGO_SETTINGS_MODULE'] = 'pootle.settings'
+
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from pootle_app.models.task import Task
+# tasks are registered by the modules defining them
+import pootle_translationproject.models
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--forever', action='store_true', dest='forever', default=False,
+                    help='keep waiting for new tasks instead of exiting when the queue is empty'),
+        make_option('--interval', action='store', type='int', dest='interval', default=5,
+                    help='seconds between checks for new tasks'),
+        )
+    help = "Run background tasks queued by the web interface."
+
+    def handle_noargs(self, **options):
+        forever = options.get('forever', False)
+        interval = options.get('interval', 5)
+
+        while True:
+            count = Task.objects.run_pending()
+            if not forever:
+                break
+            if not count:
+                time.sleep(interval)
@@ -41,12 +41,6 @@ class Command(NoArgsCommand):
         refresh_path = options.get('directory', '')
         overwrite = options.get('overwrite', False)
 
-        # reduce size of parse pool early on
-        from pootle_store.fields import  TranslationStoreFieldFile
-        TranslationStoreFieldFile._store_cache.maxsize = 2
-        TranslationStoreFieldFile._store_cache.cullsize = 2
-
-
         for translation_project in TranslationProject.objects.filter(real_path__startswith=refresh_path).iterator():
             if not os.path.isdir(translation_project.abs_real_path):
                 # translation project no longer exists
@@ -27,6 +27,7 @@ from optparse import make_option
 from django.core.management.base import NoArgsCommand
 
 from pootle_translationproject.models import TranslationProject
+from pootle_store.qualitychecks import make_check_pool
 
 class Command(NoArgsCommand):
     option_list = NoArgsCommand.option_list + (
@@ -41,20 +42,22 @@ class Command(NoArgsCommand):
         refresh_path = options.get('directory', '')
         keep = options.get('keep', False)
 
-        # reduce size of parse pool early on
-        from pootle_store.fields import  TranslationStoreFieldFile
-        TranslationStoreFieldFile._store_cache.maxsize = 2
-        TranslationStoreFieldFile._store_cache.cullsize = 2
-
-
-        for translation_project in TranslationProject.objects.filter(real_path__startswith=refresh_path).iterator():
-            if not os.path.isdir(translation_project.abs_real_path):
-                # translation project no longer exists
-                translation_project.delete()
-                continue
-
-            logging.info("Updating translations from %s", translation_project.fullname)
-            # update new translations
-            for store in translation_project.stores.exclude(file='').iterator():
-                store.update(update_translation=not keep, conservative=keep, update_structure=True)
+        # one set of quality check processes for the whole run
+        pool = make_check_pool()
+        try:
+            for translation_project in TranslationProject.objects.filter(real_path__startswith=refresh_path).iterator():
+                if not os.path.isdir(translation_project.abs_real_path):
+                    # translation project no longer exists
+                    translation_project.delete()
+                    continue
+
+                logging.info("Updating translations from %s", translation_project.fullname)
+                # update new translations
+                for store in translation_project.stores.exclude(file='').iterator():
+                    store.update(update_translation=not keep, conservative=keep, update_structure=True)
+                if not translation_project.is_template_project:
+                    translation_project.require_qualitychecks(pool=pool)
+        finally:
+            if pool is not None:
+                pool.close()
 
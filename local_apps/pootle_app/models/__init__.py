@@ -22,7 +22,8 @@
 from pootle_app.models.suggestion import Suggestion
 from pootle_app.models.directory import Directory
 from pootle_app.models.permissions import PermissionSet
+from pootle_app.models.task import Task
 
-__all__ = ["Suggestion", "Directory", "PermissionSet"]
+__all__ = ["Suggestion", "Directory", "PermissionSet", "Task"]
 
 
@@ -21,8 +21,8 @@
 
 from django.db                import models
 
-from pootle_store.util import empty_quickstats, empty_completestats, statssum, completestatssum
-from pootle_store.models import Suggestion, Unit
+from pootle_store.util import empty_quickstats, empty_completestats, completestatssum
+from pootle_store.models import Suggestion, Unit, store_stats_sum
 
 from pootle_misc.util import getfromcache, dictsum
 from pootle_misc.aggregate import max_column
@@ -113,13 +113,7 @@ class Directory(models.Model):
             #FIXME: Hackish return empty_stats to avoid messing up
             # with project and language stats
             return empty_quickstats
-        #FIXME: can we replace this with a quicker path query?
-        file_result = statssum(self.child_stores.iterator())
-        dir_result  = statssum(self.child_dirs.iterator())
-        stats = dictsum(file_result, dir_result)
-        return stats
-
-        #return calculate_stats(Unit.objects.filter(store__pootle_path__startswith=self.pootle_path))
+        return store_stats_sum(pootle_path__startswith=self.pootle_path)
 
     @getfromcache
     def getcompletestats(self):
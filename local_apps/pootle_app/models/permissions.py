@@ -19,13 +19,17 @@
 # along with translate; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
-from django.db import models
+import threading
+
+from django.db import models, connection
+from django.db.models import Q
 from django.core.cache import cache
 from django.conf import settings
 from django.contrib.auth.models import Permission
 from django.contrib.contenttypes.models import ContentType
 
 from pootle_app.lib.util import RelatedManager
+from pootle_misc.util import CACHE_PATCH_LIMIT
 
 def get_pootle_permission(codename):
     # The content type of our permission
@@ -42,29 +46,159 @@ def get_pootle_permissions(codenames=None):
         permissions = Permission.objects.filter(content_type=content_type)
     return dict((permission.codename, permission) for permission in permissions)
 
+PERMISSION_CACHE_SIZE = 10000
+"""permission trees of (user, translation project) pairs each process
+keeps in memory, all are dropped when there are more"""
+
+_GENERATION_KEY = "permissions:generation"
+
+# (username, tree path) -> {directory path: permission bitmask}
+_trees = {}
+_trees_generation = [None]
+_trees_lock = threading.Lock()
+# permission id -> codename, bits of masks are permission ids
+_codenames = {}
+_mask_dicts = {}
+_request_memo = threading.local()
+
+def _drop_trees(usernames):
+    for key in _trees.keys():
+        if key[0] in usernames:
+            del _trees[key]
+
+def _log_permission_change(username):
+    """tell all processes to drop the permission trees of username"""
+    _trees_lock.acquire()
+    try:
+        _drop_trees([username])
+    finally:
+        _trees_lock.release()
+    try:
+        generation = cache.incr(_GENERATION_KEY)
+    except ValueError:
+        cache.add(_GENERATION_KEY, 0, settings.OBJECT_CACHE_TIMEOUT)
+        generation = cache.incr(_GENERATION_KEY)
+    cache.set("%s:%d" % (_GENERATION_KEY, generation), username, settings.OBJECT_CACHE_TIMEOUT)
+
+def _sync_trees():
+    """drop permission trees of users whose permission sets changed
+    since this process last checked, or all of them if the changes
+    can't be told"""
+    generation = cache.get(_GENERATION_KEY, 0)
+    _trees_lock.acquire()
+    try:
+        known = _trees_generation[0]
+        if known == generation:
+            return
+        if known is None or known > generation or generation - known > CACHE_PATCH_LIMIT:
+            _trees.clear()
+        else:
+            log_keys = ["%s:%d" % (_GENERATION_KEY, i) for i in xrange(known + 1, generation + 1)]
+            log = cache.get_many(log_keys)
+            if len(log) < len(log_keys):
+                _trees.clear()
+            else:
+                _drop_trees(set(log.values()))
+        _trees_generation[0] = generation
+    finally:
+        _trees_lock.release()
+
+def start_request_memo():
+    """bring permission trees up to date once for the whole request,
+    used by PermissionsMiddleware"""
+    _sync_trees()
+    _request_memo.synced = True
+
+def end_request_memo():
+    _request_memo.synced = False
+
+def _get_tree_path(pootle_path):
+    """path of the translation project (or language or project)
+    directory pootle_path is in, permission sets of a tree are loaded
+    together"""
+    path_parts = filter(None, pootle_path.split('/'))
+    return '/' + ''.join(part + '/' for part in path_parts[:2])
+
+def _load_permission_tree(username, tree_path):
+    """bitmasks of the positive permissions of username's permission
+    sets that can apply to directories in tree_path, by directory
+    path, loaded with two queries"""
+    path_parts = filter(None, tree_path.split('/'))
+    paths = ['/' + ''.join(part + '/' for part in path_parts[:i]) for i in xrange(len(path_parts))]
+    if len(path_parts) > 1 and path_parts[0] != 'projects':
+        paths.append('/projects/%s/' % path_parts[1])
+    query = Q(directory__pootle_path__startswith=tree_path)
+    if paths:
+        query |= Q(directory__pootle_path__in=paths)
+    rows = PermissionSet.objects.filter(query, profile__user__username=username)
+    paths = dict(rows.values_list('id', 'directory__pootle_path').iterator())
+    tree = dict((pootle_path, 0) for pootle_path in paths.itervalues())
+    if not paths:
+        return tree
+
+    # values_list can't follow many to many fields before django 1.2
+    field = PermissionSet._meta.get_field('positive_permissions')
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    cursor.execute("SELECT %s, %s FROM %s WHERE %s IN (%s)" % (
+        qn(field.m2m_column_name()), qn(field.m2m_reverse_name()), qn(field.m2m_db_table()),
+        qn(field.m2m_column_name()), ", ".join(["%s"] * len(paths))), paths.keys())
+    for permissionset_id, permission_id in cursor.fetchall():
+        tree[paths[permissionset_id]] |= 1 << permission_id
+    return tree
+
+def _resolve_mask(tree, pootle_path):
+    path_parts = filter(None, pootle_path.split('/'))
+    # closest permission set up the directory's trail wins
+    for i in xrange(len(path_parts), -1, -1):
+        path = '/' + ''.join(part + '/' for part in path_parts[:i])
+        if path in tree:
+            if i < 2 and len(path_parts) > 1 and path_parts[0] != 'projects':
+                # active permission at language level or higher, check project level permission
+                project_path = '/projects/%s/' % path_parts[1]
+                if project_path in tree:
+                    return tree[project_path]
+            return tree[path]
+    return None
+
+def _mask_to_dict(mask):
+    """dict of the codenames of permissions in mask, shared by all
+    lookups with the same result"""
+    if mask not in _mask_dicts:
+        ids = []
+        permission_id = 0
+        while mask >> permission_id:
+            if mask & (1 << permission_id):
+                ids.append(permission_id)
+            permission_id += 1
+        if [permission_id for permission_id in ids if permission_id not in _codenames]:
+            _codenames.update(Permission.objects.values_list('id', 'codename').iterator())
+        _mask_dicts[mask] = dict((_codenames[permission_id], True) for permission_id in ids)
+    return _mask_dicts[mask]
+
 def get_permissions_by_username(username, directory):
     pootle_path = directory.pootle_path
-    path_parts = filter(None, pootle_path.split('/'))
-    key = 'Permissions:%s' % username
-    permissions_cache = cache.get(key, {})
-    if pootle_path not in permissions_cache:
+    key = (username, _get_tree_path(pootle_path))
+    if not getattr(_request_memo, 'synced', False):
+        _sync_trees()
+    _trees_lock.acquire()
+    try:
+        tree = _trees.get(key)
+    finally:
+        _trees_lock.release()
+    if tree is None:
+        tree = _load_permission_tree(username, key[1])
+        _trees_lock.acquire()
         try:
-            permissionset = PermissionSet.objects.filter(
-                directory__in=directory.trail(only_dirs=False),
-                profile__user__username=username).order_by('-directory__pootle_path')[0]
-            if len(path_parts) > 1 and path_parts[0] != 'projects' and len(filter(None, permissionset.directory.pootle_path.split('/'))) < 2:
-                # active permission at language level or higher, check project level permission
-                try:
-                    project_path = '/projects/%s/' % path_parts[1]
-                    permissionset = PermissionSet.objects.get(directory__pootle_path=project_path, profile__user__username=username)
-                except PermissionSet.DoesNotExist:
-                    pass
-            permissions_cache[pootle_path] = permissionset.to_dict()
-        except IndexError:
-            permissions_cache[pootle_path] = None
-        cache.set(key, permissions_cache, settings.OBJECT_CACHE_TIMEOUT)
-
-    return permissions_cache[pootle_path]
+            if len(_trees) >= PERMISSION_CACHE_SIZE:
+                _trees.clear()
+            _trees[key] = tree
+        finally:
+            _trees_lock.release()
+    mask = _resolve_mask(tree, pootle_path)
+    if mask is None:
+        return None
+    return _mask_to_dict(mask)
 
 def get_matching_permissions(profile, directory):
     if profile.user.is_authenticated():
@@ -113,10 +247,17 @@ class PermissionSet(models.Model):
 
     def save(self, *args, **kwargs):
         super(PermissionSet, self).save(*args, **kwargs)
-        key = 'Permissions:%s' % self.profile.user.username
-        cache.delete(key)
+        _log_permission_change(self.profile.user.username)
 
     def delete(self, *args, **kwargs):
         super(PermissionSet, self).delete(*args, **kwargs)
-        key = 'Permissions:%s' % self.profile.user.username
-        cache.delete(key)
+        _log_permission_change(self.profile.user.username)
+
+def permissions_changed(sender, instance, **kwargs):
+    _log_permission_change(instance.profile.user.username)
+
+try:
+    from django.db.models.signals import m2m_changed
+    m2m_changed.connect(permissions_changed, sender=PermissionSet.positive_permissions.through)
+except ImportError:
+    pass
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2010 Zuza Software Foundation
+#
+# This file is part of Pootle.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+"""queue of expensive jobs run outside of web requests by the
+run_tasks management command"""
+
+import datetime
+import logging
+
+from django.db import models
+from django.conf import settings
+from django.contrib.auth.models import User
+
+# Task States
+FAILED = -1
+"""task raised an exception"""
+PENDING = 0
+"""task waiting for a worker"""
+RUNNING = 1
+"""task picked up by a worker"""
+DONE = 2
+"""task finished successfully"""
+
+TASK_RETRY_INTERVAL = 3600
+"""seconds before a finished task is queued again for the same
+object, to avoid queueing jobs that keep leaving work undone (like
+parsing broken files) on every page view"""
+
+TASK_TIMEOUT = 3 * 3600
+"""seconds after which a running task is assumed to belong to a
+worker that died, and is marked failed"""
+
+_task_functions = {}
+
+def register_task(name, description):
+    """decorator registering function as the job run by tasks called
+    name. the function gets the task, whose pootle_path identifies the
+    object to work on"""
+    def decorator(function):
+        _task_functions[name] = (function, description)
+        return function
+    return decorator
+
+def use_task_queue():
+    return getattr(settings, 'USE_TASK_QUEUE', False)
+
+
+class TaskManager(models.Manager):
+    def queue(self, name, pootle_path, user=None):
+        """add a task unless an identical one is already pending"""
+        try:
+            return self.filter(name=name, pootle_path=pootle_path, state=PENDING)[0]
+        except IndexError:
+            return self.create(name=name, pootle_path=pootle_path, user=user)
+
+    def fail_stale(self):
+        """mark tasks left running by dead workers failed, so pages
+        stop waiting for them. returns number of tasks failed"""
+        now = datetime.datetime.now()
+        timeout = now - datetime.timedelta(seconds=TASK_TIMEOUT)
+        return self.filter(state=RUNNING, started__lt=timeout).update(
+            state=FAILED, finished=now, message=u"Timed out")
+
+    def require(self, name, pootle_path):
+        """queue a task some page depends on, returns the unfinished
+        task or None if the job recently ran and should be left to
+        the page itself"""
+        self.fail_stale()
+        try:
+            return self.filter(name=name, pootle_path=pootle_path, state__in=[PENDING, RUNNING])[0]
+        except IndexError:
+            pass
+        retry_time = datetime.datetime.now() - datetime.timedelta(seconds=TASK_RETRY_INTERVAL)
+        if self.filter(name=name, pootle_path=pootle_path, finished__gt=retry_time).count():
+            return None
+        return self.queue(name, pootle_path)
+
+    def run_pending(self):
+        """run pending tasks one by one until none are left, returns
+        number of tasks run"""
+        self.fail_stale()
+        count = 0
+        while True:
+            try:
+                task = self.filter(state=PENDING).order_by('created')[0]
+            except IndexError:
+                return count
+            # make sure no other worker claimed it meanwhile
+            if self.filter(pk=task.pk, state=PENDING).update(state=RUNNING,
+                                                             started=datetime.datetime.now()) == 0:
+                continue
+            task.run()
+            count += 1
+
+
+class Task(models.Model):
+    class Meta:
+        app_label = "pootle_app"
+        ordering = ['created']
+
+    name        = models.CharField(max_length=64, db_index=True)
+    pootle_path = models.CharField(max_length=255, db_index=True)
+    user        = models.ForeignKey(User, null=True)
+    state       = models.IntegerField(default=PENDING, db_index=True)
+    progress    = models.IntegerField(default=0)
+    message     = models.TextField(blank=True)
+    created     = models.DateTimeField(auto_now_add=True)
+    started     = models.DateTimeField(null=True)
+    finished    = models.DateTimeField(null=True)
+
+    objects = TaskManager()
+
+    def __unicode__(self):
+        return u"%s %s" % (self.name, self.pootle_path)
+
+    def _get_description(self):
+        try:
+            return _task_functions[self.name][1]
+        except KeyError:
+            return self.name
+    description = property(_get_description)
+
+    def set_progress(self, done, total):
+        self.progress = done * 100 / max(total, 1)
+        Task.objects.filter(pk=self.pk).update(progress=self.progress)
+
+    def run(self):
+        logging.info("Running task %s", self)
+        self.state = RUNNING
+        self.started = datetime.datetime.now()
+        self.save()
+        try:
+            function = _task_functions[self.name][0]
+            function(self)
+            self.state = DONE
+            self.progress = 100
+        except Exception, e:
+            logging.exception("Task %s failed", self)
+            self.state = FAILED
+            self.message = unicode(e)
+        self.finished = datetime.datetime.now()
+        self.save()
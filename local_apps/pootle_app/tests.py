@@ -1,5 +1,9 @@
 import os
 import zipfile
+import datetime
+
+from django.conf import settings
+from django.contrib.csrf.middleware import _make_token
 
 from translate.misc import wStringIO
 
@@ -8,6 +12,12 @@ from pootle.tests import PootleTestCase, formset_dict
 from pootle_project.models import Project
 from pootle_language.models import Language
 from pootle_store.models import Store
+from pootle_translationproject.models import TranslationProject
+from pootle_app.models.task import Task, DONE, FAILED, RUNNING, TASK_TIMEOUT
+from pootle_app.models.directory import Directory
+from pootle_app.models.permissions import PermissionSet, get_permissions_by_username, get_matching_permissions
+from pootle_app.models.permissions import start_request_memo, end_request_memo
+from pootle_profile.models import PootleProfile
 
 
 def unit_dict(pootle_path):
@@ -393,6 +403,28 @@ msgstr "resto"
         store = Store.objects.get(pootle_path=pootle_path)
         self.assertEqual(store.units[0].getnotes(), 'goodbye\nand thanks for all the fish')
 
+    def test_export_zip(self):
+        """zip export streams a valid archive of the translation project"""
+        response = self.client.get('/af/pootle/export/zip')
+        content = ''.join(response)
+        self.assertEqual(len(content), int(response['Content-Length']))
+        archive = zipfile.ZipFile(wStringIO.StringIO(content), 'r')
+        self.assertEqual(archive.testzip(), None)
+        self.assertTrue('pootle.po' in archive.namelist())
+
+    def test_terminology_extract(self):
+        """terminology extraction runs over the stored units and
+        creates the terminology store"""
+        session_id = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+        post_dict = {'extract': 'Extract',
+                     'csrfmiddlewaretoken': _make_token(session_id),
+                     }
+        response = self.client.post('/af/pootle/terminology_extract.html', post_dict)
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['Location'].endswith('/af/pootle/terminology_manage.html'))
+        store = Store.objects.get(pootle_path='/af/pootle/pootle-terminology.po')
+        self.assertEqual(store.translation_project.pootle_path, '/af/pootle/')
+
 
 class NonprivTests(PootleTestCase):
     def setUp(self):
@@ -423,3 +455,73 @@ class NonprivTests(PootleTestCase):
         suggestions = [str(sug) for sug in store.findunit('test').get_suggestions()]
         self.assertTrue('samaka' in suggestions)
 
+
+class TaskTests(PootleTestCase):
+    def test_queue_and_run(self):
+        """identical pending tasks are queued once and workers run them"""
+        task = Task.objects.queue('require_units', '/af/pootle/')
+        self.assertEqual(Task.objects.queue('require_units', '/af/pootle/').pk, task.pk)
+        self.assertEqual(Task.objects.run_pending(), 1)
+        task = Task.objects.get(pk=task.pk)
+        self.assertEqual(task.state, DONE)
+        self.assertEqual(task.progress, 100)
+        # recently done, left to the page
+        self.assertEqual(Task.objects.require('require_units', '/af/pootle/'), None)
+
+    def test_stale_running_task(self):
+        """tasks left running by a dead worker stop blocking pages"""
+        task = Task.objects.queue('require_units', '/af/pootle/')
+        Task.objects.filter(pk=task.pk).update(state=RUNNING, started=datetime.datetime.now())
+        self.assertEqual(Task.objects.require('require_units', '/af/pootle/').pk, task.pk)
+
+        started = datetime.datetime.now() - datetime.timedelta(seconds=TASK_TIMEOUT + 60)
+        Task.objects.filter(pk=task.pk).update(started=started)
+        # recently failed, left to the page
+        self.assertEqual(Task.objects.require('require_units', '/af/pootle/'), None)
+        self.assertEqual(Task.objects.get(pk=task.pk).state, FAILED)
+
+class LiveTranslationTests(PootleTestCase):
+    def test_translate_message(self):
+        """live translation follows units translated after the catalog
+        was compiled"""
+        translation_project = TranslationProject.objects.get(language__code='af', project__code='pootle')
+        self.assertEqual(translation_project.translate_message(u"no such message"), u"no such message")
+        self.assertEqual(translation_project.translate_message(u"no such message", u"no such messages", 2),
+                         u"no such messages")
+        unit = Store.objects.get(pootle_path="/af/pootle/pootle.po").units[0]
+        unit.target = u"live translation"
+        unit.markfuzzy(False)
+        unit.save()
+        # skip waiting for the next check
+        translation_project.non_db_state.catalog_checked = 0
+        self.assertEqual(translation_project.translate_message(unit.source.strings[0]), u"live translation")
+
+class PermissionTests(PootleTestCase):
+    def test_closest_permission_set(self):
+        """permissions come from the closest permission set, memoized
+        ones are dropped when permission sets change"""
+        directory = Directory.objects.get(pootle_path='/af/pootle/')
+        start_request_memo()
+        try:
+            self.assertTrue('view' in get_permissions_by_username('nobody', directory))
+            profile = PootleProfile.objects.get(user__username='nobody')
+            permission_set = PermissionSet(profile=profile, directory=directory)
+            permission_set.save()
+            self.assertEqual(get_permissions_by_username('nobody', directory), {})
+            self.assertTrue('view' in get_permissions_by_username('nobody', directory.parent))
+            permission_set.delete()
+            self.assertTrue('view' in get_permissions_by_username('nobody', directory))
+        finally:
+            end_request_memo()
+
+    def test_default_permissions_change(self):
+        """users falling back to default permissions see changes to
+        them"""
+        directory = Directory.objects.get(pootle_path='/af/pootle/')
+        profile = PootleProfile.objects.get(user__username='nonpriv')
+        permissions = get_matching_permissions(profile, directory)
+        self.assertTrue('view' in permissions)
+        self.assertTrue(get_matching_permissions(profile, directory) is permissions)
+        default = PootleProfile.objects.get(user__username='default')
+        PermissionSet(profile=default, directory=directory).save()
+        self.assertEqual(get_matching_permissions(profile, directory), {})
@@ -30,6 +30,7 @@ from pootle_app.models import Directory
 from pootle_statistics.models import Submission
 from pootle_language.models import Language
 from pootle_project.models import Project
+from pootle_store.models import quickstats_many
 from pootle_app.models.permissions import get_matching_permissions, check_permission
 from pootle_app.views import pagelayout
 from pootle_app.views.top_stats import gentopstats_root
@@ -39,14 +40,14 @@ from pootle_app.views.language.item_dict import add_percentages
 def limit(query):
     return query[:5]
 
-def get_items(request, model, get_last_action, name_func):
+def get_items(request, model, get_last_action, name_func, group_field):
 
     items = []
     if not check_permission('view', request):
         return items
 
-    for item in model.objects.iterator():
-        stats = item.getquickstats()
+    objects = list(model.objects.iterator())
+    for item, stats in zip(objects, quickstats_many(objects, group_field)):
         stats = add_percentages(stats)
 
         lastact = get_last_action(item)
@@ -74,7 +75,7 @@ def getlanguages(request):
         except Submission.DoesNotExist:
             return ''
 
-    return get_items(request, Language, get_last_action, tr_lang)
+    return get_items(request, Language, get_last_action, tr_lang, 'translation_project__language')
 
 def getprojects(request):
     def get_last_action(item):
@@ -83,7 +84,7 @@ def getprojects(request):
         except Submission.DoesNotExist:
             return ''
 
-    return get_items(request, Project, get_last_action, lambda name: name)
+    return get_items(request, Project, get_last_action, lambda name: name, 'translation_project__project')
 
 
 def view(request):
@@ -256,12 +256,14 @@ def stats_descriptions(quick_stats):
         'todo_tooltip': todo_tooltip,
     }
 
-def make_generic_item(request, path_obj, action, show_checks=False):
+def make_generic_item(request, path_obj, action, show_checks=False, quick_stats=None):
     """Template variables for each row in the table.
 
     make_directory_item() and make_store_item() will add onto these variables."""
     try:
-        quick_stats = add_percentages(path_obj.getquickstats())
+        if quick_stats is None:
+            quick_stats = path_obj.getquickstats()
+        quick_stats = add_percentages(quick_stats)
         info = {
             'href':    action,
             'data':    quick_stats,
@@ -283,10 +285,10 @@ def make_generic_item(request, path_obj, action, show_checks=False):
             }
     return info
 
-def make_directory_item(request, directory, links_required=None):
+def make_directory_item(request, directory, links_required=None, quick_stats=None):
     action = dispatch.show_directory(request, directory.pootle_path)
     show_checks = links_required == 'review'
-    item = make_generic_item(request, directory, action, show_checks)
+    item = make_generic_item(request, directory, action, show_checks, quick_stats)
     if links_required == 'translate':
         item['actions'] = directory_translate_links(request, directory)
     elif links_required == 'review':
@@ -298,10 +300,10 @@ def make_directory_item(request, directory, links_required=None):
             'isdir':  True })
     return item
 
-def make_store_item(request, store, links_required=None):
+def make_store_item(request, store, links_required=None, quick_stats=None):
     action = dispatch.translate(request, store.pootle_path)
     show_checks = links_required == 'review'
-    item = make_generic_item(request, store, action, show_checks)
+    item = make_generic_item(request, store, action, show_checks, quick_stats)
     if links_required == 'translate':
         item['actions'] = store_translate_links(request, store)
     elif links_required == 'review':
@@ -26,8 +26,7 @@ from pootle.i18n.gettext import tr_lang, language_dir
 from pootle_misc.util import getfromcache
 from pootle_misc.aggregate import max_column
 from pootle_misc.baseurl import l
-from pootle_store.util import statssum
-from pootle_store.models import Unit
+from pootle_store.models import Unit, store_stats_sum
 from pootle_app.lib.util import RelatedManager
 
 class Language(models.Model):
@@ -75,7 +74,7 @@ class Language(models.Model):
 
     @getfromcache
     def getquickstats(self):
-        return statssum(self.translationproject_set.iterator())
+        return store_stats_sum(translation_project__language=self)
 
     def get_absolute_url(self):
         return l(self.pootle_path)
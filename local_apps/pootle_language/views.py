@@ -29,6 +29,7 @@ from pootle_app.views.language.item_dict import nice_percentage, add_percentages
 from pootle_app.views import pagelayout
 from pootle_app.views.top_stats import gentopstats_language
 from pootle_language.models import Language
+from pootle_store.models import quickstats_many
 from pootle_statistics.models import Submission
 
 from pootle.i18n.gettext import tr_lang
@@ -46,10 +47,10 @@ def get_last_action(translation_project):
     except Submission.DoesNotExist:
         return ''
 
-def make_project_item(translation_project):
+def make_project_item(translation_project, projectstats):
     project = translation_project.project
     href = translation_project.pootle_path
-    projectstats = add_percentages(translation_project.getquickstats())
+    projectstats = add_percentages(projectstats)
     info = {
         'code': project.code,
         'href': href,
@@ -75,9 +76,10 @@ def language_index(request, language_code):
     if not check_permission("view", request):
         raise PermissionDenied
 
-    projects = language.translationproject_set.order_by('project__fullname')
+    projects = list(language.translationproject_set.order_by('project__fullname').select_related('project'))
     projectcount = len(projects)
-    items = (make_project_item(translate_project) for translate_project in projects.iterator())
+    items = (make_project_item(translate_project, stats)
+             for translate_project, stats in zip(projects, quickstats_many(projects, 'translation_project')))
 
     totals = language.getquickstats()
     average = nice_percentage(totals['translatedsourcewords'] * 100.0 / max(totals['totalsourcewords'], 1))
@@ -42,6 +42,18 @@ try:
         result = queryset.values(column).annotate(count=Count(column))
         return dict((item[column], item['count']) for item in result)
 
+    def group_by_sum(queryset, column, columns, count=False):
+        arg_dict = {}
+        if count:
+            arg_dict['count'] = Count('id')
+
+        for sum_col in columns:
+            arg_dict[sum_col] = Sum(sum_col)
+
+        # clear default ordering, it would end up in the GROUP BY clause
+        result = queryset.order_by().values(column).annotate(**arg_dict)
+        return dict((item.pop(column), item) for item in result)
+
     def group_by_sort(queryset, column, fields):
         return queryset.annotate(count=Count(column)).order_by('-count').values('count',*fields)
 
@@ -72,6 +84,16 @@ except ImportError:
             result[item] += 1
         return result
 
+    def group_by_sum(queryset, column, columns, count=False):
+        result = {}
+        for item in queryset.values(column, *columns).iterator():
+            totals = result.setdefault(item.pop(column), dict((sum_col, 0) for sum_col in columns))
+            for sum_col in columns:
+                totals[sum_col] += item[sum_col]
+            if count:
+                totals['count'] = totals.get('count', 0) + 1
+        return result
+
     def group_by_sort(queryset, column, fields):
         items = queryset.values('id', *fields).distinct()
         result = []
@@ -32,6 +32,7 @@ def pootle_context(request):
             'CAN_REGISTER': settings.CAN_REGISTER,
             'SCRIPT_NAME': settings.SCRIPT_NAME,
             'CACHE_TIMEOUT': settings.CACHE_MIDDLEWARE_SECONDS,
+            'OBJECT_CACHE_TIMEOUT': settings.OBJECT_CACHE_TIMEOUT,
         },
     }
     return context
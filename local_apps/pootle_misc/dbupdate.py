@@ -27,7 +27,7 @@ from pootle.i18n.gettext import ugettext as _
 from pootle.i18n.gettext import ungettext
 
 from pootle_app.models import Directory
-from pootle_store.models import Store
+from pootle_store.models import Store, PARSED
 from pootle_language.models import Language
 from pootle_project.models import Project
 from pootle_misc.dbinit import stats_start, stats_language, stats_project, stats_end
@@ -163,6 +163,34 @@ def parse_end():
     """ % _('Done importing units.')
     return text
 
+def search_index_start():
+    text = u"""
+    <p>%s</p>
+    <ul>
+    """ % _('Building search index, this will take a few minutes.')
+    return text
+
+def index_store(store):
+    try:
+        logging.info("Indexing units from %s", store.pootle_path)
+        store.update_search_terms()
+        text = u"""
+        <li>%s</li>
+        """ % _('Indexed %s', store.pootle_path)
+    except Exception:
+        logging.exception("Failed to index %s", store.pootle_path)
+        text = u"""
+        <li>%s</li>
+        """ % _('Failed to index %s', store.pootle_path)
+    return text
+
+def search_index_end():
+    text = u"""
+    </ul>
+    <p>%s</p>
+    """ % _('Done building search index.')
+    return text
+
 def footer():
     text = """
     <p>%(endmsg)s</p>
@@ -204,6 +232,13 @@ def staggered_update(db_buildversion):
             yield import_suggestions(store)
         yield parse_end()
 
+    if 21000 <= db_buildversion < 21002:
+        # stores parsed above are indexed as they are parsed
+        yield search_index_start()
+        for store in Store.objects.filter(state__gte=PARSED).iterator():
+            yield index_store(store)
+        yield search_index_end()
+
     # first time to visit the front page all stats for projects and
     # languages will be calculated which can take forever, since users
     # don't like webpages that take forever let's precalculate the
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2010 Zuza Software Foundation
+#
+# This file is part of Pootle.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from pootle_app.models.permissions import start_request_memo, end_request_memo
+
+class PermissionsMiddleware(object):
+    """
+    Keeps permissions looked up while handling a request in memory,
+    pages checking permissions of many directories fetch them from the
+    cache once.
+    """
+    def process_request(self, request):
+        start_request_memo()
+
+    def process_response(self, request, response):
+        end_request_memo()
+        return response
@@ -19,23 +19,215 @@
 # along with this program; if not, see <http://www.gnu.org/licenses/>.
 
 import logging
+import datetime
+import threading
+import time
 
+import django
 from django.core.cache import cache
 from django.conf import settings
 from django.core.paginator import Paginator
 from django.utils.encoding import iri_to_uri
+from django.db import connection, transaction
+from django.db.models import AutoField
+
+CACHE_PATCH_LIMIT = 100
+"""maximum number of logged changes applied to a cached result
+before it gets recalculated instead"""
+
+CACHE_LOCK_TIMEOUT = 300
+"""seconds after which a recalculation lock is considered abandoned"""
+
+CACHE_LOCK_WAIT = 10
+"""seconds to wait for another process recalculating a result when
+there is no stale copy to serve"""
+
+def _get_translation_project_path(pootle_path):
+    """path of the translation project containing pootle_path, None
+    if pootle_path is above translation project level"""
+    path_parts = pootle_path.split('/')
+    if len(path_parts) < 4 or path_parts[1] == 'projects' or not path_parts[2]:
+        return None
+    return '/%s/%s/' % (path_parts[1], path_parts[2])
+
+def _get_generation_path(pootle_path):
+    """path whose generation counter versions cached results for
+    pootle_path: the translation project containing it, or
+    pootle_path itself above translation project level"""
+    return _get_translation_project_path(pootle_path) or pootle_path
+
+def _log_patches(generation_path, changed_path, patches, timeout):
+    generation_key = generation_path + ":generation"
+    try:
+        generation = cache.incr(generation_key)
+    except ValueError:
+        cache.add(generation_key, 0, timeout)
+        generation = cache.incr(generation_key)
+    cache.set("%s:generation:%d" % (generation_path, generation), (changed_path, patches), timeout)
+
+def _apply_patch(result, patch):
+    if isinstance(patch, dict):
+        return dictsum(result, patch)
+    elif isinstance(patch, datetime.datetime):
+        return max(result, patch)
+    else:
+        return result + patch
+
+def _revalidate(entry, generation, path, function_name):
+    """bring a cached (generation, result) entry up to date by
+    applying logged changes, returns None if that is not possible"""
+    try:
+        cached_generation, result = entry
+    except (TypeError, ValueError):
+        return None
+    if cached_generation == generation:
+        return result
+    if cached_generation > generation or generation - cached_generation > CACHE_PATCH_LIMIT:
+        return None
+
+    generation_path = _get_generation_path(path)
+    log_keys = ["%s:generation:%d" % (generation_path, i) for i in xrange(cached_generation + 1, generation + 1)]
+    log = cache.get_many(log_keys)
+    for log_key in log_keys:
+        if log_key not in log:
+            return None
+        changed_path, patches = log[log_key]
+        if not changed_path.startswith(path) or function_name not in patches:
+            continue
+        if patches[function_name] is None:
+            return None
+        result = _apply_patch(result, patches[function_name])
+    return result
+
+def _recalculate(function, instance, args, kwargs, key, store_result):
+    try:
+        result = function(instance, *args, **kwargs)
+        store_result(result)
+        cache.set(key + ":stale", result, settings.OBJECT_CACHE_TIMEOUT * 2)
+        return result
+    finally:
+        cache.delete(key + ":lock")
+
+def _recalculate_in_background(*args):
+    def run():
+        try:
+            _recalculate(*args)
+        except Exception:
+            logging.exception("failed to recalculate %s in the background", args[4])
+        # this thread got its own database connection
+        connection.close()
+    thread = threading.Thread(target=run)
+    thread.setDaemon(True)
+    thread.start()
+
+def _serve_stale(function, instance, args, kwargs, key, store_result):
+    """handle a cache miss without making the request wait for the
+    recalculation: only one process recalculates the result while the
+    last known value is served to everyone"""
+    stale = cache.get(key + ":stale")
+    if cache.add(key + ":lock", True, CACHE_LOCK_TIMEOUT):
+        if stale is None:
+            return _recalculate(function, instance, args, kwargs, key, store_result)
+        _recalculate_in_background(function, instance, args, kwargs, key, store_result)
+    elif stale is None:
+        # someone else is busy with it, nothing to serve meanwhile
+        deadline = time.time() + CACHE_LOCK_WAIT
+        while time.time() < deadline and cache.get(key + ":lock"):
+            time.sleep(0.1)
+        stale = cache.get(key + ":stale")
+        if stale is None:
+            return function(instance, *args, **kwargs)
+    return stale
 
 def getfromcache(function, timeout=settings.OBJECT_CACHE_TIMEOUT):
     def _getfromcache(instance, *args, **kwargs):
-        key = iri_to_uri(instance.pootle_path + ":" + function.__name__)
-        result = cache.get(key)
-        if result is None:
-            logging.debug("cache miss for %s", key)
-            result = function(instance, *args, **kwargs)
-            cache.set(key, result, timeout)
+        path = iri_to_uri(instance.pootle_path)
+        key = path + ":" + function.__name__
+        generation_key = _get_generation_path(path) + ":generation"
+        cached = cache.get_many([key, generation_key])
+        generation = cached.get(generation_key, 0)
+        if key in cached:
+            result = _revalidate(cached[key], generation, path, function.__name__)
+            if result is not None:
+                if cached[key][0] != generation:
+                    cache.set(key, (generation, result), timeout)
+                return result
+
+        def store_result(result):
+            if cache.get(generation_key, 0) == generation:
+                # don't cache if something changed while we were busy
+                cache.set(key, (generation, result), timeout)
+
+        logging.debug("cache miss for %s", key)
+        if getattr(settings, 'OBJECT_CACHE_SERVE_STALE', False):
+            return _serve_stale(function, instance, args, kwargs, key, store_result)
+        result = function(instance, *args, **kwargs)
+        store_result(result)
         return result
     return _getfromcache
 
+def getmanyfromcache(instances, function_name, calculate_many, timeout=settings.OBJECT_CACHE_TIMEOUT):
+    """results of the getfromcache decorated method function_name for
+    several instances. cached results are fetched in a single round
+    trip, missing ones are calculated together by calculate_many
+    which gets a list of instances and returns a list of results"""
+    paths = [iri_to_uri(instance.pootle_path) for instance in instances]
+    keys = [path + ":" + function_name for path in paths]
+    generation_keys = [_get_generation_path(path) + ":generation" for path in paths]
+    cached = cache.get_many(keys + list(set(generation_keys)))
+
+    results = []
+    missing = []
+    for i, key in enumerate(keys):
+        if key in cached:
+            generation = cached.get(generation_keys[i], 0)
+            result = _revalidate(cached[key], generation, paths[i], function_name)
+            if result is not None and cached[key][0] != generation:
+                cache.set(key, (generation, result), timeout)
+        else:
+            result = None
+        if result is None:
+            missing.append(i)
+        results.append(result)
+
+    if missing:
+        logging.debug("cache miss for %d %s results", len(missing), function_name)
+        calculated = calculate_many([instances[i] for i in missing])
+        current = cache.get_many(list(set(generation_keys)))
+        for i, result in zip(missing, calculated):
+            results[i] = result
+            if current.get(generation_keys[i], 0) == cached.get(generation_keys[i], 0):
+                cache.set(keys[i], (cached.get(generation_keys[i], 0), result), timeout)
+            if getattr(settings, 'OBJECT_CACHE_SERVE_STALE', False):
+                cache.set(keys[i] + ":stale", result, settings.OBJECT_CACHE_TIMEOUT * 2)
+    return results
+
+def patchcache(sender, patches, timeout=settings.OBJECT_CACHE_TIMEOUT, **kwargs):
+    """record a change affecting cached results of sender and its
+    ancestors.
+
+    patches maps function names to the change in their result:
+    dictionaries are added to cached dictionaries, datetimes replace
+    older cached datetimes and numbers are added. None means cached
+    results need to be recalculated.
+
+    instead of deleting cached results the translation project's
+    generation counter is bumped, readers apply the logged change to
+    their cached result next time they are accessed. project,
+    language and root results are sums over their translation
+    projects and get patched the same way under their own generation
+    counters."""
+    path = iri_to_uri(sender.pootle_path)
+    translation_project_path = _get_translation_project_path(path)
+    if translation_project_path is None:
+        deletefromcache(sender, patches.keys())
+        return
+
+    _log_patches(translation_project_path, path, patches, timeout)
+    path_parts = translation_project_path.split("/")
+    for aggregate_path in ("/projects/%s/" % path_parts[2], "/%s/" % path_parts[1], "/"):
+        _log_patches(aggregate_path, aggregate_path, patches, timeout)
+
 def deletefromcache(sender, functions, **kwargs):
     path = iri_to_uri(sender.pootle_path)
     path_parts = path.split("/")
@@ -57,8 +249,53 @@ def dictsum(x, y):
     return dict( (n, x.get(n, 0)+y.get(n, 0)) for n in set(x)|set(y) )
 
 
-def paginate(request, queryset, items=30, page=None):
+def _get_db_prep_save(field, value):
+    if django.VERSION >= (1, 2):
+        return field.get_db_prep_save(value, connection=connection)
+    return field.get_db_prep_save(value)
+
+def insert_many(model, instances, chunk_size=500):
+    """insert model instances using multi-row INSERT statements.
+
+    much faster than calling save() on each instance, but no signals
+    are sent, custom save() methods are bypassed and primary keys are
+    not set on the inserted instances."""
+    if not instances:
+        return 0
+    fields = [field for field in model._meta.local_fields if not isinstance(field, AutoField)]
+    if 'sqlite' in connection.__class__.__module__:
+        # SQLite refuses statements with more than 999 parameters
+        chunk_size = max(1, min(chunk_size, 999 / len(fields)))
+
+    qn = connection.ops.quote_name
+    row_sql = "(%s)" % ", ".join(["%s"] * len(fields))
+    insert_sql = "INSERT INTO %s (%s) VALUES " % (qn(model._meta.db_table),
+                                                   ", ".join(qn(field.column) for field in fields))
+    cursor = connection.cursor()
+    count = 0
+    for i in xrange(0, len(instances), chunk_size):
+        chunk = instances[i:i+chunk_size]
+        params = []
+        for instance in chunk:
+            for field in fields:
+                params.append(_get_db_prep_save(field, field.pre_save(instance, True)))
+        cursor.execute(insert_sql + ", ".join([row_sql] * len(chunk)), params)
+        count += len(chunk)
+    if transaction.is_managed():
+        transaction.set_dirty()
+    else:
+        # outside of requests (management commands, threads) nobody
+        # else will commit the raw writes
+        transaction.commit_unless_managed()
+    return count
+
+
+def paginate(request, queryset, items=30, page=None, count=None):
+    """page of queryset, count saves a COUNT query when the number of
+    items is already known"""
     paginator = Paginator(queryset, items, orphans=items/2)
+    if count is not None:
+        paginator._count = count
 
     if not page:
         try:
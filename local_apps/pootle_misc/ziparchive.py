@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2010 Zuza Software Foundation
+#
+# This file is part of Pootle.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+"""ZIP archives generated piece by piece while they are sent to the
+client, with compressed files cached between downloads"""
+
+import os
+import time
+import zlib
+import struct
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import add_never_cache_headers
+
+from translate.misc.hash import md5_f
+
+CACHE_MAX_ENTRY_SIZE = 1000000
+"""compressed files bigger than this are not cached (memcached
+refuses items over 1MB)"""
+
+MEMORY_BUDGET = 16 * 1024 * 1024
+"""compressed bytes kept in memory between measuring the archive and
+sending it, files past this are compressed a second time"""
+
+_LOCAL_HEADER = "<IHHHHHIIIHH"
+_CENTRAL_HEADER = "<IHHHHHHIIIHHHHHII"
+_END_RECORD = "<IHHHHIIH"
+
+_UTF8_FLAG = 0x800
+_DEFLATED = 8
+_VERSION = 20
+_MADE_BY_UNIX = 3 << 8
+
+def _dos_datetime(mtime):
+    t = time.localtime(mtime)
+    dostime = t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2
+    dosdate = max(t.tm_year - 1980, 0) << 9 | t.tm_mon << 5 | t.tm_mday
+    return dostime, dosdate
+
+def _compress(path):
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+    crc = 0
+    size = 0
+    chunks = []
+    f = open(path, 'rb')
+    try:
+        while True:
+            data = f.read(65536)
+            if not data:
+                break
+            crc = zlib.crc32(data, crc)
+            size += len(data)
+            chunks.append(compressor.compress(data))
+    finally:
+        f.close()
+    chunks.append(compressor.flush())
+    return crc & 0xffffffff, size, ''.join(chunks)
+
+def get_compressed(path, mod_info):
+    """(crc, uncompressed size, deflated data) of file at path, reused
+    from the cache while the file's (mtime, size) equals mod_info"""
+    key = "%s:%r:%d" % (path, mod_info[0], mod_info[1])
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    key = "zipentry:" + md5_f(key).hexdigest()
+    result = cache.get(key)
+    if result is None:
+        result = _compress(path)
+        if len(result[2]) <= CACHE_MAX_ENTRY_SIZE:
+            cache.set(key, result, settings.OBJECT_CACHE_TIMEOUT)
+    return result
+
+
+class ZipStream(object):
+    """iterable producing a ZIP archive of files, given as (name in
+    archive, path) pairs. the archive's total size is known before
+    any of it is produced."""
+
+    def __init__(self, files):
+        self.entries = []
+        self.size = 0
+        kept = 0
+        for name, path in files:
+            if isinstance(name, unicode):
+                name = name.encode('utf-8')
+            file_stat = os.stat(path)
+            mod_info = (file_stat.st_mtime, file_stat.st_size)
+            crc, size, data = get_compressed(path, mod_info)
+            compressed_size = len(data)
+            if kept + compressed_size <= MEMORY_BUDGET:
+                kept += compressed_size
+            else:
+                data = None
+            entry = {'name': name, 'path': path, 'mod_info': mod_info,
+                     'crc': crc, 'size': size, 'data': data,
+                     'compressed_size': compressed_size}
+            self.entries.append(entry)
+            self.size += struct.calcsize(_LOCAL_HEADER) + len(name) + entry['compressed_size']
+            self.size += struct.calcsize(_CENTRAL_HEADER) + len(name)
+        self.size += struct.calcsize(_END_RECORD)
+
+    def __len__(self):
+        return self.size
+
+    def _flags(self, name):
+        try:
+            name.decode('ascii')
+            return 0
+        except UnicodeDecodeError:
+            return _UTF8_FLAG
+
+    def __iter__(self):
+        offset = 0
+        central_directory = []
+        for entry in self.entries:
+            data = entry['data']
+            if data is None:
+                crc, size, data = get_compressed(entry['path'], entry['mod_info'])
+                if crc != entry['crc'] or len(data) != entry['compressed_size']:
+                    raise IOError("%s changed while being archived" % entry['path'])
+            # release memory as we go
+            entry['data'] = None
+
+            name = entry['name']
+            dostime, dosdate = _dos_datetime(entry['mod_info'][0])
+            header = struct.pack(_LOCAL_HEADER, 0x04034b50, _VERSION, self._flags(name), _DEFLATED,
+                                 dostime, dosdate, entry['crc'], len(data), entry['size'],
+                                 len(name), 0)
+            central_directory.append(struct.pack(_CENTRAL_HEADER, 0x02014b50, _MADE_BY_UNIX | _VERSION, _VERSION,
+                                                 self._flags(name), _DEFLATED, dostime, dosdate,
+                                                 entry['crc'], len(data), entry['size'],
+                                                 len(name), 0, 0, 0, 0, 0644 << 16, offset) + name)
+            yield header + name
+            yield data
+            offset += len(header) + len(name) + len(data)
+
+        central_directory = ''.join(central_directory)
+        yield central_directory
+        yield struct.pack(_END_RECORD, 0x06054b50, 0, 0, len(self.entries), len(self.entries),
+                          len(central_directory), offset, 0)
+
+
+class ZipResponse(HttpResponse):
+    """response sending a ZipStream without ever holding the whole
+    archive in memory"""
+
+    def __init__(self, stream, filename):
+        super(ZipResponse, self).__init__(stream, content_type="application/zip")
+        self['Content-Length'] = str(len(stream))
+        self['Content-Disposition'] = 'attachment; filename=%s' % filename
+        # keep the page cache from trying to store the archive
+        add_never_cache_headers(self)
+
+    def _get_content(self):
+        # middleware looking at the content (gzip) must not buffer the
+        # whole archive, they see an empty response instead
+        return ''
+
+    content = property(_get_content, HttpResponse._set_content)
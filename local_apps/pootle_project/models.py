@@ -27,9 +27,9 @@ from django.db                import models
 from translate.filters import checks
 from translate.lang.data import langcode_re
 
-from pootle_store.util import absolute_real_path, statssum
+from pootle_store.util import absolute_real_path
 from pootle_misc.aggregate import max_column
-from pootle_store.models import Unit
+from pootle_store.models import Unit, store_stats_sum
 from pootle_store.filetypes import filetype_choices, factory_classes, is_monolingual
 from pootle_misc.util import getfromcache
 from pootle_misc.baseurl import l
@@ -87,7 +87,7 @@ class Project(models.Model):
 
     @getfromcache
     def getquickstats(self):
-        return statssum(self.translationproject_set.iterator())
+        return store_stats_sum(translation_project__project=self)
 
     def translated_percentage(self):
         return int(100.0 * self.getquickstats()['translatedsourcewords'] / max(self.getquickstats()['totalsourcewords'], 1))
@@ -38,6 +38,7 @@ from pootle.i18n.gettext import tr_lang
 from pootle_app.views.top_stats import gentopstats_project, gentopstats_root
 from pootle_app.views import pagelayout
 from pootle_translationproject.models import TranslationProject
+from pootle_store.models import quickstats_many
 from pootle_app import project_tree
 from pootle_app.views.admin import util
 from pootle_profile.models import get_profile
@@ -45,6 +46,7 @@ from pootle_app.views.index.index import getprojects
 from pootle_app.models.permissions import get_matching_permissions, check_permission
 from pootle_app.views.admin.permissions import admin_permissions
 from pootle_app.models import Directory
+from pootle_app.models.task import Task, use_task_queue
 
 
 def limit(query):
@@ -56,9 +58,9 @@ def get_last_action(translation_project):
     except Submission.DoesNotExist:
         return ''
 
-def make_language_item(request, translation_project):
+def make_language_item(request, translation_project, projectstats):
     href = '/%s/%s/' % (translation_project.language.code, translation_project.project.code)
-    projectstats = add_percentages(translation_project.getquickstats())
+    projectstats = add_percentages(projectstats)
     info = {
         'code': translation_project.language.code,
         'href': href,
@@ -82,8 +84,9 @@ def project_language_index(request, project_code):
     if not check_permission('view', request):
         raise PermissionDenied
 
-    translation_projects = project.translationproject_set.all()
-    items = [make_language_item(request, translation_project) for translation_project in translation_projects.iterator()]
+    translation_projects = list(project.translationproject_set.select_related('language', 'project'))
+    items = [make_language_item(request, translation_project, stats)
+             for translation_project, stats in zip(translation_projects, quickstats_many(translation_projects, 'translation_project'))]
     items.sort(lambda x, y: locale.strcoll(x['title'], y['title']))
     languagecount = len(translation_projects)
     totals = add_percentages(project.getquickstats())
@@ -152,7 +155,10 @@ def project_admin(request, project_code):
                     self.instance.initialize()
 
                 if self.cleaned_data.get('update', None):
-                    project_tree.convert_templates(template_translation_project, self.instance)
+                    if use_task_queue():
+                        Task.objects.queue('convert_templates', self.instance.pootle_path, request.user)
+                    else:
+                        project_tree.convert_templates(template_translation_project, self.instance)
 
     queryset = TranslationProject.objects.filter(project=current_project).order_by('pootle_path')
     model_args = {}
@@ -24,17 +24,19 @@ import logging
 import shutil
 import tempfile
 import os
+import heapq
+import threading
 
 from django.conf import settings
 from django.db import models
 from django.db.models.fields.files import FieldFile, FileField
 
 from translate.storage import factory
-from translate.misc.lru import LRUCachingDict
 from translate.misc.multistring import multistring
 
 from pootle_store.signals import translation_file_updated
 from pootle_store.filetypes import factory_classes
+from pootle_store import parsecache
 
 ################# String #############################
 
@@ -50,27 +52,65 @@ def list_empty(strings):
             return False
     return True
 
+def to_multistring(value):
+    """multistring from a value read from the database or assigned to
+    a MultiStringField"""
+    if not value:
+        return multistring("", encoding="UTF-8")
+    elif isinstance(value, multistring):
+        return value
+    elif isinstance(value, basestring):
+        if SEPERATOR not in value:
+            # most units have no plurals, skip splitting
+            return multistring(value, encoding="UTF-8")
+        return multistring(value.split(SEPERATOR), encoding="UTF-8")
+    elif isinstance(value, dict):
+        return multistring([val for key, val in sorted(value.items())], encoding="UTF-8")
+    else:
+        return multistring(value, encoding="UTF-8")
+
+class LazyMultiString(object):
+    """descriptor keeping values of a MultiStringField as they come
+    from the database until they are first read, units loaded for bulk
+    work that never touch a field don't pay for building multistrings"""
+
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            raise AttributeError("Can only be accessed via an instance.")
+        value = instance.__dict__[self.field.name]
+        if not isinstance(value, multistring):
+            value = to_multistring(value)
+            instance.__dict__[self.field.name] = value
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.name] = value
+
 class MultiStringField(models.Field):
     description = "a field imitating translate.misc.multistring used for plurals"
-    __metaclass__ = models.SubfieldBase
 
     def __init__(self, *args, **kwargs):
         super(MultiStringField, self).__init__(*args, **kwargs)
 
+    def contribute_to_class(self, cls, name):
+        super(MultiStringField, self).contribute_to_class(cls, name)
+        setattr(cls, self.name, LazyMultiString(self))
+
     def get_internal_type(self):
         return "TextField"
 
     def to_python(self, value):
-        if not value:
-            return multistring("", encoding="UTF-8")
-        elif isinstance(value, multistring):
+        return to_multistring(value)
+
+    def pre_save(self, model_instance, add):
+        value = model_instance.__dict__[self.attname]
+        if isinstance(value, basestring):
+            # values never read are saved as they were loaded
             return value
-        elif isinstance(value, basestring):
-            return multistring(value.split(SEPERATOR), encoding="UTF-8")
-        elif isinstance(value, dict):
-            return multistring([val for key, val in sorted(value.items())], encoding="UTF-8")
-        else:
-            return multistring(value, encoding="UTF-8")
+        return getattr(model_instance, self.attname)
 
     def get_db_prep_value(self, value):
         #FIXME: maybe we need to override get_db_prep_save instead?
@@ -97,20 +137,107 @@ class MultiStringField(models.Field):
 ################# File ###############################
 
 
+PARSED_SIZE_FACTOR = 10
+"""rough ratio between memory used by a parsed store and the size of
+its file"""
+
 class StoreTuple(object):
-    """Encapsulates toolkit stores in the in memory cache, needed
-    since LRUCachingDict is based on a weakref.WeakValueDictionary
-    which cannot reference normal tuples"""
+    """Encapsulates toolkit stores in the in memory cache"""
     def __init__(self, store, mod_info, realpath):
         self.store = store
         self.mod_info = mod_info
         self.realpath = realpath
 
+    def _get_memory(self):
+        return self.mod_info[1] * PARSED_SIZE_FACTOR
+    memory = property(_get_memory)
+
+class ParsePool(object):
+    """least recently used cache of StoreTuples limited by the
+    approximate amount of memory they use rather than their number"""
+
+    def __init__(self, max_memory):
+        self.max_memory = max_memory
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = {}
+        self._sizes = {}
+        self._last_used = {}
+        # (time of use, key) pairs, may contain outdated uses
+        self._heap = []
+        self._clock = 0
+        self._lock = threading.Lock()
+
+    def _use(self, key):
+        self._clock += 1
+        self._last_used[key] = self._clock
+        heapq.heappush(self._heap, (self._clock, key))
+        if len(self._heap) > 4 * len(self._entries) + 16:
+            self._heap = [(used, key) for key, used in self._last_used.iteritems()]
+            heapq.heapify(self._heap)
+
+    def _remove(self, key):
+        del self._entries[key]
+        del self._last_used[key]
+        self.memory -= self._sizes.pop(key)
+
+    def __getitem__(self, key):
+        self._lock.acquire()
+        try:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                raise
+            self.hits += 1
+            self._use(key)
+            return value
+        finally:
+            self._lock.release()
+
+    def __setitem__(self, key, value):
+        self._lock.acquire()
+        try:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = value
+            self._sizes[key] = value.memory
+            self.memory += value.memory
+            self._use(key)
+            while self.memory > self.max_memory and len(self._entries) > 1:
+                used, oldest = heapq.heappop(self._heap)
+                if self._last_used.get(oldest) != used:
+                    # outdated use
+                    continue
+                self._remove(oldest)
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def __delitem__(self, key):
+        self._lock.acquire()
+        try:
+            self._remove(key)
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_stats(self):
+        return {'entries': len(self._entries),
+                'memory': self.memory,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
 class TranslationStoreFieldFile(FieldFile):
     """FieldFile is the File-like object of a FileField, that is found in a
     TranslationStoreField."""
 
-    _store_cache = LRUCachingDict(settings.PARSE_POOL_SIZE, settings.PARSE_POOL_CULL_FREQUENCY)
+    _store_cache = ParsePool(getattr(settings, 'PARSE_POOL_MEMORY', 100 * 1024 * 1024))
 
     def getpomtime(self):
         file_stat = os.stat(self.realpath)
@@ -153,8 +280,11 @@ class TranslationStoreFieldFile(FieldFile):
                     raise KeyError
             except KeyError:
                 logging.debug("cache miss for %s", self.path)
-                self._store_tuple = StoreTuple(factory.getobject(self.path, ignore=self.field.ignore, classes=factory_classes),
-                                               mod_info, self.realpath)
+                store = parsecache.get_store(self.realpath, mod_info)
+                if store is None:
+                    store = factory.getobject(self.path, ignore=self.field.ignore, classes=factory_classes)
+                    parsecache.set_store(self.realpath, mod_info, store)
+                self._store_tuple = StoreTuple(store, mod_info, self.realpath)
                 self._store_cache[self.path] = self._store_tuple
                 translation_file_updated.send(sender=self, path=self.path)
 
@@ -187,14 +317,28 @@ class TranslationStoreFieldFile(FieldFile):
 
     store = property(_get_store)
 
-    def savestore(self):
+    def savestore(self, cache=True):
         """Saves to temporary file then moves over original file. This
-        way we avoid the need for locking."""
+        way we avoid the need for locking.
+
+        with cache set the saved store replaces the file's entry in the
+        parse cache, otherwise the entry is just removed. saves of a
+        single unit (AUTOSYNC) shouldn't pickle the whole store."""
+        old_mod_info = self.getpomtime()
         tmpfile, tmpfilename = tempfile.mkstemp(suffix=self.filename)
         #FIXME: what if the file was modified before we save
         self.store.savefile(tmpfilename)
         shutil.move(tmpfilename, self.realpath)
         self._touch_store_cache()
+        # savefile pointed the store at the temporary file, unpickled
+        # copies would try to open it
+        self._store_tuple.store.filename = self.realpath
+        # cached copies are looked up by mtime and size, the old one
+        # is of no use anymore
+        parsecache.delete_store(self.realpath, old_mod_info)
+        if cache:
+            # spare other processes from parsing the file we just wrote
+            parsecache.set_store(self.realpath, self._store_tuple.mod_info, self._store_tuple.store)
 
     def save(self, name, content, save=True):
         #FIXME: implement save to tmp file then move instead of directly saving
@@ -22,10 +22,15 @@ import os
 import logging
 import re
 import time
+import bisect
+from array import array
 
-from django.db import models, IntegrityError
+from django.db import models, IntegrityError, transaction
+from django.db.models import F
 from django.conf import settings
+from django.core.cache import cache
 from django.utils.translation import ugettext_lazy as _
+from django.utils.encoding import force_unicode
 from django.core.files.storage import FileSystemStorage
 from django.core.exceptions import ObjectDoesNotExist
 from django.db.transaction import commit_on_success
@@ -36,14 +41,17 @@ from translate.misc.hash import md5_f
 from pootle.__version__ import sver as pootle_version
 
 from pootle_app.lib.util import RelatedManager
-from pootle_misc.util import getfromcache, deletefromcache
-from pootle_misc.aggregate import group_by_count, max_column
+from pootle_misc.util import getfromcache, getmanyfromcache, deletefromcache, patchcache, insert_many, dictsum
+from pootle_misc.aggregate import group_by_count, group_by_sum, max_column, sum_column
 from pootle_misc.baseurl import l
 
-from pootle_store.fields  import TranslationStoreField, MultiStringField
+from pootle_store.fields  import TranslationStoreField, MultiStringField, to_multistring
 from pootle_store.util import calculate_stats, empty_quickstats
+from pootle_store.util import stats_fields, unit_stats, stats_delta
 from pootle_store.util import OBSOLETE, UNTRANSLATED, FUZZY, TRANSLATED
+from pootle_store.util import TERM_MAX_LENGTH, search_fields, search_columns, search_terms
 from pootle_store.filetypes import factory_classes, is_monolingual
+from pootle_store.qualitychecks import QualityCheckRunner
 
 # Store States
 LOCKED = -1
@@ -107,6 +115,11 @@ def fix_monolingual(oldunit, newunit, monolingual=None):
         newunit.target = newunit.source
         newunit.source = oldunit.source
 
+def get_unit_version_key(unit_id):
+    """cache key of a value changing whenever unit is saved, used to
+    version rendered fragments of the unit"""
+    return "unit_version:%d" % unit_id
+
 def count_words(strings):
     wordcount = 0
     for string in strings:
@@ -153,8 +166,40 @@ class Unit(models.Model, base.TranslationUnit):
         self._rich_target = None
         self._target_updated = False
         self._encoding = 'UTF-8'
-
-    def save(self, *args, **kwargs):
+        self._notes = self._get_notes()
+        if self.id is None:
+            self._stats = {}
+        else:
+            self._stats = self._get_unit_stats()
+
+    def _get_notes(self):
+        return (self.developer_comment, self.translator_comment, self.locations)
+
+    def _get_unit_stats(self):
+        return unit_stats(self.state, self.source_wordcount, self.target_wordcount)
+
+    def _update_store_stats(self, newstats):
+        """apply change in this unit's contribution to materialized
+        store stats, returns the change"""
+        delta = stats_delta(self._stats, newstats)
+        if delta and self.store.state != LOCKED:
+            # added in the database so concurrent saves don't
+            # overwrite each other. stores being updated from their
+            # file are recalculated once when done.
+            StoreStats.objects.filter(store=self.store_id).update(
+                **dict((key, F(key) + value) for key, value in delta.items()))
+        self._stats = newstats
+        return delta
+
+    def _patch_suggestion_count(self, delta):
+        # prefetched suggestions are out of date
+        self.__dict__.pop('_suggestions', None)
+        if self.store.state >= PARSED and not self.isobsolete():
+            patchcache(self.store, {'has_suggestions': delta})
+
+    def _update_derived_fields(self):
+        """recalculate hashes, wordcounts and lengths after source or
+        target was modified"""
         if self._source_updated:
             # update source related fields
             self.source_hash = md5_f(self.source_f.encode("utf-8")).hexdigest()
@@ -171,28 +216,58 @@ class Unit(models.Model, base.TranslationUnit):
             elif self.state > FUZZY:
                 self.state = UNTRANSLATED
 
+    def save(self, *args, **kwargs):
+        self._update_derived_fields()
+
         super(Unit, self).save(*args, **kwargs)
+        # rendered copies of the unit are out of date, even if saved
+        # within the same second as the last change
+        cache.set(get_unit_version_key(self.id), time.time(), settings.OBJECT_CACHE_TIMEOUT)
+        delta = self._update_store_stats(self._get_unit_stats())
+        if 'total' in delta:
+            # made obsolete or resurrected, positions changed
+            invalidate_unit_ordinals(self.store.translation_project_id)
+        notes = self._get_notes()
+        if self._source_updated or self._target_updated or notes != self._notes:
+            self.update_search_terms()
+            self._notes = notes
 
         if settings.AUTOSYNC and self.store.file and self.store.state >= PARSED:
             #FIXME: last translator information is lost
             self.sync(self.getorig())
-            self.store.file.savestore()
+            self.store.file.savestore(cache=False)
 
+        checks_updated = False
         if self.store.state >= CHECKED and (self._source_updated or self._target_updated):
             #FIXME: are we sure only source and target affect quality checks?
             self.update_qualitychecks()
+            checks_updated = True
 
         # done processing source/target update remove flag
         self._source_updated = False
         self._target_updated = False
 
         if self.store.state >= PARSED:
-            # updated caches
+            # update cached results with what changed instead of
+            # flushing them
             store = self.store
-            #translation_project = store.translation_project
-            #translation_project.update_index(translation_project.indexer, store, self.id)
-            deletefromcache(store,
-                            ["getquickstats", "getcompletestats", "get_mtime", "has_suggestions"])
+            # search index catches up in the background
+            store.translation_project.queue_index_update(self)
+            patches = {'get_mtime': self.mtime}
+            if delta:
+                if store.pootle_path.startswith('/templates/'):
+                    # template stats are not aggregated above store level
+                    patches['getquickstats'] = None
+                else:
+                    patches['getquickstats'] = delta
+            if checks_updated:
+                patches['getcompletestats'] = None
+            patchcache(store, patches)
+
+    def delete(self, *args, **kwargs):
+        super(Unit, self).delete(*args, **kwargs)
+        self._update_store_stats({})
+        invalidate_unit_ordinals(self.store.translation_project_id)
 
     def _get_source(self):
         return self.source_f
@@ -215,24 +290,7 @@ class Unit(models.Model, base.TranslationUnit):
     def convert(self, unitclass):
         """convert to a unit of type unitclass retaining as much
         information from the database as the target format can support"""
-        newunit = unitclass(self.source)
-        newunit.target = self.target
-        newunit.markfuzzy(self.isfuzzy())
-        locations = self.getlocations()
-        if locations:
-            newunit.addlocations(locations)
-        notes = self.getnotes(origin="developer")
-        if notes:
-            newunit.addnote(notes, origin="developer")
-        notes = self.getnotes(origin="translator")
-        if notes:
-            newunit.addnote(notes, origin="translator")
-        newunit.setid(self.getid())
-        newunit.setcontext(self.getcontext())
-        if hasattr(newunit, "addalttrans"):
-            for suggestion in self.get_suggestions().iterator():
-                newunit.addalttrans(suggestion.target, origin=unicode(suggestion.user))
-        return newunit
+        return convert_unit(self, unitclass)
 
     def get_unit_class(self):
         try:
@@ -331,8 +389,18 @@ class Unit(models.Model, base.TranslationUnit):
                 changed = True
         return changed
 
+    def update_search_terms(self):
+        """replace this unit's entries in the search index, part of
+        the transaction saving the unit"""
+        SearchTerm.objects.filter(unit=self).delete()
+        values = dict((column, getattr(self, column)) for column in search_columns)
+        for column in ('source_f', 'target_f'):
+            values[column] = u"\n".join(values[column].strings)
+        insert_many(SearchTerm, get_search_terms(self.id, values))
+
     def update_qualitychecks(self, created=False):
         """run quality checks and store result in database"""
+        self.__dict__.pop('_qualitychecks', None)
         if not created:
             self.qualitycheck_set.all().delete()
         if not self.target:
@@ -473,7 +541,21 @@ class Unit(models.Model, base.TranslationUnit):
 
 ##################### Suggestions #################################
     def get_suggestions(self):
-        return self.suggestion_set.select_related('user').all()
+        return self.suggestion_set.select_related('user__user').all()
+
+    def get_suggestion_list(self):
+        """list of suggestions, loaded by prefetch_units if it was
+        called for this unit"""
+        if not hasattr(self, '_suggestions'):
+            self._suggestions = list(self.get_suggestions())
+        return self._suggestions
+
+    def get_qualitycheck_list(self):
+        """list of failing quality checks, loaded by prefetch_units
+        if it was called for this unit"""
+        if not hasattr(self, '_qualitychecks'):
+            self._qualitychecks = list(self.qualitycheck_set.all())
+        return self._qualitychecks
 
     def add_suggestion(self, translation, user=None, touch=True):
         if translation == self.target:
@@ -488,6 +570,7 @@ class Unit(models.Model, base.TranslationUnit):
         except:
             # probably duplicate suggestion
             return None
+        self._patch_suggestion_count(1)
         return suggestion
 
     def accept_suggestion(self, suggid):
@@ -499,11 +582,12 @@ class Unit(models.Model, base.TranslationUnit):
         self.target = suggestion.target
         self.save()
         suggestion.delete()
+        self._patch_suggestion_count(-1)
         if settings.AUTOSYNC and self.file:
             #FIXME: update alttrans
             self.sync(self.getorig())
             self.store.updateheader(suggestion.user)
-            self.file.savestore()
+            self.file.savestore(cache=False)
         return True
 
     def reject_suggestion(self, suggid):
@@ -512,6 +596,7 @@ class Unit(models.Model, base.TranslationUnit):
         except Suggestion.DoesNotExist:
             return False
         suggestion.delete()
+        self._patch_suggestion_count(-1)
         return True
 
     def get_terminology(self):
@@ -523,6 +608,138 @@ class Unit(models.Model, base.TranslationUnit):
             result = []
         return result
 
+def convert_unit(unit, unitclass):
+    """convert unit, a Unit or UnitRow, to a unit of type unitclass"""
+    newunit = unitclass(unit.source)
+    newunit.target = unit.target
+    newunit.markfuzzy(unit.isfuzzy())
+    locations = unit.getlocations()
+    if locations:
+        newunit.addlocations(locations)
+    notes = unit.getnotes(origin="developer")
+    if notes:
+        newunit.addnote(notes, origin="developer")
+    notes = unit.getnotes(origin="translator")
+    if notes:
+        newunit.addnote(notes, origin="translator")
+    newunit.setid(unit.getid())
+    newunit.setcontext(unit.getcontext())
+    if hasattr(newunit, "addalttrans"):
+        for suggestion in unit.get_suggestions():
+            newunit.addalttrans(suggestion.target, origin=unicode(suggestion.user))
+    return newunit
+
+UNIT_ROW_FIELDS = ('id', 'index', 'unitid', 'source_f', 'target_f', 'developer_comment',
+                   'translator_comment', 'locations', 'context', 'state')
+
+class UnitRow(object):
+    """lightweight unit made from a row of Unit columns, implementing
+    the parts of the translation unit API needed to export, index or
+    extract terms from units without the cost of model instances,
+    changes are never saved back to the database"""
+    __slots__ = UNIT_ROW_FIELDS + ('suggestions',)
+
+    def __init__(self, row, suggestions=()):
+        (self.id, self.index, self.unitid, self.source_f, self.target_f, self.developer_comment,
+         self.translator_comment, self.locations, self.context, self.state) = row
+        self.suggestions = suggestions
+
+    def __unicode__(self):
+        return unicode(self.source)
+
+    def _get_source(self):
+        self.source_f = to_multistring(self.source_f)
+        return self.source_f
+
+    def _set_source(self, value):
+        self.source_f = value
+    source = property(_get_source, _set_source)
+
+    def _get_target(self):
+        self.target_f = to_multistring(self.target_f)
+        return self.target_f
+
+    def _set_target(self, value):
+        self.target_f = value
+    target = property(_get_target, _set_target)
+
+    def getnotes(self, origin=None):
+        if origin == None:
+            return (self.translator_comment or '') + (self.developer_comment or '')
+        elif origin == "translator":
+            return self.translator_comment
+        elif origin in ["programmer", "developer", "source code"]:
+            return self.developer_comment
+        else:
+            raise ValueError("Comment type not valid")
+
+    def getid(self):
+        return self.unitid
+
+    def getlocations(self):
+        if self.locations is None:
+            return []
+        return filter(None, self.locations.split('\n'))
+
+    def getcontext(self):
+        return self.context
+
+    def isheader(self):
+        return False
+
+    def istranslatable(self):
+        return True
+
+    def isfuzzy(self):
+        return self.state == FUZZY
+
+    def isobsolete(self):
+        return self.state == OBSOLETE
+
+    def istranslated(self):
+        return self.state >= TRANSLATED
+
+    def hasplural(self):
+        return self.source is not None and len(self.source.strings) > 1
+
+    def get_suggestions(self):
+        return self.suggestions
+    getalttrans = get_suggestions
+
+    def convert(self, unitclass):
+        return convert_unit(self, unitclass)
+
+def iter_unit_rows(units_queryset, suggestions=False):
+    """UnitRows of units_queryset streamed from the database, with the
+    suggestions of all units loaded in one query if suggestions is set"""
+    suggestion_lists = {}
+    if suggestions:
+        suggestion_set = Suggestion.objects.filter(unit__in=units_queryset.order_by().values('id'))
+        for suggestion in suggestion_set.select_related('user__user').order_by('id').iterator():
+            suggestion_lists.setdefault(suggestion.unit_id, []).append(suggestion)
+    for row in units_queryset.values_list(*UNIT_ROW_FIELDS).iterator():
+        yield UnitRow(row, suggestion_lists.get(row[0], ()))
+
+def prefetch_units(units):
+    """load suggestions, with their authors, and quality checks of
+    all units with two queries, for get_suggestion_list and
+    get_qualitycheck_list"""
+    by_id = {}
+    for unit in units:
+        unit._suggestions = []
+        unit._qualitychecks = []
+        by_id[unit.id] = unit
+    if not by_id:
+        return
+    suggestions = Suggestion.objects.filter(unit__in=by_id.keys()).select_related('user__user')
+    for suggestion in suggestions.order_by('id').iterator():
+        unit = by_id[suggestion.unit_id]
+        # saves loading the unit again for suggestion diffs
+        suggestion.unit = unit
+        unit._suggestions.append(suggestion)
+    for check in QualityCheck.objects.filter(unit__in=by_id.keys()).order_by('id').iterator():
+        by_id[check.unit_id]._qualitychecks.append(check)
+
 ###################### Store ###########################
 
 x_generator = "Pootle %s" % pootle_version
@@ -568,10 +785,12 @@ class Store(models.Model, base.TranslationStore):
                 #self.translation_project.update_index(self.translation_project.indexer, self)
             # new units, let's flush cache
             deletefromcache(self, ["getquickstats", "getcompletestats", "get_mtime", "has_suggestions"])
+        invalidate_unit_ordinals(self.translation_project_id)
 
     def delete(self, *args, **kwargs):
         super(Store, self).delete(*args, **kwargs)
         deletefromcache(self, ["getquickstats", "getcompletestats", "get_mtime", "has_suggestions"])
+        invalidate_unit_ordinals(self.translation_project_id)
 
     @getfromcache
     def get_mtime(self):
@@ -626,17 +845,19 @@ class Store(models.Model, base.TranslationStore):
             self.state = LOCKED
             self.save()
             try:
-                for index, unit in enumerate(self.file.store.units):
-                    if unit.istranslatable():
-                        self.addunit(unit, index)
+                self.addunits_bulk((unit, index) for index, unit in enumerate(self.file.store.units)
+                                   if unit.istranslatable())
             except:
                 # something broke, delete any units that got created
                 # and return store state to its original value
                 self.unit_set.all().delete()
+                StoreStats.objects.filter(store=self).delete()
                 self.state = oldstate
                 self.save()
                 raise
 
+            self.update_search_terms()
+            self.update_stats()
             self.state = PARSED
             self.save()
             return
@@ -680,24 +901,75 @@ class Store(models.Model, base.TranslationStore):
             # unlock store
             self.state = oldstate
             self.save()
+            # unit saves skipped stats while the store was locked
+            self.patch_quickstats(self.update_stats())
 
-    def require_qualitychecks(self):
+    @commit_on_success
+    def update_search_terms(self, chunk_size=1000):
+        """rebuild search index entries of all units"""
+        SearchTerm.objects.filter(unit__store=self).delete()
+        # raw column values are enough for tokenizing, no need to
+        # build unit objects
+        units = self.unit_set.values_list('id', *search_columns)
+        terms = []
+        for row in units.iterator():
+            terms.extend(get_search_terms(row[0], dict(zip(search_columns, row[1:]))))
+            if len(terms) >= chunk_size:
+                insert_many(SearchTerm, terms)
+                terms = []
+        insert_many(SearchTerm, terms)
+
+    def require_qualitychecks(self, pool=None):
         """make sure quality checks are run"""
         if self.state < CHECKED:
-            self.update_qualitychecks()
+            self.update_qualitychecks(pool=pool)
             # new qualitychecks, let's flush cache
             deletefromcache(self, ["getcompletestats"])
 
     @commit_on_success
-    def update_qualitychecks(self):
+    def update_qualitychecks(self, chunk_size=1000, pool=None):
+        """run quality checks on all units, checks are compared to the
+        existing ones and only the differences are written back. pool
+        is a CheckPool from make_check_pool, checks run in process
+        without one."""
         logging.debug("Updating quality checks for %s", self.pootle_path)
+        translation_project = self.translation_project
+        runner = QualityCheckRunner(translation_project.project.checkstyle,
+                                    translation_project.language.code, pool)
+        chunk = []
         for unit in self.units.iterator():
-            unit.update_qualitychecks()
+            chunk.append(unit)
+            if len(chunk) >= chunk_size:
+                self._update_qualitychecks_chunk(runner, chunk)
+                chunk = []
+        if chunk:
+            self._update_qualitychecks_chunk(runner, chunk)
 
         if self.state < CHECKED:
             self.state = CHECKED
             self.save()
 
+    def _update_qualitychecks_chunk(self, runner, units):
+        results = runner.run([(unit.id, unit) for unit in units if unit.target])
+        new_checks = set()
+        for unit_id, failures in results.iteritems():
+            for name, message in failures.iteritems():
+                new_checks.add((unit_id, name, force_unicode(message)))
+
+        obsolete = []
+        existing = set()
+        queryset = QualityCheck.objects.filter(unit__in=[unit.id for unit in units])
+        for check_id, unit_id, name, message in queryset.values_list('id', 'unit', 'name', 'message').iterator():
+            if (unit_id, name, message) in new_checks and (unit_id, name, message) not in existing:
+                existing.add((unit_id, name, message))
+            else:
+                obsolete.append(check_id)
+
+        if obsolete:
+            QualityCheck.objects.filter(id__in=obsolete).delete()
+        insert_many(QualityCheck, [QualityCheck(unit_id=unit_id, name=name, message=message)
+                                   for unit_id, name, message in new_checks - existing])
+
     def sync(self, update_structure=False, update_translation=False, conservative=True, create=False):
         """sync file with translations from db"""
         if not self.file:
@@ -760,7 +1032,7 @@ class Store(models.Model, base.TranslationStore):
         except ObjectDoesNotExist:
             pass
         #FIXME: we should add some headers
-        for unit in self.units.iterator():
+        for unit in self.get_unit_rows(suggestions=hasattr(output.UnitClass, 'addalttrans')):
             output.addunit(unit.convert(output.UnitClass))
         return output
 
@@ -784,6 +1056,12 @@ class Store(models.Model, base.TranslationStore):
         return self.unit_set.filter(state__gt=OBSOLETE).order_by('index').select_related('store__translation_project')
     units=property(_get_units)
 
+    def get_unit_rows(self, suggestions=False):
+        """read only UnitRows of units, for bulk jobs"""
+        if hasattr(self, '_units'):
+            return iter(self._units)
+        return iter_unit_rows(self.units, suggestions)
+
     def max_index(self):
         """Largest unit index"""
         return max_column(self.unit_set.all(), 'index', -1)
@@ -806,6 +1084,28 @@ class Store(models.Model, base.TranslationStore):
                 self._units = FakeQuerySet()
             self._units.append(newunit)
 
+    def addunits_bulk(self, units, chunk_size=1000):
+        """create database units from (unit, index) pairs using
+        multi-row inserts, used when a file is parsed for the first
+        time.
+
+        units are inserted directly, bypassing Unit.save so cache
+        invalidation, AUTOSYNC and quality checks are left to the
+        caller."""
+        count = 0
+        newunits = []
+        for unit, index in units:
+            newunit = Unit(store=self, index=index)
+            newunit.update(unit)
+            newunit._update_derived_fields()
+            newunits.append(newunit)
+            if len(newunits) >= chunk_size:
+                count += insert_many(Unit, newunits)
+                newunits = []
+        if newunits:
+            count += insert_many(Unit, newunits)
+        return count
+
     def findunit(self, source):
         # find using hash instead of index
         source_hash = md5_f(source.encode("utf-8")).hexdigest()
@@ -841,11 +1141,58 @@ class Store(models.Model, base.TranslationStore):
 
 ############################### Stats ############################
 
-    @getfromcache
-    def getquickstats(self):
-        """calculate translation statistics"""
+    def _get_stats(self):
+        """materialized translation statistics, calculated from the
+        units if they don't exist yet"""
+        try:
+            return StoreStats.objects.get(store=self)
+        except StoreStats.DoesNotExist:
+            stats = StoreStats(store=self)
+            stats.set_stats(calculate_stats(self.units))
+            sid = transaction.savepoint()
+            try:
+                stats.save()
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                # stats materialized concurrently by another process
+                transaction.savepoint_rollback(sid)
+            return stats
+
+    def update_stats(self):
+        """recalculate materialized stats from the units with one
+        aggregate query, returns the change"""
+        stats = calculate_stats(self.unit_set.filter(state__gt=OBSOLETE))
+        sid = transaction.savepoint()
         try:
-            return calculate_stats(self.units)
+            try:
+                row = StoreStats.objects.get(store=self)
+                oldstats = row.get_stats()
+            except StoreStats.DoesNotExist:
+                row = StoreStats(store=self)
+                oldstats = {}
+            row.set_stats(stats)
+            row.save()
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # row materialized concurrently by another process
+            transaction.savepoint_rollback(sid)
+            StoreStats.objects.filter(store=self).update(**stats)
+            oldstats = {}
+        return stats_delta(dict((field, oldstats.get(field, 0)) for field in stats_fields), stats)
+
+    def patch_quickstats(self, delta):
+        """update cached quickstats of store and ancestors with delta"""
+        if not delta:
+            return
+        if self.pootle_path.startswith('/templates/'):
+            # template stats are not aggregated above store level
+            patchcache(self, {'getquickstats': None})
+        else:
+            patchcache(self, {'getquickstats': delta})
+
+    def _calculate_quickstats(self):
+        try:
+            return self._get_stats().get_stats()
         except IntegrityError:
             logging.info("Duplicate IDs in %s", self.abs_real_path)
         except base.ParseError, e:
@@ -857,6 +1204,15 @@ class Store(models.Model, base.TranslationStore):
         stats['errors'] += 1
         return stats
 
+    def require_stats(self):
+        """make sure materialized stats exist, returns number of errors"""
+        return self._calculate_quickstats().get('errors', 0)
+
+    @getfromcache
+    def getquickstats(self):
+        """calculate translation statistics"""
+        return self._calculate_quickstats()
+
     @getfromcache
     def getcompletestats(self):
         """report result of quality checks"""
@@ -937,6 +1293,7 @@ class Store(models.Model, base.TranslationStore):
             # unlock store
             self.state = oldstate
             self.save()
+            self.patch_quickstats(self.update_stats())
 
 
     def updateheader(self, user=None):
@@ -1018,3 +1375,201 @@ class Store(models.Model, base.TranslationStore):
             except PootleProfile.DoesNotExist:
                 pass
         return None
+
+###################### Search Index ###########################
+
+class SearchTerm(models.Model):
+    """inverted index of unit text, lets the database search find
+    units by word without scanning every unit"""
+    unit = models.ForeignKey(Unit, db_index=True)
+    field = models.CharField(max_length=16)
+    term = models.CharField(max_length=TERM_MAX_LENGTH, db_index=True)
+
+    def __unicode__(self):
+        return u"%s:%s" % (self.field, self.term)
+
+def get_search_terms(unit_id, values):
+    """SearchTerm instances for a unit, values maps search_columns
+    to the unit's text"""
+    terms = []
+    for field, columns in search_fields.iteritems():
+        words = set()
+        for column in columns:
+            words.update(search_terms(values[column]))
+        terms.extend(SearchTerm(unit_id=unit_id, field=field, term=word) for word in words)
+    return terms
+
+def filter_by_search_terms(units_queryset, text, fields):
+    """narrow units_queryset to units containing words starting
+    with every word of text in any of fields"""
+    words = search_terms(text)
+    if not words:
+        return units_queryset
+    for word in words:
+        # each filter() call joins the index again, so all words
+        # have to match
+        units_queryset = units_queryset.filter(searchterm__term__startswith=word,
+                                               searchterm__field__in=fields)
+    return units_queryset.distinct()
+
+###################### Store Stats ###########################
+
+class StoreStats(models.Model):
+    """materialized quickstats of a store, kept current by applying
+    deltas whenever a unit changes state or wordcount"""
+    store = models.OneToOneField(Store, related_name='stats', db_index=True, editable=False)
+    total = models.IntegerField(default=0)
+    totalsourcewords = models.IntegerField(default=0)
+    untranslated = models.IntegerField(default=0)
+    untranslatedsourcewords = models.IntegerField(default=0)
+    fuzzy = models.IntegerField(default=0)
+    fuzzysourcewords = models.IntegerField(default=0)
+    translated = models.IntegerField(default=0)
+    translatedsourcewords = models.IntegerField(default=0)
+    translatedtargetwords = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return unicode(self.store)
+
+    def set_stats(self, stats):
+        for field in stats_fields:
+            setattr(self, field, stats.get(field, 0))
+
+    def get_stats(self):
+        stats = {}
+        stats.update(empty_quickstats)
+        for field in stats_fields:
+            stats[field] = getattr(self, field)
+        return stats
+
+def _stats_from_totals(totals, errors=0):
+    stats = {}
+    stats.update(empty_quickstats)
+    for field in stats_fields:
+        stats[field] = totals.get(field) or 0
+    stats['errors'] = errors
+    return stats
+
+def store_stats_grouped(group_field, exclude_templates=True, **filters):
+    """aggregate quickstats of all stores matching filters for each
+    value of group_field (a lookup starting from Store) in a single
+    query, stats missing for some stores are calculated first"""
+    stores = Store.objects.filter(**filters)
+    if exclude_templates:
+        stores = stores.exclude(pootle_path__startswith='/templates/')
+
+    errors = {}
+    for pk, group in stores.filter(stats__isnull=True).values_list('pk', group_field).iterator():
+        errors[group] = errors.get(group, 0) + Store.objects.get(pk=pk).require_stats()
+
+    stats_filters = dict(('store__' + key, value) for key, value in filters.iteritems())
+    queryset = StoreStats.objects.filter(**stats_filters)
+    if exclude_templates:
+        queryset = queryset.exclude(store__pootle_path__startswith='/templates/')
+    grouped = group_by_sum(queryset, 'store__' + group_field, stats_fields)
+    result = {}
+    for group in set(grouped) | set(errors):
+        result[group] = _stats_from_totals(grouped.get(group, {}), errors.get(group, 0))
+    return result
+
+def store_stats_sum(**filters):
+    """aggregate quickstats of all stores matching filters from their
+    materialized stats, stats missing for some stores are calculated
+    first"""
+    errors = 0
+    stores = Store.objects.filter(stats__isnull=True, **filters).exclude(pootle_path__startswith='/templates/')
+    for store in stores.iterator():
+        errors += store.require_stats()
+
+    stats_filters = dict(('store__' + key, value) for key, value in filters.iteritems())
+    queryset = StoreStats.objects.filter(**stats_filters).exclude(store__pootle_path__startswith='/templates/')
+    return _stats_from_totals(sum_column(queryset, stats_fields), errors)
+
+def _directory_stats_many(directories):
+    prefix = os.path.commonprefix([directory.pootle_path for directory in directories])
+    prefix = prefix[:prefix.rfind('/') + 1]
+    by_parent = store_stats_grouped('parent__pootle_path', pootle_path__startswith=prefix)
+    result = []
+    for directory in directories:
+        stats = _stats_from_totals({})
+        for parent_path, parent_stats in by_parent.iteritems():
+            if parent_path.startswith(directory.pootle_path):
+                stats = dictsum(stats, parent_stats)
+        result.append(stats)
+    return result
+
+def quickstats_many(objects, group_field=None):
+    """getquickstats() for several objects of the same kind. cached
+    results are fetched in one round trip and the missing ones are
+    calculated with a single query.
+
+    group_field is the lookup from Store to the objects, 'id' for
+    stores themselves. without one objects are taken to be
+    directories."""
+    def calculate(objects):
+        if group_field is None:
+            return _directory_stats_many(objects)
+        grouped = store_stats_grouped(group_field, exclude_templates=group_field != 'id',
+                                      **{group_field + '__in': [obj.pk for obj in objects]})
+        return [grouped.get(obj.pk) or _stats_from_totals({}) for obj in objects]
+    return getmanyfromcache(objects, 'getquickstats', calculate)
+
+###################### Unit Ordinals ###########################
+
+def get_units_version_key(translation_project_id):
+    return "unit_ordinals:%s" % translation_project_id
+
+def invalidate_unit_ordinals(translation_project_id):
+    """forget cached unit positions after units were added to or
+    removed from a translation project"""
+    cache.set(get_units_version_key(translation_project_id), time.time(), settings.OBJECT_CACHE_TIMEOUT)
+
+class UnitOrdinals(object):
+    """position of stores within a unit queryset ordered by
+    (pootle_path, index), used to place units on pages without
+    counting rows on every request"""
+
+    def __init__(self, counts):
+        counts = sorted(counts.items())
+        self.paths = [path for path, count in counts]
+        self.offsets = []
+        self.total = 0
+        for path, count in counts:
+            self.offsets.append(self.total)
+            self.total += count
+
+    def store_offset(self, pootle_path):
+        """number of units in stores before pootle_path"""
+        i = bisect.bisect_left(self.paths, pootle_path)
+        if i < len(self.paths):
+            return self.offsets[i]
+        return self.total
+
+def get_unit_ordinals(translation_project_id, units_queryset):
+    """UnitOrdinals of units_queryset, which must stay within the
+    translation project, cached until units are added or removed"""
+    version_key = get_units_version_key(translation_project_id)
+    key = "%s:%s" % (version_key, md5_f(unicode(units_queryset.query).encode('utf-8')).hexdigest())
+    cached = cache.get_many([version_key, key])
+    version = cached.get(version_key)
+    if key in cached and cached[key][0] == version:
+        return cached[key][1]
+
+    ordinals = UnitOrdinals(group_by_count(units_queryset.order_by(), 'store__pootle_path'))
+    cache.set(key, (version, ordinals), settings.OBJECT_CACHE_TIMEOUT)
+    return ordinals
+
+def get_store_position(store, index):
+    """number of units of store before the one at index, from the
+    cached indexes of the store's units"""
+    version_key = get_units_version_key(store.translation_project_id)
+    key = "%s:store:%d" % (version_key, store.id)
+    cached = cache.get_many([version_key, key])
+    version = cached.get(version_key)
+    if key in cached and cached[key][0] == version:
+        indexes = array('i', cached[key][1])
+    else:
+        indexes = array('i', store.unit_set.filter(state__gt=OBSOLETE).order_by('index').values_list('index', flat=True))
+        # stored as a packed string, stores can be long
+        cache.set(key, (version, indexes.tostring()), settings.OBJECT_CACHE_TIMEOUT)
+    return bisect.bisect_left(indexes, index)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2010 Zuza Software Foundation
+#
+# This file is part of Pootle.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+"""on disk cache of parsed translation stores shared by all server
+processes, unpickling a store is much faster than parsing the file
+again"""
+
+import os
+import random
+import logging
+import tempfile
+import cPickle
+
+from django.conf import settings
+
+from translate.misc.hash import md5_f
+
+CULL_PROBABILITY = 0.05
+"""chance of checking the cache size after adding a store, listing
+the cache directory on every write would cost more than parsing"""
+
+def _get_cache_dir():
+    return getattr(settings, 'PARSE_CACHE_DIR', None)
+
+def _get_cache_path(cache_dir, realpath, mod_info):
+    key = "%s:%r:%d" % (realpath, mod_info[0], mod_info[1])
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return os.path.join(cache_dir, md5_f(key).hexdigest() + '.pickle')
+
+def get_store(realpath, mod_info):
+    """parsed store for file at realpath, None unless it is in the
+    cache and the file's (mtime, size) equals mod_info"""
+    cache_dir = _get_cache_dir()
+    if not cache_dir:
+        return None
+    path = _get_cache_path(cache_dir, realpath, mod_info)
+    try:
+        cache_file = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        try:
+            store = cPickle.load(cache_file)
+        except Exception, e:
+            logging.warning("Failed to load cached %s\n%s", realpath, e)
+            return None
+    finally:
+        cache_file.close()
+    # mark as recently used for eviction
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+    return store
+
+def set_store(realpath, mod_info, store):
+    """add parsed store for file at realpath to cache"""
+    cache_dir = _get_cache_dir()
+    if not cache_dir:
+        return
+    try:
+        data = cPickle.dumps(store, cPickle.HIGHEST_PROTOCOL)
+    except Exception, e:
+        # some storage classes wrap C libraries and can't be pickled
+        logging.debug("Can't cache %s\n%s", realpath, e)
+        return
+
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # write to a temporary file then move it, other processes
+        # never see half written files
+        fd, tmpfilename = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        os.rename(tmpfilename, _get_cache_path(cache_dir, realpath, mod_info))
+    except (IOError, OSError), e:
+        logging.warning("Failed to cache %s\n%s", realpath, e)
+        return
+    if random.random() < CULL_PROBABILITY:
+        cull(cache_dir)
+
+def delete_store(realpath, mod_info):
+    """remove store for file at realpath from the cache, used when
+    mod_info is out of date"""
+    cache_dir = _get_cache_dir()
+    if not cache_dir:
+        return
+    try:
+        os.remove(_get_cache_path(cache_dir, realpath, mod_info))
+    except OSError:
+        # not cached or removed by another process
+        pass
+
+def cull(cache_dir):
+    """delete least recently used cache files until the cache is
+    smaller than PARSE_CACHE_SIZE bytes"""
+    max_size = getattr(settings, 'PARSE_CACHE_SIZE', 256 * 1024 * 1024)
+    entries = []
+    total = 0
+    for filename in os.listdir(cache_dir):
+        if not filename.endswith('.pickle'):
+            continue
+        path = os.path.join(cache_dir, filename)
+        try:
+            file_stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((file_stat.st_mtime, file_stat.st_size, path))
+        total += file_stat.st_size
+
+    if total <= max_size:
+        return
+    entries.sort()
+    for mtime, size, path in entries:
+        try:
+            os.remove(path)
+        except OSError:
+            # removed by another process
+            pass
+        total -= size
+        if total <= max_size:
+            break
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2010 Zuza Software Foundation
+#
+# This file is part of Pootle.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+"""run quality checks on many units at once, batch jobs can spread
+the work over a pool of worker processes shared by all the stores they
+go through"""
+
+import logging
+
+from django.conf import settings
+
+from translate.filters import checks
+from translate.storage import pypo
+
+def get_checker(checkstyle, languagecode, errorhandler=None):
+    checkerclasses = [checks.projectcheckers.get(checkstyle,
+                                                 checks.StandardChecker),
+                      checks.StandardUnitChecker]
+    return checks.TeeChecker(checkerclasses=checkerclasses,
+                             errorhandler=errorhandler,
+                             languagecode=languagecode)
+
+def filtererrorhandler(functionname, str1, str2, e):
+    logging.error("error in filter %s: %r, %r, %s", functionname, str1, str2, e)
+    return False
+
+def lightweight_unit(unit):
+    """picklable copy of a database unit with everything the checkers
+    look at"""
+    newunit = pypo.pounit(unit.source)
+    newunit.target = unit.target
+    newunit.markfuzzy(unit.isfuzzy())
+    notes = unit.getnotes(origin="developer")
+    if notes:
+        newunit.addnote(notes, origin="developer")
+    notes = unit.getnotes(origin="translator")
+    if notes:
+        newunit.addnote(notes, origin="translator")
+    return newunit
+
+def run_filters(checker, units):
+    """run checker on a list of (id, unit) pairs, returns a list of
+    (id, failures) pairs"""
+    return [(unit_id, checker.run_filters(unit)) for unit_id, unit in units]
+
+# checkers of a worker process by checkstyle and language
+_worker_checkers = {}
+
+def _run_filters_worker(args):
+    checkstyle, languagecode, units = args
+    key = (checkstyle, languagecode)
+    if key not in _worker_checkers:
+        _worker_checkers[key] = get_checker(checkstyle, languagecode, filtererrorhandler)
+    return run_filters(_worker_checkers[key], units)
+
+
+class CheckPool(object):
+    """worker processes running quality checks for a batch job"""
+
+    def __init__(self, processes):
+        import multiprocessing
+        self.pool = multiprocessing.Pool(processes)
+        self.processes = processes
+
+    def map(self, checkstyle, languagecode, chunks):
+        return self.pool.map(_run_filters_worker, [(checkstyle, languagecode, chunk) for chunk in chunks])
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+def make_check_pool(processes=None):
+    """CheckPool for a management command or task to pass to every
+    store it checks, None if checks should run in process. web
+    requests never start worker processes."""
+    if processes is None:
+        processes = getattr(settings, 'QUALITYCHECK_PROCESSES', 0)
+    if processes > 1:
+        try:
+            return CheckPool(processes)
+        except (ImportError, OSError), e:
+            logging.warning("Can't start quality check processes, running checks in process\n%s", e)
+    return None
+
+
+class QualityCheckRunner(object):
+    """runs a project's checker over chunks of units, in this process
+    or in the worker processes of pool"""
+
+    def __init__(self, checkstyle, languagecode, pool=None):
+        self.checkstyle = checkstyle
+        self.languagecode = languagecode
+        self.checker = get_checker(checkstyle, languagecode, filtererrorhandler)
+        self.pool = pool
+
+    def run(self, units):
+        """returns a dictionary mapping unit ids to check failures"""
+        if self.pool is None or len(units) < self.pool.processes * 2:
+            return dict(run_filters(self.checker, units))
+
+        units = [(unit_id, lightweight_unit(unit)) for unit_id, unit in units]
+        size = len(units) / self.pool.processes + 1
+        results = {}
+        for chunk_results in self.pool.map(self.checkstyle, self.languagecode,
+                                           [units[i:i+size] for i in xrange(0, len(units), size)]):
+            results.update(chunk_results)
+        return results
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2010 Zuza Software Foundation
+#
+# This file is part of Pootle.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+"""find units matching a search, using the translation project's
+indexer when there is one and the database word index otherwise.
+results are ranked lists of unit ids, cached so stepping through
+them costs a single cache lookup."""
+
+import re
+import logging
+from array import array
+
+from django.core.cache import cache
+
+from translate.misc.hash import md5_f
+
+from pootle_misc.aggregate import group_by_count
+from pootle_store.models import Unit, SearchTerm, filter_by_search_terms, get_units_version_key
+from pootle_store.util import search_fields, search_terms
+
+SEARCH_CACHE_TIMEOUT = 600
+"""seconds search results are kept for stepping through them, a new
+search always starts from fresh results"""
+
+CHUNK_SIZE = 500
+"""unit ids per query when ranking or checking phrases"""
+
+_phrase_re = re.compile(r'"([^"]*)"')
+
+def parse_search(text):
+    """split search text into words and "quoted phrases", returns
+    (words, phrases). words include the words of phrases."""
+    phrases = [phrase.strip() for phrase in _phrase_re.findall(text) if phrase.strip()]
+    words = _phrase_re.sub(u" ", text).split()
+    for phrase in phrases:
+        words.extend(phrase.split())
+    return words, phrases
+
+def _indexed_search(indexer, words, fields, paths):
+    searchparts = []
+    for word in words:
+        # a word may appear in any field, but all words must appear
+        searchparts.append(indexer.make_query([(field, word) for field in fields], False))
+    searchparts.append(indexer.make_query([('pofilename', path) for path in paths], False))
+    query = indexer.make_query(searchparts, True)
+    # indexer returns best matches first
+    return [int(item['dbid'][0]) for item in indexer.search(query, ['dbid'])]
+
+def _database_search(units_queryset, words, fields):
+    text = u" ".join(words)
+    unit_ids = list(filter_by_search_terms(units_queryset, text, fields).values_list('id', flat=True))
+
+    # units where the words appear as whole words and in more fields
+    # rank first
+    terms = list(search_terms(text))
+    scores = {}
+    for i in xrange(0, len(unit_ids), CHUNK_SIZE):
+        matches = SearchTerm.objects.filter(unit__in=unit_ids[i:i+CHUNK_SIZE], term__in=terms, field__in=fields)
+        scores.update(group_by_count(matches, 'unit'))
+    position = dict((unit_id, i) for i, unit_id in enumerate(unit_ids))
+    unit_ids.sort(key=lambda unit_id: (-scores.get(unit_id, 0), position[unit_id]))
+    return unit_ids
+
+def _filter_phrases(unit_ids, phrases, fields):
+    """keep units containing every phrase in one of fields"""
+    phrases = [phrase.lower() for phrase in phrases]
+    columns = []
+    for field in fields:
+        columns.extend(search_fields[field])
+    matching = set()
+    for i in xrange(0, len(unit_ids), CHUNK_SIZE):
+        rows = Unit.objects.filter(id__in=unit_ids[i:i+CHUNK_SIZE]).values_list('id', *columns)
+        for row in rows.iterator():
+            texts = [value.lower() for value in row[1:] if value]
+            for phrase in phrases:
+                if not [text for text in texts if phrase in text]:
+                    break
+            else:
+                matching.add(row[0])
+    return [unit_id for unit_id in unit_ids if unit_id in matching]
+
+def search_units(translation_project, units_queryset, text, fields, refresh=False):
+    """ranked list of ids of units in units_queryset matching the
+    search. cached results are reused unless refresh is set or units
+    were added to or removed from the translation project."""
+    words, phrases = parse_search(text)
+    if not words or not fields:
+        return array('i')
+
+    version_key = get_units_version_key(translation_project.id)
+    key = "%r:%r:%s" % (words, phrases, ",".join(sorted(fields)))
+    key = "search:%s:%s" % (md5_f(key.encode('utf-8')).hexdigest(),
+                            md5_f(unicode(units_queryset.query).encode('utf-8')).hexdigest())
+    cached = cache.get_many([version_key, key])
+    version = cached.get(version_key)
+    if not refresh and key in cached and cached[key][0] == version:
+        return array('i', cached[key][1])
+
+    indexer = translation_project.indexer
+    if indexer is None:
+        logging.debug("No indexer for %s, using database search", translation_project)
+        unit_ids = _database_search(units_queryset, words, fields)
+    else:
+        logging.debug("Found %s indexer for %s, using indexed search",
+                      indexer.INDEX_DIRECTORY_NAME, translation_project)
+        paths = units_queryset.order_by().values_list('store__pootle_path', flat=True).distinct()
+        unit_ids = _indexed_search(indexer, words, fields, paths.iterator())
+    if phrases:
+        unit_ids = _filter_phrases(unit_ids, phrases, fields)
+
+    # stored as a packed string, search results can be long
+    unit_ids = array('i', unit_ids)
+    cache.set(key, (version, unit_ids.tostring()), SEARCH_CACHE_TIMEOUT)
+    return unit_ids
@@ -22,31 +22,88 @@ from difflib import SequenceMatcher
 from django.utils.safestring import mark_safe
 
 from django import template
-from django.utils.translation import ugettext as _
+from django.conf import settings
+from django.template.loader import render_to_string
+from django.utils.translation import ugettext as _, get_language
 from django.core.exceptions import  ObjectDoesNotExist
+from django.core.cache import cache
 
-from pootle_store.models import Unit
+from translate.misc.hash import md5_f
+
+from pootle_store.models import Unit, prefetch_units, get_unit_version_key
 from pootle_store.util import TRANSLATED
+from pootle_store.tm import get_tm_suggestions
 from pootle_misc.templatetags.cleanhtml import fancy_escape
 
 register = template.Library()
 
-def find_altsrcs(unit, alt_src_langs, store=None, project=None):
-    store = store or unit.store
-    project = project or store.translation_project.project
-    altsrcs = Unit.objects.filter(unitid_hash=unit.unitid_hash,
-                                 store__translation_project__project=project,
-                                 store__translation_project__language__in=alt_src_langs,
-                                 state=TRANSLATED).select_related('store', 'store__translation_project', 'store__translation_project__language')
+ALTSRC_CACHE_TIMEOUT = 300
+"""seconds alternative source translations are cached for"""
+
+def _get_altsrc_key(project, store, unitid_hash, language_id):
+    if project.get_treestyle() == 'nongnu':
+        return "altsrc:%d:%s:%s:%d" % (project.id, md5_f(store.name.encode('utf-8')).hexdigest(),
+                                       unitid_hash, language_id)
+    return "altsrc:%d:%s:%d" % (project.id, unitid_hash, language_id)
+
+def prefetch_altsrcs(units, alt_src_langs, store, project):
+    """find alternative source translations of several units of
+    store with one query, results are cached for find_altsrcs.
+    returns a dictionary mapping (unitid_hash, language id) to lists
+    of units."""
+    hashes = set(unit.unitid_hash for unit in units)
+    language_ids = [language.id for language in alt_src_langs]
+    if not hashes or not language_ids:
+        return {}
+    altsrcs = Unit.objects.filter(unitid_hash__in=hashes,
+                                  store__translation_project__project=project,
+                                  store__translation_project__language__in=language_ids,
+                                  state=TRANSLATED).select_related('store', 'store__translation_project', 'store__translation_project__language')
     if project.get_treestyle() == 'nongnu':
         altsrcs = altsrcs.filter(store__name=store.name)
+
+    found = {}
+    for altunit in altsrcs.iterator():
+        key = (altunit.unitid_hash, altunit.store.translation_project.language_id)
+        found.setdefault(key, []).append(altunit)
+    # units without alternative translations are cached too
+    for unitid_hash in hashes:
+        for language_id in language_ids:
+            cache.set(_get_altsrc_key(project, store, unitid_hash, language_id),
+                      found.get((unitid_hash, language_id), []), ALTSRC_CACHE_TIMEOUT)
+    return found
+
+def find_altsrcs(unit, alt_src_langs, store=None, project=None, units=None):
+    """alternative source translations of unit, when not cached they
+    are looked up for all of units (the other units on the page)"""
+    store = store or unit.store
+    project = project or store.translation_project.project
+    alt_src_langs = list(alt_src_langs)
+    keys = [_get_altsrc_key(project, store, unit.unitid_hash, language.id) for language in alt_src_langs]
+    cached = cache.get_many(keys)
+    if len(cached) < len(keys):
+        found = prefetch_altsrcs(list(units or []) + [unit], alt_src_langs, store, project)
+        cached = dict((key, found.get((unit.unitid_hash, language.id), []))
+                      for key, language in zip(keys, alt_src_langs))
+    altsrcs = []
+    for key in keys:
+        altsrcs.extend(cached.get(key, []))
     return altsrcs
 
+DIFF_CACHE_SIZE = 1000
+"""number of highlighted diffs remembered by highlight_diffs"""
+
+_diff_cache = {}
+
 def highlight_diffs(old, new):
     """Highlights the differences between old and new. The differences
     are highlighted such that they show what would be required to
     transform old into new.
     """
+    try:
+        return _diff_cache[(old, new)]
+    except KeyError:
+        pass
 
     textdiff = ""
     for tag, i1, i2, j1, j2 in SequenceMatcher(None, old, new).get_opcodes():
@@ -60,7 +117,11 @@ def highlight_diffs(old, new):
             # We don't show text that was removed as part of a change:
             #textdiff += "<span>%s</span>" % fance_escape(a[i1:i2])}
             textdiff += '<span class="translate-diff-replace">%s</span>' % fancy_escape(new[j1:j2])
-    return mark_safe(textdiff)
+    textdiff = mark_safe(textdiff)
+    if len(_diff_cache) >= DIFF_CACHE_SIZE:
+        _diff_cache.clear()
+    _diff_cache[(old, new)] = textdiff
+    return textdiff
 
 def get_sugg_list(unit):
     """get suggested translations for given unit with the localized
@@ -69,7 +130,7 @@ def get_sugg_list(unit):
     # variables in templates, since template translation is not safe
     # and might fail on livetranslation
     sugg_list = []
-    for i, sugg in enumerate(unit.get_suggestions().iterator()):
+    for i, sugg in enumerate(unit.get_suggestion_list()):
         title = _("Suggestion %(i)d by %(user)s:", {'i': i+1, 'user': sugg.user})
         sugg_list.append((sugg, title))
     if len(sugg_list) == 1:
@@ -157,8 +218,10 @@ def render_unit_edit(context, form):
                      "cantranslate": context['cantranslate'],
                      "cansuggest": context['cansuggest'],
                      "canreview": context['canreview'],
-                     'altsrcs': find_altsrcs(unit, alt_src_langs, store=store, project=project),
+                     'altsrcs': find_altsrcs(unit, alt_src_langs, store=store, project=project,
+                                             units=context.get('units')),
                      "suggestions": get_sugg_list(unit),
+                     'tm_suggestions': get_tm_suggestions(unit),
                      }
     return template_vars
 
@@ -170,8 +233,40 @@ def render_unit_view(context, unit, show_comments=False):
                      }
     return template_vars
 
+def render_unit_views(units, language, edit_unit=None):
+    """list of (unit, html) pairs with unit/view.html rendered for
+    each of units but edit_unit. rows of units that didn't change since
+    they were last rendered in the current UI language come from the
+    cache, suggestions and checks of the units rendered for this page,
+    edit_unit included, are prefetched together."""
+    units = list(units)
+    ui_language = get_language()
+    versions = cache.get_many([get_unit_version_key(unit.id) for unit in units])
+    keys = ["unit_view:%d:%s:%r:%s" % (unit.id, unit.mtime.strftime("%Y%m%d%H%M%S"),
+                                      versions.get(get_unit_version_key(unit.id), 0), ui_language)
+            for unit in units]
+    cached = cache.get_many(keys)
+    page_units = [unit for unit, key in zip(units, keys) if unit != edit_unit and key not in cached]
+    if edit_unit is not None:
+        page_units.append(edit_unit)
+    prefetch_units(page_units)
+    rendered = []
+    for unit, key in zip(units, keys):
+        if unit == edit_unit:
+            rendered.append((unit, None))
+            continue
+        html = cached.get(key)
+        if html is None:
+            html = render_to_string('unit/view.html', {'unit': unit, 'language': language,
+                                                      'show_comments': False})
+            cache.set(key, html, settings.OBJECT_CACHE_TIMEOUT)
+        rendered.append((unit, mark_safe(html)))
+    return rendered
+
 @register.inclusion_tag('store/translate_table.html', takes_context=True)
 def translate_table(context):
     """encapsulate translate_table in a tag to avoid parsing template
     when cache will be used"""
+    context['rendered_units'] = render_unit_views(context['units'], context['language'],
+                                                  context['form'].instance)
     return context
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2010 Zuza Software Foundation
+#
+# This file is part of Pootle.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+"""terminology lookups through a trie of the words of term sources.
+indexes are shared by server processes through the cache and brought
+up to date by loading only the terms changed since they were built."""
+
+import re
+import uuid
+import cPickle
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+
+from pootle_store.fields import to_multistring
+
+MAX_CANDIDATES = 10
+"""terms returned per lookup, longest first"""
+
+TERM_MAX_LENGTH = 500
+"""longer sources are not indexed as terms"""
+
+PREFIX_MIN_LENGTH = 3
+"""the last word of a term matches words of the text it starts, like
+"file" matching "files", if it is at least this long"""
+
+CACHE_CHUNK_SIZE = 512 * 1024
+"""bytes of a pickled index stored per cache entry, memcached refuses
+entries over 1MB"""
+
+_word_re = re.compile(r"[^\W_]+", re.UNICODE)
+
+def term_words(text):
+    return [word.lower() for word in _word_re.findall(text)]
+
+
+class TermMatch(object):
+    __slots__ = ('id', 'source', 'target')
+
+    def __init__(self, id, source, target):
+        self.id = id
+        self.source = source
+        self.target = target
+
+    def __unicode__(self):
+        return self.source
+
+
+class TermIndex(object):
+    """terms by the sequence of their source words. each trie node is
+    a dict of words to child nodes, ids of terms ending at a node are
+    kept under the None key."""
+
+    def __init__(self):
+        # newest unit loaded, and mtime of the source when last updated
+        self.mtime = None
+        self.source_mtime = None
+        self.terms = {}
+        self.trie = {}
+
+    def add(self, unit_id, source, target):
+        self.remove(unit_id)
+        words = term_words(source)
+        if not words or not target or len(source) > TERM_MAX_LENGTH:
+            return
+        self.terms[unit_id] = (source, target)
+        node = self.trie
+        for word in words:
+            node = node.setdefault(word, {})
+        node.setdefault(None, []).append(unit_id)
+
+    def remove(self, unit_id):
+        term = self.terms.pop(unit_id, None)
+        if term is None:
+            return
+        words = term_words(term[0])
+        path = [self.trie]
+        for word in words:
+            path.append(path[-1][word])
+        path[-1][None].remove(unit_id)
+        if not path[-1][None]:
+            del path[-1][None]
+        # prune branches left without terms
+        for i in xrange(len(words) - 1, -1, -1):
+            if path[i + 1]:
+                break
+            del path[i][words[i]]
+
+    def update(self, units_queryset, source_mtime):
+        """add terms changed since the index was last updated, drop
+        terms no longer in units_queryset"""
+        self.source_mtime = source_mtime
+        changed = units_queryset
+        if self.mtime is not None:
+            changed = changed.filter(mtime__gte=self.mtime)
+            current = set(units_queryset.values_list('id', flat=True).iterator())
+            for unit_id in [unit_id for unit_id in self.terms if unit_id not in current]:
+                self.remove(unit_id)
+        for unit_id, source, target, mtime in changed.values_list('id', 'source_f', 'target_f', 'mtime').iterator():
+            self.add(unit_id, to_multistring(source).strings[0], to_multistring(target).strings[0])
+            if self.mtime is None or mtime > self.mtime:
+                self.mtime = mtime
+
+    def matches(self, text, max_candidates=MAX_CANDIDATES):
+        """TermMatches of terms whose words appear in sequence in text,
+        the last one possibly as the start of a longer word"""
+        words = term_words(text)
+        found = set()
+        for start in xrange(len(words)):
+            node = self.trie
+            for word in words[start:]:
+                for length in xrange(PREFIX_MIN_LENGTH, len(word)):
+                    prefix_node = node.get(word[:length])
+                    if prefix_node is not None:
+                        found.update(prefix_node.get(None, ()))
+                node = node.get(word)
+                if node is None:
+                    break
+                found.update(node.get(None, ()))
+        results = [TermMatch(unit_id, *self.terms[unit_id]) for unit_id in found]
+        results.sort(key=lambda term: (-len(term.source), term.source))
+        return results[:max_candidates]
+
+
+class TerminologyMatcher(object):
+    """matches text against the terms in units_queryset. source is the
+    store or translation project holding the terms, its mtime tells
+    when the index is out of date."""
+
+    def __init__(self, key, source, units_queryset):
+        self.key = "termindex:%s" % key
+        self.source = source
+        self.units_queryset = units_queryset
+        self.index = None
+
+    def get_index(self):
+        mtime = self.source.get_mtime()
+        if self.index is not None and self.index.source_mtime == mtime:
+            return self.index
+        # the copy kept by this process is used when the cache lost
+        # the shared one
+        index = self._get_cached_index() or self.index
+        if index is None:
+            logging.debug("Building terminology index for %s", self.source)
+            index = TermIndex()
+        if index.source_mtime != mtime:
+            index.update(self.units_queryset, mtime)
+            self._set_cached_index(index)
+        self.index = index
+        return index
+
+    def _get_cached_index(self):
+        try:
+            version, count = cache.get(self.key)
+        except (TypeError, ValueError):
+            return None
+        keys = ["%s:%s:%d" % (self.key, version, i) for i in xrange(count)]
+        chunks = cache.get_many(keys)
+        if len(chunks) != count:
+            logging.warning("Terminology index for %s is incomplete in the cache", self.source)
+            return None
+        return cPickle.loads("".join(chunks[key] for key in keys))
+
+    def _set_cached_index(self, index):
+        """pickled index is stored in chunks small enough for any cache
+        backend, under a new version so readers never mix chunks of
+        different indexes"""
+        data = cPickle.dumps(index, cPickle.HIGHEST_PROTOCOL)
+        version = uuid.uuid4().hex
+        count = 0
+        for i in xrange(0, len(data), CACHE_CHUNK_SIZE):
+            cache.set("%s:%s:%d" % (self.key, version, count), data[i:i+CACHE_CHUNK_SIZE],
+                      settings.OBJECT_CACHE_TIMEOUT)
+            count += 1
+        cache.set(self.key, (version, count), settings.OBJECT_CACHE_TIMEOUT)
+
+    def matches(self, text):
+        return self.get_index().matches(text)
@@ -1,8 +1,33 @@
+import os
+import shutil
+import tempfile
+
 from translate.storage import factory
 from translate.storage import statsdb
+from translate.misc.hash import md5_f
+from translate.misc.multistring import multistring
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
 
 from pootle.tests import PootleTestCase
-from pootle_store.models import Store
+from pootle_store.models import Store, Unit, StoreStats, QualityCheck, SearchTerm, count_words, quickstats_many
+from pootle_store.models import filter_by_search_terms, get_unit_ordinals, get_store_position, prefetch_units
+from pootle_store.views import get_step_unit
+from pootle_store.unitqueue import get_unit_queue, remove_from_queue
+from pootle_store.util import calculate_stats, stats_fields, UNTRANSLATED
+from pootle_store import parsecache
+from pootle_translationproject.models import _index_queues
+from pootle_app.models.directory import Directory
+from pootle_store.search import parse_search, search_units
+from pootle_store.tm import get_memory, get_tm_suggestions
+from pootle_store import termindex
+from pootle_store.termindex import TermIndex, TerminologyMatcher
+from pootle_store.fields import ParsePool, StoreTuple
+from pootle_store.qualitychecks import make_check_pool
+from pootle_store.templatetags.store_tags import find_altsrcs, render_unit_views
+from pootle_store.util import TRANSLATED, FUZZY
 
 class UnitTests(PootleTestCase):
     def setUp(self):
@@ -97,6 +122,20 @@ class UnitTests(PootleTestCase):
         self.assertEqual(dbunit.getnotes(origin="translator"), pofile.units[dbunit.index].getnotes(origin="translator"))
 
 
+class ParsePoolTests(PootleTestCase):
+    def test_memory_budget(self):
+        """least recently used stores are evicted to stay within budget"""
+        pool = ParsePool(max_memory=25)
+        pool['a'] = StoreTuple(None, (0, 1), 'a')
+        pool['b'] = StoreTuple(None, (0, 1), 'b')
+        pool['a']
+        pool['c'] = StoreTuple(None, (0, 1), 'c')
+        self.assertRaises(KeyError, pool.__getitem__, 'b')
+        self.assertEqual(pool['a'].realpath, 'a')
+        self.assertEqual(pool.memory, 20)
+        stats = pool.get_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (2, 1, 1))
+
 class StoreTests(PootleTestCase):
     def setUp(self):
         super(StoreTests, self).setUp()
@@ -116,3 +155,438 @@ class StoreTests(PootleTestCase):
         self.assertEqual(dbstats['translated'], filestats['translated'])
         self.assertEqual(dbstats['translatedsourcewords'], filestats['translatedsourcewords'])
         self.assertEqual(dbstats['translatedtargetwords'], filestats['translatedtargetwords'])
+
+    def test_bulk_parse(self):
+        """units created by bulk parsing have the same derived fields
+        as units saved one by one"""
+        storefile = factory.getobject(self.store.file.path)
+        self.assertEqual(self.store.units.count(),
+                         len([unit for unit in storefile.units if unit.istranslatable()]))
+        for dbunit in self.store.units.iterator():
+            self.assertEqual(dbunit.source_hash, md5_f(dbunit.source_f.encode("utf-8")).hexdigest())
+            self.assertEqual(dbunit.unitid_hash, md5_f(dbunit.unitid.encode("utf-8")).hexdigest())
+            self.assertEqual(dbunit.source_wordcount, count_words(dbunit.source_f.strings))
+            self.assertEqual(dbunit.target_wordcount, count_words(dbunit.target_f.strings))
+            self.assertEqual(dbunit.istranslated(), storefile.findid(dbunit.getid()).istranslated())
+
+    def test_materialized_stats(self):
+        """materialized stats follow changes to units"""
+        self.store.getquickstats()
+        unit = self.store.getitem(0)
+        unit.target = u'samaka'
+        unit.save()
+        unit = self.store.getitem(1)
+        unit.markfuzzy()
+        unit.save()
+        self.store.getitem(2).delete()
+
+        stats = StoreStats.objects.get(store=self.store).get_stats()
+        expected = calculate_stats(self.store.units)
+        for field in stats_fields:
+            self.assertEqual(stats[field], expected[field])
+
+    def test_update_stats(self):
+        """materialized stats are repaired from the units"""
+        self.store.getquickstats()
+        # bypass Unit.save, stats drift
+        self.store.unit_set.filter(state=TRANSLATED).update(state=FUZZY)
+        expected = calculate_stats(self.store.units)
+        self.assertNotEqual(StoreStats.objects.get(store=self.store).fuzzy, expected['fuzzy'])
+
+        delta = self.store.update_stats()
+        stats = StoreStats.objects.get(store=self.store).get_stats()
+        for field in stats_fields:
+            self.assertEqual(stats[field], expected[field])
+        self.assertTrue(delta['fuzzy'] > 0)
+        self.assertEqual(self.store.update_stats(), {})
+
+    def test_cached_stats_patched(self):
+        """cached stats of store and ancestors follow unit changes"""
+        translation_project = self.store.translation_project
+        ancestors = [self.store.parent, translation_project.language,
+                     translation_project.project, Directory.objects.root]
+        store_before = self.store.getquickstats()
+        before = [ancestor.getquickstats() for ancestor in ancestors]
+        unit = self.store.getitem(0)
+        unit.target = u'samaka'
+        unit.save()
+
+        # patched rather than dropped
+        for ancestor in ancestors:
+            self.assertNotEqual(cache.get(ancestor.pootle_path + ":getquickstats"), None)
+
+        expected = calculate_stats(self.store.units)
+        store_after = self.store.getquickstats()
+        after = [ancestor.getquickstats() for ancestor in ancestors]
+        for field in stats_fields:
+            self.assertEqual(store_after[field], expected[field])
+            for ancestor_before, ancestor_after in zip(before, after):
+                self.assertEqual(ancestor_after[field] - ancestor_before[field],
+                                 store_after[field] - store_before[field])
+
+    def test_update_qualitychecks(self):
+        """batched checks match checks run unit by unit"""
+        self.store.update_qualitychecks()
+        batched = sorted(QualityCheck.objects.filter(unit__store=self.store).values_list('unit', 'name', 'message'))
+        for unit in self.store.units.iterator():
+            unit.update_qualitychecks()
+        single = sorted(QualityCheck.objects.filter(unit__store=self.store).values_list('unit', 'name', 'message'))
+        self.assertEqual(batched, single)
+
+        # nothing changed, nothing gets rewritten
+        ids = sorted(QualityCheck.objects.filter(unit__store=self.store).values_list('id', flat=True))
+        self.store.update_qualitychecks()
+        self.assertEqual(ids, sorted(QualityCheck.objects.filter(unit__store=self.store).values_list('id', flat=True)))
+
+        # worker processes find the same failures
+        QualityCheck.objects.filter(unit__store=self.store).delete()
+        pool = make_check_pool(2)
+        try:
+            self.store.update_qualitychecks(chunk_size=10, pool=pool)
+        finally:
+            if pool is not None:
+                pool.close()
+        pooled = sorted(QualityCheck.objects.filter(unit__store=self.store).values_list('unit', 'name', 'message'))
+        self.assertEqual(pooled, single)
+
+    def test_quickstats_many(self):
+        """batched stats match stats calculated one by one"""
+        directory = self.store.parent
+        stores = list(directory.child_stores.all())
+        for store, stats in zip(stores, quickstats_many(stores, 'id')):
+            self.assertEqual(stats, store.getquickstats())
+
+        cache.delete(directory.pootle_path + ":getquickstats")
+        self.assertEqual(quickstats_many([directory])[0], directory.getquickstats())
+
+    def test_serve_stale_stats(self):
+        """concurrent cache misses get the stale copy"""
+        settings.OBJECT_CACHE_SERVE_STALE = True
+        try:
+            key = self.store.pootle_path + ":getcompletestats"
+            cache.delete(key)
+            self.store.getcompletestats()
+            cache.delete(key)
+            stale = {'stale': True}
+            cache.set(key + ":stale", stale)
+            # pretend another process is busy recalculating
+            cache.add(key + ":lock", True)
+            store = Store.objects.get(pk=self.store.pk)
+            self.assertEqual(store.getcompletestats(), stale)
+            cache.delete(key + ":lock")
+        finally:
+            settings.OBJECT_CACHE_SERVE_STALE = False
+
+    def test_parse_cache(self):
+        """parsed stores are shared through the parse cache directory"""
+        cache_dir = tempfile.mkdtemp()
+        cache_size = settings.PARSE_CACHE_SIZE
+        settings.PARSE_CACHE_DIR = cache_dir
+        try:
+            self.store.file._delete_store_cache()
+            unit_count = len(self.store.file.store.units)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            cached = parsecache.get_store(self.store.file.realpath, self.store.file.getpomtime())
+            self.assertEqual(len(cached.units), unit_count)
+
+            # saves replace the outdated entry, or just drop it
+            self.store.file.savestore(cache=False)
+            self.assertEqual(os.listdir(cache_dir), [])
+            self.store.file.savestore()
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            cached = parsecache.get_store(self.store.file.realpath, self.store.file.getpomtime())
+            self.assertEqual(len(cached.units), unit_count)
+
+            # culling drops least recently used entries
+            settings.PARSE_CACHE_SIZE = 0
+            parsecache.cull(cache_dir)
+            self.assertEqual(os.listdir(cache_dir), [])
+        finally:
+            settings.PARSE_CACHE_SIZE = cache_size
+            settings.PARSE_CACHE_DIR = None
+            shutil.rmtree(cache_dir)
+
+    def test_search_terms(self):
+        """search index is built on parse and follows unit edits"""
+        self.store.require_units()
+        self.assertTrue(SearchTerm.objects.filter(unit__store=self.store).count())
+        unit = self.store.units[0]
+        units = self.store.unit_set.all()
+        self.assertFalse(filter_by_search_terms(units, u"xyzzy plugh", ['target']).count())
+        unit.target = u"Xyzzy plughs"
+        unit.save()
+        self.assertEqual(list(filter_by_search_terms(units, u"xyzzy plugh", ['target'])), [unit])
+        self.assertFalse(filter_by_search_terms(units, u"xyzzy plugh", ['source']).count())
+        self.assertFalse(filter_by_search_terms(units, u"xyzzy foo", ['target']).count())
+        unit.translator_comment = u"frobnicate"
+        unit.save()
+        self.assertEqual(list(filter_by_search_terms(units, u"frob", ['notes'])), [unit])
+
+    def test_search_terms_unmanaged(self):
+        """units are saved and indexed outside of managed transactions,
+        like in management commands"""
+        self.store.require_units()
+        unit = self.store.units[0]
+        transaction.enter_transaction_management()
+        transaction.managed(False)
+        try:
+            unit.target = u"Unmanaged xyzzy"
+            unit.save()
+            self.store.update_search_terms()
+        finally:
+            transaction.leave_transaction_management()
+        self.assertEqual(list(filter_by_search_terms(self.store.unit_set.all(), u"unmanaged", ['target'])), [unit])
+
+    def test_search_units(self):
+        """all words and phrases of a search have to match"""
+        self.assertEqual(parse_search(u'foo "bar baz" qux'), ([u'foo', u'qux', u'bar', u'baz'], [u'bar baz']))
+        self.store.require_units()
+        unit, other = self.store.units[:2]
+        unit.target = u"big red fish"
+        unit.save()
+        other.target = u"red big fish"
+        other.save()
+        phrase = u'"big red"'
+        units = self.store.units
+        results = search_units(self.store.translation_project, units, phrase, ['target'], refresh=True)
+        self.assertEqual(list(results), [unit.id])
+        self.assertEqual(len(search_units(self.store.translation_project, units, u"big red", ['target'], refresh=True)), 2)
+        # cached results are returned as they were
+        self.assertEqual(list(search_units(self.store.translation_project, units, phrase, ['target'])), list(results))
+        results = search_units(self.store.translation_project, units, u"big xyzzyplugh", ['target'], refresh=True)
+        self.assertEqual(len(results), 0)
+        # removing units outdates cached results
+        unit.delete()
+        self.assertFalse(unit.id in search_units(self.store.translation_project, units, phrase, ['target']))
+
+    def test_unit_stepping(self):
+        """keyset stepping and cached ordinals agree with counting"""
+        translation_project = self.store.translation_project
+        units = Unit.objects.filter(store__translation_project=translation_project)
+        ordinals = get_unit_ordinals(translation_project.id, units)
+        self.assertEqual(ordinals.total, units.count())
+        self.assertEqual(ordinals.store_offset(self.store.pootle_path),
+                         units.filter(store__pootle_path__lt=self.store.pootle_path).count())
+
+        for unit in self.store.units[:3]:
+            self.assertEqual(get_store_position(self.store, unit.index),
+                             self.store.units.filter(index__lt=unit.index).count())
+        unit = self.store.units[0]
+        unit.makeobsolete()
+        unit.save()
+        second = self.store.units[0]
+        self.assertEqual(get_store_position(self.store, second.index), 0)
+
+        first, second = self.store.units[:2]
+        self.assertEqual(get_step_unit(units, self.store.pootle_path, first.index), second)
+        self.assertEqual(get_step_unit(units, self.store.pootle_path, second.index, back=True), first)
+        last = units.order_by('-store__pootle_path', '-index')[0]
+        self.assertEqual(get_step_unit(units, last.store.pootle_path, last.index), None)
+
+    def test_unit_queue(self):
+        """unit queues are kept per owner until refreshed"""
+        translation_project = self.store.translation_project
+        self.store.require_units()
+        untranslated = Unit.objects.filter(store__translation_project=translation_project, state=UNTRANSLATED)
+        expected = list(untranslated.order_by('store__pootle_path', 'index').values_list('id', flat=True))
+        self.assertEqual(list(get_unit_queue(translation_project.id, untranslated, "user:1", refresh=True)), expected)
+        self.assertEqual(list(get_unit_queue(translation_project.id, untranslated, "user:2", refresh=True)), expected)
+
+        unit = self.store.units.filter(state=UNTRANSLATED)[0]
+        unit.target = u"translated"
+        unit.save()
+        self.assertEqual(list(get_unit_queue(translation_project.id, untranslated, "user:1")), expected)
+        remove_from_queue(untranslated, "user:1", [unit.id])
+        # other translators' queues are left alone
+        self.assertEqual(list(get_unit_queue(translation_project.id, untranslated, "user:2")), expected)
+        expected.remove(unit.id)
+        self.assertEqual(list(get_unit_queue(translation_project.id, untranslated, "user:1")), expected)
+        self.assertEqual(list(get_unit_queue(translation_project.id, untranslated, "user:2", refresh=True)), expected)
+
+    def test_find_altsrcs(self):
+        """alternative sources are looked up for a whole page at once"""
+        language = self.store.translation_project.language
+        units = list(self.store.units[:2])
+        for unit in units:
+            unit.target = u"alternative"
+            unit.save()
+        self.assertEqual(find_altsrcs(units[0], [language], units=units), [units[0]])
+        # found with the first unit's lookup
+        Unit.objects.filter(id=units[1].id).update(state=FUZZY)
+        self.assertEqual(find_altsrcs(units[1], [language], units=units), [units[1]])
+
+    def test_prefetch_units(self):
+        """prefetched suggestions and checks match lazily loaded ones"""
+        self.store.require_qualitychecks()
+        units = list(self.store.units[:10])
+        units[0].add_suggestion(u"prefetched suggestion")
+        expected = [(list(unit.get_suggestions()), list(unit.qualitycheck_set.all())) for unit in units]
+        units = list(self.store.units[:10])
+        prefetch_units(units)
+        self.assertEqual([(unit.get_suggestion_list(), unit.get_qualitycheck_list()) for unit in units], expected)
+        self.assertTrue(units[0].get_suggestion_list()[0].unit is units[0])
+        units[0].add_suggestion(u"another suggestion")
+        self.assertEqual(len(units[0].get_suggestion_list()), 2)
+
+    def test_lazy_multistring(self):
+        """multistring fields are built on first access and saved
+        unchanged when never read"""
+        unit = self.store.units[0]
+        source = unit.source_f
+        unit = Unit.objects.get(id=unit.id)
+        self.assertFalse(isinstance(unit.__dict__['source_f'], multistring))
+        unit.save()
+        self.assertEqual(Unit.objects.get(id=unit.id).source_f, source)
+        self.assertTrue(isinstance(unit.source_f, multistring))
+        self.assertEqual(unit.source_f.strings, source.strings)
+
+    def test_unit_rows(self):
+        """unit rows export like the units they were read from"""
+        units = list(self.store.units)
+        units[0].add_suggestion(u"row suggestion")
+        unitclass = self.store.get_file_class().UnitClass
+        rows = list(self.store.get_unit_rows(suggestions=True))
+        self.assertEqual([row.id for row in rows], [unit.id for unit in units])
+        for unit, row in zip(units, rows):
+            self.assertEqual(str(row.convert(unitclass)), str(unit.convert(unitclass)))
+            self.assertEqual(row.getnotes(), unit.getnotes())
+            self.assertEqual(row.hasplural(), unit.hasplural())
+        self.assertEqual([suggestion.target for suggestion in rows[0].get_suggestions()], [u"row suggestion"])
+
+    def test_tm_suggestions(self):
+        """translation memory finds translated units and follows their
+        changes"""
+        use_tm = getattr(settings, 'USE_TM', False)
+        settings.USE_TM = True
+        try:
+            unit = self.store.units.exclude(source_f=u"")[0]
+            unit.target = u"first tm target"
+            unit.markfuzzy(False)
+            unit.save()
+            memory = get_memory(self.store.translation_project.language_id)
+            matches = memory.matches(unit.source.strings[0])
+            self.assertEqual([(similarity, entry.target) for similarity, entry in matches if entry.id == unit.id],
+                             [(100, u"first tm target")])
+            self.assertFalse(unit.id in [entry.id for similarity, entry in get_tm_suggestions(unit)])
+            unit.target = u"second tm target"
+            unit.save()
+            matches = memory.matches(unit.source.strings[0])
+            self.assertEqual([entry.target for similarity, entry in matches if entry.id == unit.id],
+                             [u"second tm target"])
+            unit_id = unit.id
+            unit.delete()
+            self.assertFalse(unit_id in memory.entries)
+        finally:
+            settings.USE_TM = use_tm
+
+    def test_terminology_matcher(self):
+        """terminology index finds terms in text and follows their
+        changes"""
+        unit = self.store.units.exclude(source_f=u"")[0]
+        unit.target = u"first term target"
+        unit.save()
+        source = unit.source.strings[0]
+        matcher = TerminologyMatcher("test:%d" % self.store.id, self.store, self.store.unit_set.all())
+        self.assertTrue((unit.id, u"first term target") in
+                        [(term.id, term.target) for term in matcher.get_index().matches(u"before %s after" % source, 1000)])
+        unit.target = u"second term target"
+        unit.save()
+        self.assertTrue((unit.id, u"second term target") in
+                        [(term.id, term.target) for term in matcher.get_index().matches(source, 1000)])
+
+    def test_terminology_matcher_cache(self):
+        """terminology index is shared through the cache in chunks, the
+        process keeps its own copy when the cache loses them"""
+        unit = self.store.units.exclude(source_f=u"")[0]
+        unit.target = u"first term target"
+        unit.save()
+        source = unit.source.strings[0]
+        chunk_size = termindex.CACHE_CHUNK_SIZE
+        termindex.CACHE_CHUNK_SIZE = 64
+        try:
+            key = "test:%d" % self.store.id
+            matcher = TerminologyMatcher(key, self.store, self.store.unit_set.all())
+            index = matcher.get_index()
+            version, count = cache.get(matcher.key)
+            self.assertTrue(count > 1)
+            loaded = TerminologyMatcher(key, self.store, self.store.unit_set.all()).get_index()
+            self.assertEqual(loaded.terms, index.terms)
+
+            # chunk lost or refused by the cache
+            cache.delete("%s:%s:%d" % (matcher.key, version, count - 1))
+            unit.target = u"second term target"
+            unit.save()
+            self.assertTrue(matcher.get_index() is index)
+            self.assertTrue((unit.id, u"second term target") in
+                            [(term.id, term.target) for term in index.matches(source, 1000)])
+        finally:
+            termindex.CACHE_CHUNK_SIZE = chunk_size
+
+    def test_term_index(self):
+        """removed terms leave no empty trie branches"""
+        index = TermIndex()
+        index.add(1, u"open file", u"ffeil agor")
+        index.add(2, u"Open", u"agor")
+        self.assertEqual([term.id for term in index.matches(u"Open the file, open file")], [1, 2])
+        # the last word of a term may start a longer word
+        self.assertEqual([term.id for term in index.matches(u"Opening files")], [2])
+        self.assertEqual([term.id for term in index.matches(u"open files")], [1, 2])
+        self.assertEqual([term.id for term in index.matches(u"opens filesystems")], [2])
+        self.assertEqual([term.id for term in index.matches(u"reopen fil")], [])
+        index.remove(1)
+        self.assertEqual(index.trie, {u"open": {None: [2]}})
+        index.remove(2)
+        self.assertEqual(index.trie, {})
+
+    def test_render_unit_views(self):
+        """cached unit rows are rendered again once the unit is saved"""
+        language = self.store.translation_project.language
+        units = list(self.store.units[:3])
+        rendered = render_unit_views(units, language, units[0])
+        self.assertEqual(rendered[0], (units[0], None))
+        # edit unit's suggestions and checks loaded with the page
+        self.assertEqual(units[0].__dict__.get('_suggestions'), [])
+        self.assertEqual(render_unit_views(units, language, units[0]), rendered)
+        units[1].target = u"freshly rendered target"
+        units[1].save()
+        rendered = render_unit_views(units, language, units[0])
+        self.assertTrue(u"freshly rendered target" in rendered[1][1])
+
+    def test_queue_index_update(self):
+        """edited units are reindexed in one batch"""
+        class RecordingIndexer(object):
+            def __init__(self):
+                self.deleted = []
+                self.indexed = []
+            def delete_doc(self, ident):
+                self.deleted.append(ident['dbid'])
+            def begin_transaction(self):
+                pass
+            def index_document(self, doc):
+                self.indexed.append(doc)
+            def commit_transaction(self):
+                pass
+            def flush(self, optimize=False):
+                self.optimized = optimize
+
+        translation_project = self.store.translation_project
+        state = translation_project.non_db_state
+        indexing_enabled, index_initialized = state._indexing_enabled, state._index_initialized
+        state._indexing_enabled = state._index_initialized = True
+        indexer = RecordingIndexer()
+        try:
+            self.store.require_units()
+            units = list(self.store.units[:2])
+            for unit in units:
+                unit.target = u"changed"
+                unit.save()
+            self.assertEqual(_index_queues[translation_project.id], set(unit.id for unit in units))
+            translation_project.flush_index_queue(indexer)
+            self.assertEqual(sorted(indexer.deleted), sorted(str(unit.id) for unit in units))
+            self.assertEqual(len(indexer.indexed), 2)
+            self.assertEqual(indexer.indexed[0]['pomtime'], str(hash(self.store.get_mtime())**2))
+            self.assertFalse(indexer.optimized)
+            self.assertFalse(translation_project.id in _index_queues)
+        finally:
+            state._indexing_enabled, state._index_initialized = indexing_enabled, index_initialized
+            _index_queues.pop(translation_project.id, None)
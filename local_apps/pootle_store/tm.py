@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2010 Zuza Software Foundation
+#
+# This file is part of Pootle.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+"""translation memory built from the translated units of all projects
+in the database, kept in memory per language and updated as units are
+saved"""
+
+import time
+import logging
+import threading
+
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+
+from translate.search import lshtein
+
+from pootle_store.models import Unit
+from pootle_store.fields import to_multistring
+from pootle_store.util import TRANSLATED
+
+TM_MAX_LENGTH = 1000
+"""longer sources are left out of the translation memory"""
+
+TM_REFRESH_INTERVAL = 30
+"""seconds between checks for units saved by other server processes"""
+
+NGRAM_LENGTH = 3
+
+CANDIDATE_FACTOR = 10
+"""units compared with Levenshtein per requested match, picked by the
+number of n-grams they share with the source"""
+
+_memories = {}
+_memories_lock = threading.Lock()
+
+def use_tm():
+    return getattr(settings, 'USE_TM', False)
+
+def get_ngrams(text):
+    text = u" %s " % text.lower()
+    return set(text[i:i+NGRAM_LENGTH] for i in xrange(len(text) - NGRAM_LENGTH + 1))
+
+
+class TMEntry(object):
+    __slots__ = ('id', 'source', 'target', 'translation_project_id')
+
+    def __init__(self, id, source, target, translation_project_id):
+        self.id = id
+        self.source = source
+        self.target = target
+        self.translation_project_id = translation_project_id
+
+
+class TranslationMemory(object):
+    """translated units of one language, indexed by the n-grams of
+    their source text"""
+
+    def __init__(self, language_id):
+        self.language_id = language_id
+        self.entries = {}
+        self.index = {}
+        self.last_mtime = None
+        self.last_refresh = 0
+        self.lock = threading.RLock()
+
+    def _add(self, unit_id, source, target, translation_project_id):
+        self._remove(unit_id)
+        if not source or not target or len(source) > TM_MAX_LENGTH:
+            return
+        self.entries[unit_id] = TMEntry(unit_id, source, target, translation_project_id)
+        for ngram in get_ngrams(source):
+            self.index.setdefault(ngram, set()).add(unit_id)
+
+    def _remove(self, unit_id):
+        entry = self.entries.pop(unit_id, None)
+        if entry is None:
+            return
+        for ngram in get_ngrams(entry.source):
+            unit_ids = self.index.get(ngram)
+            if unit_ids is not None:
+                unit_ids.discard(unit_id)
+                if not unit_ids:
+                    del self.index[ngram]
+
+    def _load(self, units_queryset):
+        columns = ('id', 'state', 'source_f', 'target_f', 'store__translation_project', 'mtime')
+        for unit_id, state, source, target, tp_id, mtime in units_queryset.values_list(*columns).iterator():
+            if state >= TRANSLATED:
+                # plural forms aren't matched, only the singular
+                self._add(unit_id, to_multistring(source).strings[0],
+                          to_multistring(target).strings[0], tp_id)
+            else:
+                self._remove(unit_id)
+            if self.last_mtime is None or mtime > self.last_mtime:
+                self.last_mtime = mtime
+
+    def refresh(self):
+        """load units translated or changed since the last refresh,
+        including those saved by other processes"""
+        now = time.time()
+        if now - self.last_refresh < TM_REFRESH_INTERVAL:
+            return
+        self.lock.acquire()
+        try:
+            if now - self.last_refresh < TM_REFRESH_INTERVAL:
+                # refreshed by another thread meanwhile
+                return
+            self.last_refresh = now
+            units = Unit.objects.filter(store__translation_project__language=self.language_id)
+            if self.last_mtime is None:
+                logging.debug("Building translation memory for language %d", self.language_id)
+                units = units.filter(state__gte=TRANSLATED)
+            else:
+                # units saved within the second of the last refresh
+                # might have been missed, loading them again is harmless
+                units = units.filter(mtime__gte=self.last_mtime)
+            self._load(units)
+        finally:
+            self.lock.release()
+
+    def remove_unit(self, unit_id):
+        self.lock.acquire()
+        try:
+            self._remove(unit_id)
+        finally:
+            self.lock.release()
+
+    def update_unit(self, unit):
+        self.lock.acquire()
+        try:
+            if unit.istranslated():
+                self._add(unit.id, unit.source.strings[0], unit.target.strings[0],
+                          unit.store.translation_project_id)
+            else:
+                self._remove(unit.id)
+        finally:
+            self.lock.release()
+
+    def matches(self, source, max_candidates=4, min_similarity=75, exclude=None):
+        """TMEntries with a source similar to source, best first, as
+        (similarity, entry) pairs"""
+        if not source or len(source) > TM_MAX_LENGTH:
+            return []
+        self.refresh()
+        # Levenshtein similarity can't reach min_similarity for
+        # lengths too far apart
+        min_length = len(source) * min_similarity / 100
+        max_length = len(source) * 100 / max(min_similarity, 1)
+        self.lock.acquire()
+        try:
+            counts = {}
+            for ngram in get_ngrams(source):
+                for unit_id in self.index.get(ngram, ()):
+                    counts[unit_id] = counts.get(unit_id, 0) + 1
+            candidates = []
+            for unit_id, count in counts.iteritems():
+                entry = self.entries[unit_id]
+                if unit_id != exclude and min_length <= len(entry.source) <= max_length:
+                    candidates.append((count, entry))
+        finally:
+            self.lock.release()
+
+        candidates.sort(key=lambda candidate: -candidate[0])
+        comparer = lshtein.LevenshteinComparer(TM_MAX_LENGTH)
+        results = []
+        for count, entry in candidates[:max_candidates * CANDIDATE_FACTOR]:
+            similarity = comparer.similarity(source, entry.source, min_similarity)
+            if similarity >= min_similarity:
+                results.append((int(similarity), entry))
+        results.sort(key=lambda result: -result[0])
+        results = results[:max_candidates]
+
+        # units deleted by other server processes are only found out
+        # about here
+        existing = set(Unit.objects.filter(id__in=[entry.id for similarity, entry in results]).values_list('id', flat=True))
+        for similarity, entry in results:
+            if entry.id not in existing:
+                self.remove_unit(entry.id)
+        return [(similarity, entry) for similarity, entry in results if entry.id in existing]
+
+def get_memory(language_id):
+    """translation memory of language, built on first use"""
+    _memories_lock.acquire()
+    try:
+        if language_id not in _memories:
+            _memories[language_id] = TranslationMemory(language_id)
+        return _memories[language_id]
+    finally:
+        _memories_lock.release()
+
+def get_tm_suggestions(unit, max_candidates=4, min_similarity=75):
+    """translations of units similar to unit in any project, as
+    (similarity, TMEntry) pairs"""
+    if not use_tm() or not unit.source:
+        return []
+    memory = get_memory(unit.store.translation_project.language_id)
+    return memory.matches(unit.source.strings[0], max_candidates, min_similarity, exclude=unit.id)
+
+def unit_saved(sender, instance, **kwargs):
+    # units saved by other processes are found when memories refresh
+    if not _memories:
+        return
+    memory = _memories.get(instance.store.translation_project.language_id)
+    if memory is not None and memory.last_mtime is not None:
+        memory.update_unit(instance)
+
+post_save.connect(unit_saved, sender=Unit)
+
+def unit_deleted(sender, instance, **kwargs):
+    if not _memories:
+        return
+    memory = _memories.get(instance.store.translation_project.language_id)
+    if memory is not None:
+        memory.remove_unit(instance.id)
+
+post_delete.connect(unit_deleted, sender=Unit)
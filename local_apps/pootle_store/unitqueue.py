@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2010 Zuza Software Foundation
+#
+# This file is part of Pootle.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+"""queues of ids of the units matching a translate or review filter
+in (pootle_path, index) order, built once when a translator starts
+working through them and kept in the cache meanwhile. each translator
+has their own queue, units they change are dropped from it as soon as
+they stop matching."""
+
+from array import array
+
+from django.core.cache import cache
+
+from translate.misc.hash import md5_f
+
+from pootle_store.models import get_units_version_key
+
+QUEUE_CACHE_TIMEOUT = 3600
+"""seconds a queue is kept after it was last used"""
+
+def get_queue_owner(request):
+    """queues are kept per user, or per session for anonymous users"""
+    if request.user.is_authenticated():
+        return "user:%d" % request.user.id
+    if 'unitqueue' not in request.session:
+        # the session must be saved for its key to name the queue
+        request.session['unitqueue'] = True
+    return "session:%s" % request.session.session_key
+
+def _get_queue_key(owner, step_queryset):
+    return "unitqueue:%s:%s" % (owner, md5_f(unicode(step_queryset.query).encode('utf-8')).hexdigest())
+
+def get_unit_queue(translation_project_id, step_queryset, owner, refresh=False):
+    """ids of units in step_queryset ordered by position. the queue
+    is rebuilt when refresh is set or when units were added to or
+    removed from the translation project, units that stop matching
+    meanwhile are left for the caller to skip or remove."""
+    version_key = get_units_version_key(translation_project_id)
+    key = _get_queue_key(owner, step_queryset)
+    cached = cache.get_many([version_key, key])
+    version = cached.get(version_key)
+    if not refresh and key in cached and cached[key][0] == version:
+        return array('i', cached[key][1])
+
+    # sorting in python keeps DISTINCT and ORDER BY on joined
+    # columns out of the query
+    rows = step_queryset.order_by().values_list('store__pootle_path', 'index', 'id')
+    unit_ids = array('i')
+    last_id = None
+    for pootle_path, index, unit_id in sorted(rows.iterator()):
+        if unit_id != last_id:
+            unit_ids.append(unit_id)
+            last_id = unit_id
+
+    # stored as a packed string, queues can be long
+    cache.set(key, (version, unit_ids.tostring()), QUEUE_CACHE_TIMEOUT)
+    return unit_ids
+
+def remove_from_queue(step_queryset, owner, unit_ids):
+    """drop units that no longer match step_queryset from the cached
+    queue, positions of the remaining units are kept"""
+    key = _get_queue_key(owner, step_queryset)
+    cached = cache.get(key)
+    if cached is None or not unit_ids:
+        return
+    version, packed = cached
+    unit_ids = set(unit_ids)
+    queue = array('i', [unit_id for unit_id in array('i', packed) if unit_id not in unit_ids])
+    cache.set(key, (version, queue.tostring()), QUEUE_CACHE_TIMEOUT)
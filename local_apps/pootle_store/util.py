@@ -20,10 +20,11 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
 import os
+import re
 
 from django.conf import settings
 
-from pootle_misc.aggregate import sum_column
+from pootle_misc.aggregate import group_by_sum
 from pootle_misc.util import dictsum
 
 # Unit States
@@ -92,37 +93,67 @@ def completestatssum(queryset, empty_stats=empty_completestats):
             totals['errors'] += 1
     return totals
 
+stats_fields = ['total', 'totalsourcewords', 'untranslated', 'untranslatedsourcewords',
+                'fuzzy', 'fuzzysourcewords', 'translated', 'translatedsourcewords',
+                'translatedtargetwords']
+"""quickstats counters that can be materialized and summed"""
+
+def unit_stats(state, source_wordcount, target_wordcount):
+    """contribution of a single unit to quickstats"""
+    if state <= OBSOLETE:
+        return {}
+    stats = {'total': 1,
+             'totalsourcewords': source_wordcount}
+    if state == UNTRANSLATED:
+        stats['untranslated'] = 1
+        stats['untranslatedsourcewords'] = source_wordcount
+    elif state == FUZZY:
+        stats['fuzzy'] = 1
+        stats['fuzzysourcewords'] = source_wordcount
+    elif state == TRANSLATED:
+        stats['translated'] = 1
+        stats['translatedsourcewords'] = source_wordcount
+        stats['translatedtargetwords'] = target_wordcount
+    return stats
+
+def stats_delta(oldstats, newstats):
+    """difference between two quickstats dictionaries, zero entries
+    are dropped"""
+    delta = {}
+    for key in set(oldstats) | set(newstats):
+        value = newstats.get(key, 0) - oldstats.get(key, 0)
+        if value:
+            delta[key] = value
+    return delta
+
 def calculate_stats(units):
     """calculate translation statistics for given unit queryset"""
-    total = sum_column(units,
-                       ['source_wordcount'], count=True)
-    untranslated = sum_column(units.filter(state=UNTRANSLATED),
-                              ['source_wordcount'], count=True)
-    fuzzy = sum_column(units.filter(state=FUZZY),
-                       ['source_wordcount'], count=True)
-    translated = sum_column(units.filter(state=TRANSLATED),
-                            ['source_wordcount', 'target_wordcount'], count=True)
-    result = {}
-    result['total'] = total['count']
-    if result['total'] == 0:
-        result['totalsourcewords'] = 0
-    else:
-        result['totalsourcewords'] = total['source_wordcount']
-    result['fuzzy'] = fuzzy['count']
-    if result['fuzzy'] == 0:
-        result['fuzzysourcewords'] = 0
-    else:
-        result['fuzzysourcewords'] = fuzzy['source_wordcount']
-    result['untranslated'] = untranslated['count']
-    if result['untranslated'] == 0:
-        result['untranslatedsourcewords'] = 0
-    else:
-        result['untranslatedsourcewords'] = untranslated['source_wordcount']
-    result['translated'] = translated['count']
-    if result['translated'] == 0:
-        result['translatedsourcewords'] = 0
-        result['translatedtargetwords'] = 0
-    else:
-        result['translatedsourcewords'] = translated['source_wordcount']
-        result['translatedtargetwords'] = translated['target_wordcount']
+    by_state = group_by_sum(units, 'state', ['source_wordcount', 'target_wordcount'], count=True)
+    result = dict((field, 0) for field in stats_fields)
+    for state, totals in by_state.iteritems():
+        unitstats = unit_stats(state, totals['source_wordcount'] or 0, totals['target_wordcount'] or 0)
+        for field, value in unitstats.iteritems():
+            if field in ('total', 'untranslated', 'fuzzy', 'translated'):
+                value = totals['count']
+            result[field] += value
     return result
+
+TERM_MAX_LENGTH = 64
+"""longer words are truncated in the search index"""
+
+search_fields = {'source': ['source_f'],
+                 'target': ['target_f'],
+                 'notes': ['developer_comment', 'translator_comment'],
+                 'locations': ['locations']}
+"""unit columns covered by each field of the search form"""
+
+search_columns = sorted(set(column for columns in search_fields.values() for column in columns))
+
+# underscores are left out so plural separators never become terms
+_term_re = re.compile(r"[^\W_]+", re.UNICODE)
+
+def search_terms(text):
+    """set of normalized words in text, as stored in the search index"""
+    if not text:
+        return set()
+    return set(word[:TERM_MAX_LENGTH] for word in _term_re.findall(text.lower()))
@@ -31,20 +31,21 @@ from django.template import RequestContext
 from django.utils.translation import to_locale, ugettext as _
 from django.utils.translation.trans_real import parse_accept_lang_header
 from django.core.exceptions import PermissionDenied, ObjectDoesNotExist
-from django.core.cache import cache
 from django.conf import settings
 from django.utils import simplejson
 from django.views.decorators.cache import never_cache
 
 from pootle_misc.baseurl import redirect
 from pootle_app.models.permissions import get_matching_permissions, check_permission, check_profile_permission
-from pootle_misc.util import paginate
+from pootle_misc.util import paginate, patchcache
 from pootle_profile.models import get_profile
 from pootle_translationproject.forms import SearchForm
 from pootle_statistics.models import Submission
 from pootle_app.models import Suggestion as SuggestionStat
 
-from pootle_store.models import Store, Unit
+from pootle_store.models import Store, Unit, get_unit_ordinals, get_store_position
+from pootle_store.search import search_units
+from pootle_store.unitqueue import get_unit_queue, get_queue_owner, remove_from_queue
 from pootle_store.forms import unit_form_factory, highlight_whitespace
 from pootle_store.templatetags.store_tags import highlight_diffs
 from pootle_store.util import UNTRANSLATED, FUZZY, TRANSLATED
@@ -90,54 +91,6 @@ def get_alt_src_langs(request, profile, language):
             langs = Language.objects.filter(code__in=codes)
     return langs
 
-def get_non_indexed_search_step_query(form, units_queryset):
-    result = units_queryset
-    for word in form.cleaned_data['search'].split():
-        subresult = units_queryset.none()
-        if 'source' in form.cleaned_data['sfields']:
-            subresult = subresult | units_queryset.filter(source_f__contains=word)
-        if 'target' in form.cleaned_data['sfields']:
-            subresult = subresult | units_queryset.filter(target_f__contains=word)
-        if 'notes' in form.cleaned_data['sfields']:
-            subresult = subresult | units_queryset.filter(developer_comment__contains=word) | \
-                     units_queryset.filter(translator_comment__contains=word)
-        if 'locations' in form.cleaned_data['sfields']:
-            subresult = subresult | units_queryset.filter(locations__contains=word)
-        result = subresult & result
-    return result
-
-def get_search_step_query(translation_project, form, units_queryset):
-    """Narrows down units query to units matching search string"""
-
-    if translation_project.indexer is None:
-        logging.debug("No indexer for %s, using database search", translation_project)
-        return get_non_indexed_search_step_query(form, units_queryset)
-
-    logging.debug("Found %s indexer for %s, using indexed search",
-                  translation_project.indexer.INDEX_DIRECTORY_NAME, translation_project)
-
-    word_querylist = []
-    for word in form.cleaned_data['search'].split():
-        # Generate a list for the query based on the selected fields
-        word_querylist = [(field, word) for field in form.cleaned_data['sfields']]
-    paths = units_queryset.order_by().values_list('store__pootle_path', flat=True).distinct()
-    path_querylist = [('pofilename', pootle_path) for pootle_path in paths.iterator()]
-    cache_key = "search:%s" % str(hash((repr(path_querylist), translation_project.get_mtime(), repr(word_querylist))))
-
-    dbids = cache.get(cache_key)
-    if dbids is None:
-        searchparts = []
-        textquery = translation_project.indexer.make_query(word_querylist, False)
-        searchparts.append(textquery)
-        pathquery = translation_project.indexer.make_query(path_querylist, False)
-        searchparts.append(pathquery)
-        limitedquery = translation_project.indexer.make_query(searchparts, True)
-
-        result = translation_project.indexer.search(limitedquery, ['dbid'])
-        dbids = [int(item['dbid'][0]) for item in result[:999]]
-        cache.set(cache_key, dbids, settings.OBJECT_CACHE_TIMEOUT)
-    return units_queryset.filter(id__in=dbids)
-
 def get_step_query(request, units_queryset):
     """Narrows down unit query to units matching conditions in GET and POST"""
     if 'unit' in request.GET or 'page' in request.GET:
@@ -169,6 +122,26 @@ def get_step_query(request, units_queryset):
 
     return units_queryset.distinct()
 
+def get_step_unit(step_queryset, pootle_path, index, back=False):
+    """unit of step_queryset following (or with back preceding)
+    position (pootle_path, index). keyset queries fetching a single
+    row, the following store is only looked at when nothing is left in
+    the current one."""
+    if back:
+        queries = [step_queryset.filter(store__pootle_path=pootle_path, index__lt=index),
+                   step_queryset.filter(store__pootle_path__lt=pootle_path)]
+        order = ('-store__pootle_path', '-index')
+    else:
+        queries = [step_queryset.filter(store__pootle_path=pootle_path, index__gt=index),
+                   step_queryset.filter(store__pootle_path__gt=pootle_path)]
+        order = ('store__pootle_path', 'index')
+    for queryset in queries:
+        try:
+            return queryset.order_by(*order)[0]
+        except IndexError:
+            pass
+    return None
+
 def get_current_units(request, step_queryset, units_queryset):
     """returns current active unit, and in case of POST previously active unit"""
     edit_unit = None
@@ -194,27 +167,11 @@ def get_current_units(request, step_queryset, units_queryset):
         prev_index = int(request.POST['index'])
         pootle_path = request.POST['pootle_path']
         back = request.POST.get('back', False)
-        if back:
-            queryset = (step_queryset.filter(store__pootle_path=pootle_path, index__lte=prev_index) | \
-                        step_queryset.filter(store__pootle_path__lt=pootle_path)
-                        ).order_by('-store__pootle_path', '-index')
-        else:
-            queryset = (step_queryset.filter(store__pootle_path=pootle_path, index__gte=prev_index) | \
-                        step_queryset.filter(store__pootle_path__gt=pootle_path)
-                        ).order_by('store__pootle_path', 'index')
-
-        for unit in queryset.iterator():
-            if edit_unit is None and prev_unit is not None:
-                edit_unit = unit
-                break
-            if unit.id == prev_id:
-                prev_unit = unit
-            elif unit.index > prev_index or back and unit.index < prev_index:
-                logging.debug("submitting to a unit no longer part of step query, %s:%d", (pootle_path, prev_id))
-                # prev_unit no longer part of the query, load it directly
-                edit_unit = unit
-                prev_unit = Unit.objects.get(store__pootle_path=pootle_path, id=prev_id)
-                break
+        try:
+            prev_unit = Unit.objects.select_related('store').get(store__pootle_path=pootle_path, id=prev_id)
+        except Unit.DoesNotExist:
+            logging.debug("submitting to a unit that no longer exists, %s:%d", pootle_path, prev_id)
+        edit_unit = get_step_unit(step_queryset, pootle_path, prev_index, back)
 
     if edit_unit is None:
         if prev_unit is not None:
@@ -230,6 +187,63 @@ def get_current_units(request, step_queryset, units_queryset):
 
     return prev_unit, edit_unit, pager
 
+def get_current_queue_units(request, unit_ids, step_queryset, units_queryset, keyset=False, stale=None):
+    """like get_current_units, but steps through a list of unit ids,
+    search results or a unit queue. units no longer part of
+    step_queryset are skipped and their ids added to stale. with
+    keyset set, the list is ordered like step_queryset and a
+    previous unit missing from it is stepped from by position."""
+    def load(unit_id, queryset=step_queryset):
+        try:
+            return queryset.get(id=unit_id)
+        except Unit.DoesNotExist:
+            return None
+
+    edit_unit = None
+    prev_unit = None
+    position = -1
+    step = 1
+    if 'unit' in request.GET:
+        try:
+            edit_id = int(request.GET['unit'])
+            if edit_id in unit_ids:
+                edit_unit = load(edit_id)
+        except ValueError:
+            pass
+        if edit_unit is not None:
+            return prev_unit, edit_unit, None
+        # not part of the list, start with its first unit
+    elif 'id' in request.POST:
+        prev_id = int(request.POST['id'])
+        prev_unit = load(prev_id, units_queryset)
+        back = request.POST.get('back', False)
+        if back:
+            step = -1
+        try:
+            position = unit_ids.index(prev_id)
+        except ValueError:
+            if keyset and 'index' in request.POST and 'pootle_path' in request.POST:
+                # not part of the queue, find the neighbour by position
+                edit_unit = get_step_unit(step_queryset, request.POST['pootle_path'],
+                                          int(request.POST['index']), back)
+                if edit_unit is None and back:
+                    edit_unit = prev_unit
+                return prev_unit, edit_unit, None
+            # not part of the results, start over
+            step = 1
+
+    # skip over units that changed since the list was made
+    position += step
+    while edit_unit is None and 0 <= position < len(unit_ids):
+        edit_unit = load(unit_ids[position])
+        if edit_unit is None and stale is not None:
+            stale.append(unit_ids[position])
+        position += step
+
+    if edit_unit is None and step < 0:
+        edit_unit = prev_unit
+    return prev_unit, edit_unit, None
+
 def translate_end(request, translation_project):
     """render a message at end of review, translate or search action"""
     if request.POST:
@@ -269,22 +283,40 @@ def translate_page(request, units_queryset, store=None):
     # shouldn't we globalize profile context
     profile = get_profile(request.user)
 
-    step_queryset = None
-
     # Process search first
-    search_form = None
+    search_results = None
     if 'search' in request.GET and 'sfields' in request.GET:
         search_form = SearchForm(request.GET)
         if search_form.is_valid():
-            step_queryset = get_search_step_query(request.translation_project, search_form, units_queryset)
+            # results are kept while stepping through them, a new
+            # search recalculates them
+            search_results = search_units(translation_project, units_queryset,
+                                          search_form.cleaned_data['search'],
+                                          search_form.cleaned_data['sfields'],
+                                          refresh=not request.POST and 'unit' not in request.GET)
     else:
         search_form = SearchForm()
 
     # which units are we interested in?
-    if step_queryset is None:
+    unit_queue = None
+    if search_results is not None and 'page' not in request.GET:
+        prev_unit, edit_unit, pager = get_current_queue_units(request, search_results,
+                                                              units_queryset, units_queryset)
+    else:
         step_queryset = get_step_query(request, units_queryset)
-
-    prev_unit, edit_unit, pager = get_current_units(request, step_queryset, units_queryset)
+        if ('unitstates' in request.GET or 'matchnames' in request.GET) and \
+               'unit' not in request.GET and 'page' not in request.GET:
+            # a filter, step through the translator's queue instead of
+            # running the filter query again on every step
+            queue_owner = get_queue_owner(request)
+            unit_queue = get_unit_queue(translation_project.id, step_queryset, queue_owner,
+                                        refresh=not request.POST)
+            stale = []
+            prev_unit, edit_unit, pager = get_current_queue_units(request, unit_queue,
+                                                                  step_queryset, units_queryset,
+                                                                  keyset=True, stale=stale)
+        else:
+            prev_unit, edit_unit, pager = get_current_units(request, step_queryset, units_queryset)
 
     # time to process POST submission
     form = None
@@ -302,6 +334,9 @@ def translate_page(request, units_queryset, store=None):
                 sub = Submission(translation_project=translation_project,
                                  submitter=get_profile(request.user))
                 sub.save()
+                if unit_queue is not None and not step_queryset.filter(id=prev_unit.id).count():
+                    # translated unit no longer matches the filter
+                    stale.append(prev_unit.id)
             elif cansuggest and 'suggest' in request.POST:
                 #HACKISH: django 1.2 stupidly modifies instance on model form validation, reload unit from db
                 prev_unit = Unit.objects.get(id=prev_unit.id)
@@ -314,6 +349,9 @@ def translate_page(request, units_queryset, store=None):
             # form failed, don't skip to next unit
             edit_unit = prev_unit
 
+    if unit_queue is not None and stale:
+        remove_from_queue(step_queryset, queue_owner, stale)
+
     if edit_unit is None:
         # no more units to step through, display end of translation message
         return translate_end(request, translation_project)
@@ -325,14 +363,19 @@ def translate_page(request, units_queryset, store=None):
 
     if store is None:
         store = edit_unit.store
+        # positions come from cached ordinals instead of counting
+        # units on every step
+        ordinals = get_unit_ordinals(translation_project.id, units_queryset)
         pager_query = units_queryset
-        preceding = (pager_query.filter(store=store, index__lt=edit_unit.index) | \
-                     pager_query.filter(store__pootle_path__lt=store.pootle_path)).distinct().count()
-        store_preceding = store.units.filter(index__lt=edit_unit.index).count()
+        pager_count = ordinals.total
+        store_offset = ordinals.store_offset(store.pootle_path)
     else:
         pager_query = store.units
-        preceding = pager_query.filter(index__lt=edit_unit.index).count()
-        store_preceding = preceding
+        pager_count = store.getquickstats()['total']
+        store_offset = 0
+    store_preceding = get_store_position(store, edit_unit.index)
+    preceding = store_offset + store_preceding
+    store_total = store.getquickstats()['total']
 
     unit_rows = profile.get_unit_rows()
 
@@ -341,7 +384,7 @@ def translate_page(request, units_queryset, store=None):
     # the store not for the unit_step query
     if pager is None:
         page = preceding / unit_rows + 1
-        pager = paginate(request, pager_query, items=unit_rows, page=page)
+        pager = paginate(request, pager_query, items=unit_rows, page=page, count=pager_count)
 
     # we always display the active unit in the middle of the page to
     # provide context for translators
@@ -353,13 +396,15 @@ def translate_page(request, units_queryset, store=None):
             offset = unit_rows - (context_rows - unit_position)
             units_query = store.units[offset:]
             page = store_preceding / unit_rows
-            units = paginate(request, units_query, items=unit_rows, page=page).object_list
+            units = paginate(request, units_query, items=unit_rows, page=page,
+                             count=max(store_total - offset, 0)).object_list
         elif unit_position >= unit_rows - context_rows:
             # units too close to the bottom of the batch
             offset = context_rows - (unit_rows - unit_position - 1)
             units_query = store.units[offset:]
             page = store_preceding / unit_rows + 1
-            units = paginate(request, units_query, items=unit_rows, page=page).object_list
+            units = paginate(request, units_query, items=unit_rows, page=page,
+                             count=max(store_total - offset, 0)).object_list
         else:
             units = pager.object_list
     else:
@@ -513,6 +558,7 @@ def reject_qualitycheck(request, uid, checkid):
             check.delete()
             # update timestamp
             unit.save()
+            patchcache(unit.store, {'getcompletestats': None})
             response['success'] = True
         except ObjectDoesNotExist:
             check = None
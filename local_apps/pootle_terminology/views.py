@@ -67,7 +67,7 @@ def extract(request, translation_project):
         for store in translation_project.stores.iterator():
             if store.name == 'pootle-terminology.po':
                 continue
-            extractor.processunits(store.units, store.pootle_path)
+            extractor.processunits(store.get_unit_rows(), store.pootle_path)
         terms = extractor.extract_terms(create_termunit=create_termunit)
         termunits = extractor.filter_terms(terms, nonstopmin=2)
         store, created = Store.objects.get_or_create(parent=translation_project.directory, translation_project=translation_project,
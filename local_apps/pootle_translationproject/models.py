@@ -19,10 +19,10 @@
 # along with this program; if not, see <http://www.gnu.org/licenses/>.
 
 import os
-import cStringIO
+import time
 import gettext
-import zipfile
 import logging
+import threading
 
 from django.conf                   import settings
 from django.db                     import models, IntegrityError
@@ -30,20 +30,23 @@ from django.db.models.signals      import post_save
 from django.core.exceptions import PermissionDenied
 from django.utils.translation import ugettext_lazy as _
 
-from translate.filters import checks
-from translate.search  import match, indexing
+from translate.search  import indexing
 from translate.storage import versioncontrol
 from translate.storage.base import ParseError
 from translate.misc.lru import LRUCachingDict
 
 from pootle.scripts                import hooks
-from pootle_misc.util import getfromcache, dictsum
+from pootle_misc.util import getfromcache, deletefromcache, dictsum
 from pootle_misc.baseurl import l
 from pootle_misc.aggregate import group_by_count, max_column
-from pootle_store.util import calculate_stats
+from pootle_misc.ziparchive import ZipStream
 from pootle_store.models           import Store, Unit, QualityCheck, PARSED, CHECKED
+from pootle_store.models import store_stats_sum, iter_unit_rows
+from pootle_store.termindex import TerminologyMatcher
 from pootle_store.util             import relative_real_path, absolute_real_path
-from pootle_store.util import empty_quickstats, empty_completestats
+from pootle_store.qualitychecks import get_checker, make_check_pool
+from pootle_store.util import empty_quickstats, empty_completestats, OBSOLETE, TRANSLATED
+from pootle_store.fields import to_multistring
 
 from pootle_app.lib.util           import RelatedManager
 from pootle_project.models     import Project
@@ -52,17 +55,32 @@ from pootle_app.models.directory   import Directory
 from pootle_app                    import project_tree
 from pootle_app.models.permissions import check_permission
 from pootle_app.models.signals import post_vc_update, post_vc_commit
+from pootle_app.models.task import Task, register_task, use_task_queue
 
 
+INDEX_BATCH_SIZE = 100
+"""units reindexed per indexer transaction, more changes queued
+by a single request or command are written right away"""
+
+CATALOG_CHECK_INTERVAL = 10
+"""seconds live translation goes without checking for changed units"""
+
 class TranslationProjectNonDBState(object):
     def __init__(self, parent):
         self.parent = parent
         # terminology matcher
         self.termmatcher = None
-        self.termmatchermtime = None
+        # compiled translations for live translation
+        self.catalog = None
+        self.catalog_mtime = None
+        self.catalog_checked = 0
+        self.pluralfn = None
         self._indexing_enabled = True
         self._index_initialized = False
-        self.indexer = None
+
+# ids of changed units waiting to be reindexed by translation project id
+_index_queues = {}
+_index_queues_lock = threading.Lock()
 
 
 def create_translation_project(language, project):
@@ -132,12 +150,7 @@ class TranslationProject(models.Model):
     file_style = property(_get_treestyle)
 
     def _get_checker(self):
-        checkerclasses = [checks.projectcheckers.get(self.project.checkstyle,
-                                                     checks.StandardChecker),
-                          checks.StandardUnitChecker]
-        return checks.TeeChecker(checkerclasses=checkerclasses,
-                                 errorhandler=self.filtererrorhandler,
-                                 languagecode=self.language.code)
+        return get_checker(self.project.checkstyle, self.language.code, self.filtererrorhandler)
 
     checker = property(_get_checker)
 
@@ -151,7 +164,7 @@ class TranslationProject(models.Model):
                 self._non_db_state = self._non_db_state_cache[self.id]
             except KeyError:
                 self._non_db_state = TranslationProjectNonDBState(self)
-                self._non_db_state_cache[self.id] = TranslationProjectNonDBState(self)
+                self._non_db_state_cache[self.id] = self._non_db_state
 
         return self._non_db_state
 
@@ -171,10 +184,13 @@ class TranslationProject(models.Model):
     def get_mtime(self):
         return max_column(Unit.objects.filter(store__translation_project=self), 'mtime', None)
 
-    def require_units(self):
+    def require_units(self, task=None):
         """makes sure all stores are parsed"""
         errors = 0
-        for store in self.stores.filter(state__lt=PARSED).iterator():
+        stores = list(self.stores.filter(state__lt=PARSED))
+        for i, store in enumerate(stores):
+            if task is not None:
+                task.set_progress(i, len(stores))
             try:
                 store.require_units()
             except IntegrityError:
@@ -193,33 +209,44 @@ class TranslationProject(models.Model):
     def getquickstats(self):
         if self.is_template_project:
             return empty_quickstats
-        errors = self.require_units()
-        stats = calculate_stats(Unit.objects.filter(store__translation_project=self))
-        stats['errors'] = errors
-        return stats
+        return store_stats_sum(translation_project=self)
+
+    def require_qualitychecks(self, task=None, pool=None):
+        """makes sure quality checks of all stores are run, pool is
+        a CheckPool shared by batch jobs"""
+        stores = list(self.stores.filter(state__lt=CHECKED))
+        for i, store in enumerate(stores):
+            if task is not None:
+                task.set_progress(i, len(stores))
+            store.require_qualitychecks(pool)
 
     @getfromcache
     def getcompletestats(self):
         if self.is_template_project:
             return empty_completestats
-        for store in self.stores.filter(state__lt=CHECKED).iterator():
-            store.require_qualitychecks()
+        self.require_qualitychecks()
         return group_by_count(QualityCheck.objects.filter(unit__store__translation_project=self), 'name')
 
 
     def _get_indexer(self):
-        if self.non_db_state.indexer is None and self.non_db_state._indexing_enabled:
+        # kept with this instance only, not in the process wide
+        # non_db_state, see make_indexer
+        if getattr(self, '_indexer', None) is None and self.non_db_state._indexing_enabled:
             try:
                 indexer = self.make_indexer()
                 if not self.non_db_state._index_initialized:
-                    self.init_index(indexer)
+                    if use_task_queue():
+                        # search results stay incomplete until a worker is done
+                        Task.objects.queue('init_index', self.pootle_path)
+                    else:
+                        self.init_index(indexer)
                     self.non_db_state._index_initialized = True
-                self.non_db_state.indexer =  indexer
+                self._indexer = indexer
             except Exception, e:
                 logging.warning("Could not initialize indexer for %s in %s: %s", self.project.code, self.language.code, str(e))
                 self.non_db_state._indexing_enabled = False
 
-        return self.non_db_state.indexer
+        return getattr(self, '_indexer', None)
 
     indexer = property(_get_indexer)
 
@@ -271,23 +298,33 @@ class TranslationProject(models.Model):
         if not check_permission("commit", request):
             raise PermissionDenied(_("You do not have rights to update from version control here"))
 
+        if use_task_queue():
+            Task.objects.queue('update_project', self.pootle_path, request.user)
+            request.user.message_set.create(message=unicode(_("Update from version control will start shortly")))
+        else:
+            self.update_from_version_control(request.user)
+
+    def update_from_version_control(self, user, task=None):
         old_stats = self.getquickstats()
         remote_stats = {}
 
-        for store in self.stores.iterator():
+        stores = list(self.stores.all())
+        for i, store in enumerate(stores):
             try:
                 oldstats, remotestats, newstats = self.update_file_from_version_control(store)
                 remote_stats = dictsum(remote_stats, remotestats)
             except VersionControlError:
                 pass
+            if task is not None:
+                task.set_progress(i + 1, len(stores))
 
         project_tree.scan_translation_project_files(self)
         new_stats = self.getquickstats()
 
-        request.user.message_set.create(message=unicode(_("Updated %s files from version control", self.fullname)))
-        request.user.message_set.create(message=stats_message("working copy", old_stats))
-        request.user.message_set.create(message=stats_message("remote copy", remote_stats))
-        request.user.message_set.create(message=stats_message("merged copy", new_stats))
+        user.message_set.create(message=unicode(_("Updated %s files from version control", self.fullname)))
+        user.message_set.create(message=stats_message("working copy", old_stats))
+        user.message_set.create(message=stats_message("remote copy", remote_stats))
+        user.message_set.create(message=stats_message("merged copy", new_stats))
 
         post_vc_update.send(sender=self, oldstats=old_stats, remotestats=remote_stats, newstats=new_stats)
 
@@ -356,29 +393,9 @@ class TranslationProject(models.Model):
     ##############################################################################################
 
     def get_archive(self, stores):
-        """returns an archive of the given filenames"""
-        tempzipfile = None
-        try:
-            # using zip command line is fast
-            from tempfile import mkstemp
-            # The temporary file below is opened and immediately closed for security reasons
-            fd, tempzipfile = mkstemp(prefix='pootle', suffix='.zip')
-            os.close(fd)
-            os.system("cd %s ; zip -r - %s > %s" % (self.abs_real_path, " ".join(store.abs_real_path[len(self.abs_real_path)+1:] for store in stores), tempzipfile))
-            filedata = open(tempzipfile, "r").read()
-            if filedata:
-                return filedata
-        finally:
-            if tempzipfile is not None and os.path.exists(tempzipfile):
-                os.remove(tempzipfile)
-
-        # but if it doesn't work, we can do it from python
-        archivecontents = cStringIO.StringIO()
-        archive = zipfile.ZipFile(archivecontents, 'w', zipfile.ZIP_DEFLATED)
-        for store in stores:
-            archive.write(store.abs_real_path.encode('utf-8'), store.abs_real_path[len(self.abs_real_path)+1:].encode('utf-8'))
-        archive.close()
-        return archivecontents.getvalue()
+        """returns a ZipStream of the given stores' files"""
+        return ZipStream((store.abs_real_path[len(self.abs_real_path)+1:], store.abs_real_path)
+                         for store in stores)
 
 
     ##############################################################################################
@@ -449,7 +466,7 @@ class TranslationProject(models.Model):
             # interface. All other items should still be up-to-date (even with an
             # older pomtime).
             # delete the relevant item from the database
-            units = store.units.filter(id=unitid)
+            units = iter_unit_rows(store.units.filter(id=unitid))
             itemsquery = indexer.make_query([("dbid", str(unitid))], False)
             indexer.delete_doc([pofilenamequery, itemsquery])
         else:
@@ -458,88 +475,159 @@ class TranslationProject(models.Model):
             # delete all items of this file
             logging.debug("Updating %s indexer for file %s", self.pootle_path, store.pootle_path) 
             indexer.delete_doc({"pofilename": store.pootle_path})
-            units = store.units
-        addlist = []
-        for unit in units:
-            doc = {"pofilename": store.pootle_path,
-                   "pomtime": pomtime,
-                   "itemno": str(unit.index),
-                   "dbid": str(unit.id),
-                   }
-            if unit.hasplural():
-                orig = "\n".join(unit.source.strings)
-                trans = "\n".join(unit.target.strings)
-            else:
-                orig = unit.source
-                trans = unit.target
-            doc["source"] = orig
-            doc["target"] = trans
-            doc["notes"] = unit.getnotes()
-            doc["locations"] = unit.getlocations()
-            addlist.append(doc)
+            units = store.get_unit_rows()
+        addlist = [self._get_index_doc(store, unit, pomtime) for unit in units]
         if addlist:
+            self._index_documents(indexer, addlist, optimize)
+
+    def _get_index_doc(self, store, unit, pomtime):
+        doc = {"pofilename": store.pootle_path,
+               "pomtime": pomtime,
+               "itemno": str(unit.index),
+               "dbid": str(unit.id),
+               }
+        if unit.hasplural():
+            orig = "\n".join(unit.source.strings)
+            trans = "\n".join(unit.target.strings)
+        else:
+            orig = unit.source
+            trans = unit.target
+        doc["source"] = orig
+        doc["target"] = trans
+        doc["notes"] = unit.getnotes()
+        doc["locations"] = unit.getlocations()
+        return doc
+
+    def _index_documents(self, indexer, addlist, optimize=True):
+        try:
+            indexer.begin_transaction()
+            for add_item in addlist:
+                indexer.index_document(add_item)
+            indexer.commit_transaction()
+            indexer.flush(optimize=optimize)
+        except Exception, e:
+            logging.error("Error opening indexer for %s:\n%s", self, e)
             try:
-                indexer.begin_transaction()
-                for add_item in addlist:
-                    indexer.index_document(add_item)
-                indexer.commit_transaction()
-                indexer.flush(optimize=optimize)
-            except Exception, e:
-                logging.error("Error opening indexer for %s:\n%s", self, e)
-                try:
-                    indexer.cancel_transaction()
-                except:
-                    pass
+                indexer.cancel_transaction()
+            except:
+                pass
+
+    def queue_index_update(self, unit):
+        """reindex unit once the request is done, see
+        flush_index_queues"""
+        state = self.non_db_state
+        if not state._indexing_enabled or not state._index_initialized:
+            # index not loaded in this process, it will catch up with
+            # the store's mtime when it is
+            return
+        _index_queues_lock.acquire()
+        try:
+            queue = _index_queues.setdefault(self.id, set())
+            queue.add(unit.id)
+            full = len(queue) >= INDEX_BATCH_SIZE
+        finally:
+            _index_queues_lock.release()
+        if full:
+            self.flush_index_queue()
+
+    def flush_index_queue(self, indexer=None):
+        """reindex units queued by queue_index_update"""
+        _index_queues_lock.acquire()
+        try:
+            unit_ids = list(_index_queues.pop(self.id, ()))
+        finally:
+            _index_queues_lock.release()
+        if not unit_ids:
+            return
+
+        if indexer is None:
+            indexer = self.make_indexer()
+        for i in xrange(0, len(unit_ids), INDEX_BATCH_SIZE):
+            batch = unit_ids[i:i+INDEX_BATCH_SIZE]
+            for unit_id in batch:
+                indexer.delete_doc({"dbid": str(unit_id)})
+            addlist = []
+            pomtimes = {}
+            for unit in Unit.objects.filter(id__in=batch, state__gt=OBSOLETE).select_related('store').iterator():
+                store = unit.store
+                if store.pk not in pomtimes:
+                    # matching the store's mtime tells update_index
+                    # that the store needs no full reindex
+                    pomtimes[store.pk] = str(hash(store.get_mtime())**2)
+                addlist.append(self._get_index_doc(store, unit, pomtimes[store.pk]))
+            if addlist:
+                self._index_documents(indexer, addlist, optimize=False)
 
     ########################################################################################
 
     is_terminology_project = property(lambda self: self.pootle_path.endswith('/terminology/'))
     is_template_project = property(lambda self: self.pootle_path.startswith('/templates/'))
 
+    def _get_termmatcher(self, key, source, units_queryset):
+        # matchers keep their index between calls
+        matcher = self.non_db_state.termmatcher
+        if matcher is None or matcher.key != "termindex:%s" % key:
+            matcher = TerminologyMatcher(key, source, units_queryset)
+            self.non_db_state.termmatcher = matcher
+        return matcher
+
     def gettermmatcher(self):
         """returns the terminology matcher"""
         if self.is_terminology_project:
             if self.non_db_state.termmatcher is None:
                 self.require_units()
-
-            newmtime = self.get_mtime()
-            if newmtime != self.non_db_state.termmatchermtime:
-                self.non_db_state.termmatcher = match.terminologymatcher(self.stores.iterator())
-                self.non_db_state.termmatchermtime = newmtime
-        else:
+            return self._get_termmatcher("tp:%d" % self.id, self,
+                                         Unit.objects.filter(store__translation_project=self, state__gt=OBSOLETE))
+        try:
+            termfilename = "pootle-terminology." + self.project.localfiletype
+            store = self.stores.get(name=termfilename)
+            return self._get_termmatcher("store:%d" % store.id, store, store.unit_set.filter(state__gt=OBSOLETE))
+        except Store.DoesNotExist:
             try:
-                termfilename = "pootle-terminology." + self.project.localfiletype
-                store = self.stores.get(name=termfilename)
-                newmtime = store.get_mtime()
-                if newmtime != self.non_db_state.termmatchermtime:
-                    self.non_db_state.termmatcher = match.terminologymatcher(store)
-                    self.non_db_state.termmatchermtime = newmtime
-            except Store.DoesNotExist:
-                try:
-                    termproject = TranslationProject.objects.get(language=self.language_id, project__code='terminology')
-                    self.non_db_state.termmatcher = termproject.gettermmatcher()
-                    self.non_db_state.termmatchermtime = termproject.non_db_state.termmatchermtime
-                except TranslationProject.DoesNotExist:
-                    pass
-        return self.non_db_state.termmatcher
+                termproject = TranslationProject.objects.get(language=self.language_id, project__code='terminology')
+                return termproject.gettermmatcher()
+            except TranslationProject.DoesNotExist:
+                return None
 
     ##############################################################################################
 
-    #FIXME: we should cache results to ease live translation
+    def get_message_catalog(self):
+        """dict of translated sources to their target strings, rebuilt
+        when units change. checked at most every
+        CATALOG_CHECK_INTERVAL seconds."""
+        state = self.non_db_state
+        now = time.time()
+        if state.catalog is not None and now - state.catalog_checked < CATALOG_CHECK_INTERVAL:
+            return state.catalog
+        state.catalog_checked = now
+        mtime = self.get_mtime()
+        if state.catalog is None or mtime != state.catalog_mtime:
+            logging.debug("Compiling message catalog for %s", self.pootle_path)
+            self.require_units()
+            catalog = {}
+            units = Unit.objects.filter(store__translation_project=self, state__gte=TRANSLATED)
+            for source, target in units.order_by('store__pootle_path').values_list('source_f', 'target_f').iterator():
+                # like findunit, the first store with a translation wins
+                catalog.setdefault(to_multistring(source).strings[0], tuple(to_multistring(target).strings))
+            if self.language.pluralequation:
+                state.pluralfn = gettext.c2py(self.language.pluralequation)
+            else:
+                state.pluralfn = None
+            state.catalog = catalog
+            state.catalog_mtime = mtime
+        return state.catalog
+
     def translate_message(self, singular, plural=None, n=1):
-        for store in self.stores.iterator():
-            unit = store.findunit(singular)
-            if unit is not None and unit.istranslated():
-                if unit.hasplural() and n != 1:
-                    nplural = self.language.nplurals
-                    pluralequation = self.language.pluralequation
-                    if pluralequation:
-                        pluralfn = gettext.c2py(pluralequation)
-                        target =  unit.target.strings[pluralfn(n)]
-                        if target is not None:
-                            return target
-                else:
-                    return unit.target
+        targets = self.get_message_catalog().get(singular)
+        if targets is not None:
+            if len(targets) == 1 or n == 1:
+                return targets[0]
+            pluralfn = self.non_db_state.pluralfn
+            if pluralfn is not None:
+                try:
+                    return targets[pluralfn(n)]
+                except IndexError:
+                    pass
 
         # no translation found
         if n != 1 and plural is not None:
@@ -561,3 +649,54 @@ def scan_projects(sender, instance, **kwargs):
     for project in Project.objects.iterator():
         create_translation_project(instance, project)
 post_save.connect(scan_projects, sender=Language)
+
+def flush_index_queues():
+    """reindex units changed in this process, done at the end of each
+    request by the calling thread with indexers of its own, indexers
+    can't be shared between threads"""
+    _index_queues_lock.acquire()
+    try:
+        translation_project_ids = _index_queues.keys()
+    finally:
+        _index_queues_lock.release()
+    for translation_project in TranslationProject.objects.filter(id__in=translation_project_ids).iterator():
+        try:
+            translation_project.flush_index_queue()
+        except Exception:
+            logging.exception("Failed to update search index for %s", translation_project)
+
+################ Background Tasks ###################
+
+def get_task_translation_project(task):
+    return TranslationProject.objects.get(pootle_path=task.pootle_path)
+
+@register_task('require_units', _('Importing translation files'))
+def require_units_task(task):
+    get_task_translation_project(task).require_units(task)
+
+@register_task('require_qualitychecks', _('Running quality checks'))
+def require_qualitychecks_task(task):
+    translation_project = get_task_translation_project(task)
+    pool = make_check_pool()
+    try:
+        translation_project.require_qualitychecks(task, pool)
+    finally:
+        if pool is not None:
+            pool.close()
+    deletefromcache(translation_project, ["getcompletestats"])
+
+@register_task('init_index', _('Building search index'))
+def init_index_task(task):
+    translation_project = get_task_translation_project(task)
+    translation_project.init_index(translation_project.make_indexer())
+
+@register_task('update_project', _('Updating from version control'))
+def update_project_task(task):
+    get_task_translation_project(task).update_from_version_control(task.user, task)
+
+@register_task('convert_templates', _('Updating from templates'))
+def convert_templates_task(task):
+    translation_project = get_task_translation_project(task)
+    template_translation_project = TranslationProject.objects.get(project=translation_project.project,
+                                                                  language__code='templates')
+    project_tree.convert_templates(template_translation_project, translation_project)
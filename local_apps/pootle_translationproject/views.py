@@ -26,7 +26,6 @@ import zipfile
 import datetime
 
 from django.shortcuts import get_object_or_404
-from django.http import HttpResponse
 from django.utils.translation import ugettext_lazy as _
 from django.core.exceptions import PermissionDenied
 from django.shortcuts import render_to_response
@@ -39,6 +38,7 @@ from translate.storage import factory, versioncontrol
 from pootle_app.models.permissions import get_matching_permissions, check_permission
 from pootle_app.models.signals import post_file_upload
 from pootle_app.models             import Directory
+from pootle_app.models.task import Task, use_task_queue
 from pootle_app.lib import view_handler
 from pootle_app.project_tree import scan_translation_project_files, convert_templates
 from pootle_app.views.top_stats import gentopstats_translation_project
@@ -48,8 +48,9 @@ from pootle_app.views.language.view import get_stats_headings
 from pootle_app.views.admin import util
 from pootle_app.views.admin.permissions import admin_permissions
 from pootle_app.views.language.view import get_translation_project, set_request_context
+from pootle_misc.ziparchive import ZipResponse
 
-from pootle_store.models import Store, Unit
+from pootle_store.models import Store, Unit, PARSED, CHECKED, quickstats_many
 from pootle_store.util import absolute_real_path, relative_real_path
 from pootle_store.filetypes import factory_classes
 from pootle_store.views import translate_page
@@ -59,6 +60,31 @@ from pootle_profile.models import get_profile
 from pootle_translationproject.models import TranslationProject
 
 
+def processing_page(request, translation_project, directory, checks=False):
+    """with the task queue enabled, expensive jobs the page depends on
+    are queued and a placeholder is returned while they are unfinished"""
+    if not use_task_queue():
+        return None
+    task_names = []
+    if translation_project.stores.filter(state__lt=PARSED).count():
+        task_names.append('require_units')
+    if checks and translation_project.stores.filter(state__lt=CHECKED).count():
+        task_names.append('require_qualitychecks')
+    tasks = filter(None, [Task.objects.require(name, translation_project.pootle_path) for name in task_names])
+    if not tasks:
+        return None
+
+    template_vars = {
+        'translation_project': translation_project,
+        'project': translation_project.project,
+        'language': translation_project.language,
+        'directory': directory,
+        'feed_path': directory.pootle_path[1:],
+        'tasks': tasks,
+        }
+    return render_to_response("translation_project/tp_processing.html", template_vars,
+                              context_instance=RequestContext(request))
+
 class TPTranslateView(BaseView):
     def GET(self, template_vars, request, translation_project, directory):
         template_vars = super(TPTranslateView, self).GET(template_vars, request)
@@ -87,6 +113,9 @@ def tp_translate(request, translation_project, dir_path):
         raise PermissionDenied(_("You do not have rights to access translation mode."))
 
     directory = get_object_or_404(Directory, pootle_path=translation_project.directory.pootle_path + dir_path)
+    response = processing_page(request, translation_project, directory)
+    if response is not None:
+        return response
 
     view_obj = TPTranslateView(forms=dict(upload=UploadHandler,
                                           update=UpdateHandler))
@@ -123,6 +152,10 @@ def tp_review(request, translation_project, dir_path):
         raise PermissionDenied(_("You do not have rights to access review mode."))
 
     directory = get_object_or_404(Directory, pootle_path=translation_project.directory.pootle_path + dir_path)
+    response = processing_page(request, translation_project, directory, checks=True)
+    if response is not None:
+        return response
+
     view_obj = TPReviewView({})
     return render_to_response("translation_project/tp_review.html",
                               view_obj(request, translation_project, directory),
@@ -168,7 +201,10 @@ def tp_admin_files(request, translation_project):
         template_translation_project = TranslationProject.objects.get(project=translation_project.project,
                                                                       language__code='templates')
         if 'template_update' in request.GET:
-            convert_templates(template_translation_project, translation_project)
+            if use_task_queue():
+                Task.objects.queue('convert_templates', translation_project.pootle_path, request.user)
+            else:
+                convert_templates(template_translation_project, translation_project)
     except TranslationProject.DoesNotExist:
         pass
 
@@ -224,6 +260,10 @@ def tp_overview(request, translation_project, dir_path):
     if not check_permission("view", request):
         raise PermissionDenied(_("You do not have rights to access this translation project."))
     directory = get_object_or_404(Directory, pootle_path=translation_project.directory.pootle_path + dir_path)
+    response = processing_page(request, translation_project, directory)
+    if response is not None:
+        return response
+
     view_obj = ProjectIndexView(forms=dict(upload=UploadHandler,
                                            update=UpdateHandler))
     return render_to_response("translation_project/tp_overview.html",
@@ -238,22 +278,24 @@ def export_zip(request, translation_project, file_path):
     translation_project.sync()
     pootle_path = translation_project.pootle_path + (file_path or '')
     stores = Store.objects.filter(pootle_path__startswith=pootle_path).exclude(file='')
-    archivecontents = translation_project.get_archive(stores)
-    response = HttpResponse(archivecontents, content_type="application/zip")
+    archive = translation_project.get_archive(stores.iterator())
     if file_path.endswith("/"):
         file_path = file_path[:-1]
     fish, file_path = os.path.split(file_path)
     archivename = '%s-%s' % (translation_project.project.code, translation_project.language.code)
     archivename += '-' + file_path.replace('/', '-') + '.zip'
-    response['Content-Disposition'] = 'attachment; filename=%s' % archivename
-    return response
+    return ZipResponse(archive, archivename)
 
 
 def get_children(request, translation_project, directory, links_required=None):
-    return [item_dict.make_directory_item(request, child_dir, links_required=links_required)
-            for child_dir in directory.child_dirs.iterator()] + \
-           [item_dict.make_store_item(request, child_store, links_required=links_required)
-            for child_store in directory.child_stores.iterator()]
+    child_dirs = list(directory.child_dirs.iterator())
+    child_stores = list(directory.child_stores.iterator())
+    dir_stats = child_dirs and quickstats_many(child_dirs) or []
+    store_stats = child_stores and quickstats_many(child_stores, 'id') or []
+    return [item_dict.make_directory_item(request, child_dir, links_required=links_required, quick_stats=stats)
+            for child_dir, stats in zip(child_dirs, dir_stats)] + \
+           [item_dict.make_store_item(request, child_store, links_required=links_required, quick_stats=stats)
+            for child_store, stats in zip(child_stores, store_stats)]
 
 def unix_to_host_path(p):
     return os.sep.join(p.split('/'))
@@ -42,14 +42,34 @@ LIVE_TRANSLATION = False
 # every request, Pootle keeps a pool of already parsed files in memory.
 #
 # Larger pools will offer better performance, but higher memory usage
-# (per server process). When the pool fills up, 1/PARSE_POOL_CULL_FREQUENCY
-# number of files will be removed from the pool.
+# (per server process). PARSE_POOL_MEMORY is the approximate number of
+# bytes parsed files may use, when the pool fills up the least recently
+# used files are removed from the pool.
 
+# DEFAULT: 100MB
+PARSE_POOL_MEMORY = 100 * 1024 * 1024
+
+# Number of translation projects whose terminology indexes and plural
+# rules, parsed from their stores, are kept around next to the parsed
+# files. When the pool fills up, 1/PARSE_POOL_CULL_FREQUENCY of them
+# will be removed.
 # DEFAULT: 40
 PARSE_POOL_SIZE = 40
 # DEFAULT: 4
 PARSE_POOL_CULL_FREQUENCY = 4
 
+# Parsed files can also be kept in a directory shared by all server
+# processes, loading a file from there is much faster than parsing it
+# again. The directory must only be writable by the Pootle server.
+# Set to None to disable.
+# DEFAULT: None
+PARSE_CACHE_DIR = None
+#PARSE_CACHE_DIR = working_path('parsecache')
+# Maximum size of the shared parse cache in bytes, least recently
+# used files are removed first.
+# DEFAULT: 256MB
+PARSE_CACHE_SIZE = 256 * 1024 * 1024
+
 
 # Cache Backend settings
 #
@@ -78,6 +98,13 @@ CACHE_BACKEND = 'locmem:///?max_entries=4096&cull_frequency=5'
 # DEFAULT: 600
 CACHE_MIDDLEWARE_SECONDS = 600
 
+# Recalculating statistics of big projects can take a long time. Set
+# this to True to keep serving the previous statistics while a single
+# background thread recalculates them, instead of making every request
+# wait for the recalculation.
+# DEFAULT: False
+OBJECT_CACHE_SERVE_STALE = False
+
 
 # Set this to False. DEBUG mode is only needed when testing beta's or
 # hacking Pootle.
@@ -123,6 +150,30 @@ USE_CAPTCHA = False
 # the files.
 AUTOSYNC = False
 
+# Number of worker processes used to run quality checks on big files
+# by refresh_stats, update_stores and run_tasks. Quality checks are CPU
+# bound, on multi core servers setting this to the number of cores
+# speeds up importing new files considerably. Web requests always run
+# quality checks in the web server process.
+# 0 runs quality checks in the command's process.
+# DEFAULT: 0
+QUALITYCHECK_PROCESSES = 0
+
+# Set this to True to run expensive operations like importing new
+# files, running quality checks, building the search index and
+# updating from version control or templates in the background.
+# Pages show a progress notice until the work is done. Requires running
+# "manage.py run_tasks --forever" next to the web server.
+# DEFAULT: False
+USE_TASK_QUEUE = False
+
+# Set this to True to suggest translations of similar strings from all
+# projects on the translate page. The translation memory of each
+# language is built in memory by every server process the first time it
+# is used, which takes a while and a lot of memory on large servers.
+# DEFAULT: False
+USE_TM = False
+
 # Set the backends you want to use to enable translation suggestions through
 # several online services. To disable this feature completely just comment all
 # the lines to set an empty list [] to the MT_BACKENDS setting.
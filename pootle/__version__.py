@@ -20,6 +20,6 @@
 
 """This file contains the version of Pootle."""
 
-build = 21000
+build = 21002
 sver = "2.1.0-beta1"
 ver = (2, 1, 0)
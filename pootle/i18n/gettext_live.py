@@ -59,7 +59,7 @@ def _translate_message(singular, plural, n):
         live_translation = get_live_translation(default_locale)
 
     if live_translation is None:
-        _dummy_translate(singular, plural, n)
+        return _dummy_translate(singular, plural, n)
 
     return live_translation.translate_message(singular, plural, n)
 
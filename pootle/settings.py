@@ -99,6 +99,8 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.csrf.middleware.CsrfMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'pootle_misc.middleware.permissions.PermissionsMiddleware',
+    'pootle_misc.middleware.indexing.IndexingMiddleware',
     'django.middleware.locale.LocaleMiddleware',
     'pootle_misc.middleware.errorpages.ErrorPagesMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -4,6 +4,7 @@ import tempfile
 import os
 
 from django.conf import settings
+from django.core.cache import cache
 from django.test import TestCase
 from django.http import QueryDict
 from django.core.management import call_command
@@ -86,7 +87,18 @@ msgstr[1] ""
     def _teardown_test_podir(self):
         shutil.rmtree(self.testpodir)
 
+    def _clear_cache(self):
+        # cached results and their patches refer to the previous
+        # test's database
+        if hasattr(cache, 'clear'):
+            cache.clear()
+        else:
+            # django < 1.2 can't clear caches, tests use locmem
+            cache._cache.clear()
+            cache._expire_info.clear()
+
     def setUp(self):
+        self._clear_cache()
         self._setup_test_podir()
 
         #FIXME: replace initdb with a fixture